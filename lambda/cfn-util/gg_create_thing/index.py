@@ -2,17 +2,39 @@
 This lambda function controls a cloudformation custom resource which
 creates a thing and necessary key and certificates on stack creation.
 On stack deletion, this lambda ensures certificates and policies get deleted properly.
+
+The functions provision_things and deprovision_things create or delete many things
+concurrently, e.g. to onboard a fleet of cores with scripts/provision_fleet.py.
 """
+import os
 import sys
+import copy
+import functools
 import json
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 import cfnresponse
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# Maximum IoT API calls per second of all workers, 0 is unlimited
+API_RATE = float(os.getenv("API_RATE", "10"))
+# Number of things provisioned or deleted concurrently
+PROVISION_WORKERS = int(os.getenv("PROVISION_WORKERS", "8"))
+# Attempts of a throttled IoT API call
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "8"))
+# Base and maximum delay in seconds of the exponential backoff between attempts
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "5"))
+# Error codes of throttled API calls
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "Throttling")
+
 POLICY_DOCUMENT = {
     'Version': '2012-10-17',
     'Statement': [
@@ -30,42 +52,224 @@ POLICY_DOCUMENT = {
 }
 
 
+def policy_name(thingName):
+    return '{}-full-access'.format(thingName)
+
+
+def error_code(error):
+    return error.response['Error']['Code']
+
+
+class TokenBucket:
+    """
+       Hands out rate tokens per second to all workers, bursts of up to burst calls are allowed
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # a negative balance reserves a token in the future
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+class RateLimitedClient:
+    """
+       Wraps a boto3 client. Every call takes a token of the bucket shared by all workers,
+       throttled calls are retried with exponential backoff and jitter
+    """
+
+    def __init__(self, client, rate=API_RATE):
+        self.client = client
+        self.bucket = TokenBucket(rate, max(1, int(rate)))
+
+    def __getattr__(self, name):
+        operation = getattr(self.client, name)
+
+        def call(**kwargs):
+            for attempt in range(MAX_ATTEMPTS):
+                self.bucket.acquire()
+                try:
+                    return operation(**kwargs)
+                except ClientError as error:
+                    if error_code(error) not in THROTTLING_ERRORS or attempt == MAX_ATTEMPTS - 1:
+                        raise
+                    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                    logger.info('Throttled %s, retrying in %.2f seconds', name, delay)
+                    time.sleep(delay)
+        return call
+
+
+def ignore(codes, operation, **kwargs):
+    """
+       Calls operation and ignores the given error codes, so steps which already ran can run again
+    """
+    try:
+        return operation(**kwargs)
+    except ClientError as error:
+        if error_code(error) not in codes:
+            raise
+        return None
+
+
+def provision_thing(client, thingName, state=None, on_progress=None):
+    """
+       Creates the thing, its key and certificate and its policy and attaches them.
+       state records the steps which ran, a partly provisioned thing is resumed from there.
+       It is updated after every step, so it also records the progress of a failed attempt.
+       on_progress(state, step) is called after every step.
+    """
+    state = {} if state is None else state
+    on_progress = on_progress or (lambda state, step: None)
+    if not state.get('thing'):
+        # fails only if the thing exists with different attributes
+        client.create_thing(thingName=thingName)
+        state['thing'] = True
+        on_progress(state, 'thing')
+    if 'certificateArn' not in state:
+        # the private key is only returned once, the certificate is created only if none was recorded
+        response = client.create_keys_and_certificate(setAsActive=True)
+        state['certificateId'] = response['certificateId']
+        state['certificateArn'] = response['certificateArn']
+        state['certificatePem'] = response['certificatePem']
+        state['privateKey'] = response['keyPair']['PrivateKey']
+        on_progress(state, 'certificate')
+    if not state.get('policy'):
+        ignore(('ResourceAlreadyExistsException',), client.create_policy,
+               policyName=policy_name(thingName), policyDocument=json.dumps(POLICY_DOCUMENT))
+        state['policy'] = True
+        on_progress(state, 'policy')
+    if not state.get('attached'):
+        # attaching is idempotent
+        client.attach_policy(policyName=policy_name(thingName), target=state['certificateArn'])
+        client.attach_thing_principal(thingName=thingName, principal=state['certificateArn'])
+        state['attached'] = True
+        on_progress(state, 'attached')
+    logger.info('Created thing: %s, cert: %s and policy: %s' %
+                (thingName, state['certificateId'], policy_name(thingName)))
+    return state
+
+
+def deprovision_thing(client, thingName, state=None, on_progress=None):
+    """
+       Deletes the thing with its certificates and policy. Parts which are already deleted are skipped.
+       state records the certificates of the thing, so a failed attempt is resumed for certificates
+       which were already detached from the thing. on_progress(state, step) is called after every step.
+    """
+    state = {} if state is None else state
+    on_progress = on_progress or (lambda state, step: None)
+    principals = state.setdefault('principals', [])
+    response = ignore(('ResourceNotFoundException',), client.list_thing_principals, thingName=thingName)
+    for i in (response or {}).get('principals', []) + [state.get('certificateArn')]:
+        if i and i not in principals:
+            principals.append(i)
+    on_progress(state, 'principals')
+    for i in list(principals):
+        ignore(('ResourceNotFoundException',), client.detach_thing_principal,
+               thingName=thingName, principal=i)
+        ignore(('ResourceNotFoundException',), client.detach_policy,
+               policyName=policy_name(thingName), target=i)
+        ignore(('ResourceNotFoundException',), client.update_certificate,
+               certificateId=i.split('/')[-1], newStatus='INACTIVE')
+        ignore(('ResourceNotFoundException',), client.delete_certificate,
+               certificateId=i.split('/')[-1], forceDelete=True)
+        principals.remove(i)
+        on_progress(state, 'certificate')
+    ignore(('ResourceNotFoundException',), client.delete_policy, policyName=policy_name(thingName))
+    ignore(('ResourceNotFoundException',), client.delete_thing, thingName=thingName)
+    logger.info('Deleted thing: %s and cert/policy' % thingName)
+
+
+def run_concurrently(operation, thingNames, workers, on_result=None):
+    """
+       Runs operation(thingName) for all things on workers threads. Returns the result or the
+       error of every thing by name, on_result(thingName, result, error) is called as they complete.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(operation, thingName): thingName for thingName in thingNames}
+        for future in as_completed(futures):
+            thingName = futures[future]
+            try:
+                result, error = future.result(), None
+            except (BotoCoreError, ClientError) as e:
+                result, error = None, e
+                logger.error('Error for thing %s: %s', thingName, e)
+            results[thingName] = error or result
+            if on_result:
+                on_result(thingName, result, error)
+    return results
+
+
+def tracked(operation, thingName, states, lock, on_progress):
+    """
+       Runs operation(thingName, state, on_progress) on a copy of the state of the thing in states.
+       The copy is written back to states under lock after every step, so states can be read,
+       e.g. saved, under lock while the workers run.
+    """
+    with lock:
+        state = copy.deepcopy(states.get(thingName, {}))
+
+    def progress(state, step):
+        with lock:
+            states[thingName] = copy.deepcopy(state)
+        if on_progress:
+            on_progress(thingName, step)
+    return operation(thingName, state, progress)
+
+
+def provision_things(client, thingNames, states=None, workers=PROVISION_WORKERS, on_result=None,
+                     on_progress=None, lock=None):
+    """
+       Provisions the things concurrently, see provision_thing. states maps thing names to their
+       state and is updated in place under lock, so a failed run can be resumed by passing it again.
+       on_progress(thingName, step) is called from the worker threads after every step.
+    """
+    states = {} if states is None else states
+    lock = lock or threading.Lock()
+    return run_concurrently(
+        lambda thingName: tracked(functools.partial(provision_thing, client), thingName, states, lock, on_progress),
+        thingNames, workers, on_result)
+
+
+def deprovision_things(client, thingNames, states=None, workers=PROVISION_WORKERS, on_result=None,
+                       on_progress=None, lock=None):
+    """
+       Deletes the things concurrently, see deprovision_thing. states is updated in place like in provision_things.
+    """
+    states = {} if states is None else states
+    lock = lock or threading.Lock()
+    return run_concurrently(
+        lambda thingName: tracked(functools.partial(deprovision_thing, client), thingName, states, lock, on_progress),
+        thingNames, workers, on_result)
+
+
 def handler(event, context):
     responseData = {}
     try:
         logger.info('Received event: {}'.format(json.dumps(event)))
         result = cfnresponse.FAILED
-        client = boto3.client('iot')
+        client = RateLimitedClient(boto3.client('iot'))
         thingName = event['ResourceProperties']['ThingName']
         if event['RequestType'] == 'Create':
-            thing = client.create_thing(
-                thingName=thingName
-            )
-            response = client.create_keys_and_certificate(
-                setAsActive=True
-            )
-            certId = response['certificateId']
-            certArn = response['certificateArn']
-            certPem = response['certificatePem']
-            privateKey = response['keyPair']['PrivateKey']
-            client.create_policy(
-                policyName='{}-full-access'.format(thingName),
-                policyDocument=json.dumps(POLICY_DOCUMENT)
-            )
-            response = client.attach_policy(
-                policyName='{}-full-access'.format(thingName),
-                target=certArn
-            )
-            response = client.attach_thing_principal(
-                thingName=thingName,
-                principal=certArn,
-            )
-            logger.info('Created thing: %s, cert: %s and policy: %s' %
-                        (thingName, certId, '{}-full-access'.format(thingName)))
+            state = provision_thing(client, thingName)
             result = cfnresponse.SUCCESS
-            responseData['certificateId'] = certId
-            responseData['certificatePem'] = certPem
-            responseData['privateKey'] = privateKey
+            responseData['certificateId'] = state['certificateId']
+            responseData['certificatePem'] = state['certificatePem']
+            responseData['privateKey'] = state['privateKey']
             responseData['iotEndpoint'] = client.describe_endpoint(
                 endpointType='iot:Data-ATS')['endpointAddress']
         elif event['RequestType'] == 'Update':
@@ -73,32 +277,7 @@ def handler(event, context):
             result = cfnresponse.SUCCESS
         elif event['RequestType'] == 'Delete':
             logger.info('Deleting thing: %s and cert/policy' % thingName)
-            response = client.list_thing_principals(
-                thingName=thingName
-            )
-            for i in response['principals']:
-                response = client.detach_thing_principal(
-                    thingName=thingName,
-                    principal=i
-                )
-                response = client.detach_policy(
-                    policyName='{}-full-access'.format(thingName),
-                    target=i
-                )
-                response = client.update_certificate(
-                    certificateId=i.split('/')[-1],
-                    newStatus='INACTIVE'
-                )
-                response = client.delete_certificate(
-                    certificateId=i.split('/')[-1],
-                    forceDelete=True
-                )
-                response = client.delete_policy(
-                    policyName='{}-full-access'.format(thingName),
-                )
-                response = client.delete_thing(
-                    thingName=thingName
-                )
+            deprovision_thing(client, thingName)
             result = cfnresponse.SUCCESS
     except ClientError as e:
         logger.error('Error: {}'.format(e))
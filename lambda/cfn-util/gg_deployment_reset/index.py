@@ -8,7 +8,12 @@ NOTE: The role has elevated permissions and should be scoped down for production
 import os
 import sys
 import json
+import itertools
 import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import boto3
 from botocore.exceptions import ClientError
 import cfnresponse
@@ -18,6 +23,15 @@ ROLE_NAME = "greengrass_cfn_{}_ServiceRole".format(os.environ["STACK_NAME"])
 # The policies to be attached to the role
 POLICY_ARN = "arn:aws:iam::aws:policy/service-role/AWSGreengrassResourceAccessRolePolicy"
 POLICY_ARN_S3 = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+# Number of groups inspected concurrently when looking up the group of the core
+LOOKUP_WORKERS = int(os.getenv("LOOKUP_WORKERS", "16"))
+# Attempts of a throttled Greengrass API call
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "10"))
+# Base and maximum delay in seconds of the exponential backoff between attempts
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.1"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "5"))
+# Error codes of throttled API calls
+THROTTLING_ERRORS = ("ThrottlingException", "TooManyRequestsException", "Throttling")
 
 
 lgr = logging.getLogger()
@@ -26,41 +40,152 @@ greengrass = boto3.client("greengrass")
 iam = boto3.client("iam")
 
 
-def find_group(thing_name):
+class Backoff:
     """
-       Returns the Greengrass group for the given core thing name
+       Exponential backoff with jitter shared by all workers, a throttled call delays the calls of all workers
     """
-    res_auth = ""
-    response = greengrass.list_groups()
-    for grp in response["Groups"]:
-        thingfound = False
-        group_version = greengrass.get_group_version(
-            GroupId=grp["Id"], GroupVersionId=grp["LatestVersion"]
-        )
 
-        core_arn = group_version["Definition"].get(
-            "CoreDefinitionVersionArn", "")
-        if core_arn:
-            core_id = core_arn[
-                core_arn.index("/cores/") + 7: core_arn.index("/versions/")
-            ]
-            core_version_id = core_arn[
-                core_arn.index("/versions/") + 10: len(core_arn)
-            ]
-            thingfound = False
-            response_core_version = greengrass.get_core_definition_version(
-                CoreDefinitionId=core_id, CoreDefinitionVersionId=core_version_id
-            )
-            if "Cores" in response_core_version["Definition"]:
-                for thing_arn in response_core_version["Definition"]["Cores"]:
-                    if thing_name == thing_arn["ThingArn"].split("/")[1]:
-                        thingfound = True
-                        break
-        if thingfound:
-            lgr.info("found thing: %s, group id is: %s" %
-                     (thing_name, grp["Id"]))
-            res_auth = grp["Id"]
-            return res_auth
+    def __init__(self):
+        self.until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, attempt):
+        delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+        with self.lock:
+            self.until = max(self.until, time.monotonic() + delay)
+        lgr.info("Throttled, retrying in %.2f seconds", delay)
+
+
+backoff = Backoff()
+
+
+def call(operation, **kwargs):
+    """
+       Calls a Greengrass API operation, throttled calls are retried with exponential backoff
+    """
+    for attempt in range(MAX_ATTEMPTS):
+        backoff.wait()
+        try:
+            return operation(**kwargs)
+        except ClientError as error:
+            if error.response["Error"]["Code"] not in THROTTLING_ERRORS or attempt == MAX_ATTEMPTS - 1:
+                raise
+            backoff.throttled(attempt)
+
+
+def list_groups():
+    """
+       Yields all Greengrass groups, the next page is only requested when the previous one is used up
+    """
+    kwargs = {}
+    while True:
+        response = call(greengrass.list_groups, **kwargs)
+        for grp in response.get("Groups", []):
+            yield grp
+        if not response.get("NextToken"):
+            return
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def has_tag(grp, tag):
+    """
+       Returns whether the group has the given tag, written as key=value
+    """
+    key, _, value = tag.partition("=")
+    tags = call(greengrass.list_tags_for_resource, ResourceArn=grp["Arn"]).get("tags", {})
+    return tags.get(key) == value
+
+
+def has_core(grp, thing_name):
+    """
+       Returns whether the latest version of the group has the given core thing name
+    """
+    if not grp.get("LatestVersion"):
+        return False
+    group_version = call(
+        greengrass.get_group_version, GroupId=grp["Id"], GroupVersionId=grp["LatestVersion"]
+    )
+    core_arn = group_version["Definition"].get("CoreDefinitionVersionArn", "")
+    if not core_arn:
+        return False
+    core_id = core_arn[
+        core_arn.index("/cores/") + 7: core_arn.index("/versions/")
+    ]
+    core_version_id = core_arn[
+        core_arn.index("/versions/") + 10: len(core_arn)
+    ]
+    response_core_version = call(
+        greengrass.get_core_definition_version,
+        CoreDefinitionId=core_id, CoreDefinitionVersionId=core_version_id
+    )
+    for thing_arn in response_core_version["Definition"].get("Cores", []):
+        if thing_name == thing_arn["ThingArn"].split("/")[1]:
+            return True
+    return False
+
+
+def matches(grp, thing_name, tag):
+    """
+       Returns whether the group is the one looked for, groups which cannot be inspected do not match
+    """
+    try:
+        return (not tag or has_tag(grp, tag)) and has_core(grp, thing_name)
+    except ClientError as error:
+        if error.response["Error"]["Code"] in THROTTLING_ERRORS:
+            # still throttled after all attempts, the group could be the one looked for
+            raise
+        lgr.warning("Could not inspect group %s: %s", grp["Id"], error)
+        return False
+
+
+def find_first(groups, thing_name, tag=None, workers=LOOKUP_WORKERS):
+    """
+       Returns the id of the first group found with the given core thing name (and tag).
+       Groups are inspected by a pool of workers, the lookup stops at the first match.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    groups = iter(groups)
+    try:
+        while True:
+            # keep the workers busy without listing all groups up front
+            for grp in itertools.islice(groups, 2 * workers - len(pending)):
+                pending[executor.submit(matches, grp, thing_name, tag)] = grp
+            if not pending:
+                return None
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                grp = pending.pop(future)
+                if future.result():
+                    return grp["Id"]
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def find_group(thing_name, group_name=None, tag=None):
+    """
+       Returns the Greengrass group for the given core thing name.
+       Groups with the given name or tag are inspected first, if none matches all groups are inspected.
+    """
+    gid = None
+    if group_name:
+        gid = find_first((grp for grp in list_groups() if grp.get("Name") == group_name), thing_name)
+    if not gid and tag:
+        gid = find_first(list_groups(), thing_name, tag)
+    if not gid and (group_name or tag):
+        lgr.info("No group with name %s or tag %s has core %s, inspecting all groups", group_name, tag, thing_name)
+    if not gid:
+        gid = find_first(list_groups(), thing_name)
+    if gid:
+        lgr.info("found thing: %s, group id is: %s" % (thing_name, gid))
+    return gid
 
 
 def manage_role(cmd):
@@ -109,12 +234,16 @@ def handler(event, context):
     """
        Create and attach greengrass role on create.
        Delete role and reset greengrass deployment on delete!
+       Nothing to do on update, the group is looked up with the new properties on delete.
     """
     response_data = {}
     try:
         lgr.info("Received event: %s", json.dumps(event))
         res = cfnresponse.FAILED
         thing_name = event["ResourceProperties"]["ThingName"]
+        # optional, finds the group without inspecting all groups of the account
+        group_name = event["ResourceProperties"].get("GroupName")
+        group_tag = event["ResourceProperties"].get("GroupTag")
         if event["RequestType"] == "Create":
             try:
                 greengrass.get_service_role_for_account()
@@ -123,8 +252,11 @@ def handler(event, context):
                 manage_role("CREATE")
                 lgr.info("GG service role created")
                 res = cfnresponse.SUCCESS
+        elif event["RequestType"] == "Update":
+            lgr.info("Updated properties of the group of %s", thing_name)
+            res = cfnresponse.SUCCESS
         elif event["RequestType"] == "Delete":
-            gid = find_group(thing_name)
+            gid = find_group(thing_name, group_name, group_tag)
             lgr.info("Group id to delete: %s", gid)
             if gid:
                 greengrass.reset_deployments(Force=True, GroupId=gid)
@@ -139,4 +271,5 @@ def handler(event, context):
         res = cfnresponse.FAILED
     lgr.info("Response of: %s, with result of: %s", res, response_data)
     sys.stdout.flush()
-    cfnresponse.send(event, context, res, response_data)
+    # a new physical id on update would replace the resource and delete the old one, i.e. the role
+    cfnresponse.send(event, context, res, response_data, physicalResourceId=event.get("PhysicalResourceId"))
@@ -0,0 +1,103 @@
+"""
+Confidence based model cascade.
+
+Most images are easy to classify. With CASCADE_BACKEND set, every batch first runs
+through a cheap model, e.g. a quantized Tensorflow Lite model (see
+scripts/quantize_model.py), the Neo model or the same model at a lower input resolution
+(CASCADE_IMG_SIZE). Only the images whose top-1 confidence is below CASCADE_THRESHOLD
+are escalated to the full model. Results report the stage which answered, and the
+share of escalated images is reported with the metrics.
+
+The confidence is the score of the model, so both models must return probabilities
+(see SOFTMAX in postprocessing.py) over the same labels.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import os
+import threading
+import PIL.Image as Image
+from backends import load_backend
+from preprocessing import Preprocessor
+
+# backend of the cheap first stage, empty disables the cascade
+CASCADE_BACKEND = os.getenv("CASCADE_BACKEND", "")
+# model directory of the cheap first stage, defaults to the model directory of the function
+CASCADE_MODEL_DIR = os.getenv("CASCADE_MODEL_DIR", "")
+# input size of the cheap first stage, defaults to the input size of the full model
+CASCADE_IMG_SIZE = int(os.getenv("CASCADE_IMG_SIZE", "0"))
+# images with a lower top-1 confidence in the first stage are escalated to the full model
+CASCADE_THRESHOLD = float(os.getenv("CASCADE_THRESHOLD", "0.6"))
+
+STAGE_FAST = "fast"
+STAGE_FULL = "full"
+
+
+class Cascade:
+    """
+        Classifies images with fast(images) and escalates the uncertain ones to full(images).
+        Both return one result per image.
+    """
+
+    def __init__(self, fast, full, threshold=CASCADE_THRESHOLD):
+        self.fast = fast
+        self.full = full
+        self.threshold = threshold
+        self._images = 0
+        self._escalated = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, images, escalate_all=False):
+        """
+            Returns a result per image. escalate_all runs all images through both models, e.g. to warm them up.
+        """
+        results = self.fast(images)
+        escalate = [index for index, result in enumerate(results)
+                    if escalate_all or result["confidence"] < self.threshold]
+        for result in results:
+            result["stage"] = STAGE_FAST
+        if escalate:
+            escalated = self.full([images[index] for index in escalate])
+            for index, result in zip(escalate, escalated):
+                result["stage"] = STAGE_FULL
+                results[index] = result
+        with self._lock:
+            self._images += len(images)
+            self._escalated += len(escalate)
+        return results
+
+    def stats(self):
+        """
+            Returns the number of images and escalations since the previous call.
+        """
+        with self._lock:
+            images, escalated = self._images, self._escalated
+            self._images = self._escalated = 0
+        return {
+            "images": images,
+            "escalated": escalated,
+            "escalation_rate": round(escalated / images, 3) if images else 0,
+        }
+
+
+def create_cascade(run_model, backend, preprocessor, model_dir, backend_name=CASCADE_BACKEND,
+                   cascade_model_dir=CASCADE_MODEL_DIR, img_size=CASCADE_IMG_SIZE):
+    """
+        Returns the Cascade of the cheap model in front of backend, or None if no cheap model is configured.
+        run_model(backend, preprocessor, images, stage) runs prepared images through a model.
+    """
+    if not backend_name:
+        return None
+    fast_backend = load_backend(backend_name, cascade_model_dir or model_dir)
+    fast_preprocessor = Preprocessor(img_size or preprocessor.size, fast_backend.layout,
+                                     allocate=fast_backend.allocate_batch)
+
+    def fast(images):
+        if fast_preprocessor.size != preprocessor.size:
+            # images are prepared for the full model, scale them down to the input of the cheap model
+            images = [fast_preprocessor.resize(Image.fromarray(image)) for image in images]
+        return run_model(fast_backend, fast_preprocessor, images, "inference_" + STAGE_FAST)
+
+    def full(images):
+        return run_model(backend, preprocessor, images, "inference")
+    return Cascade(fast, full)
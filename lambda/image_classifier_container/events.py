@@ -0,0 +1,125 @@
+"""
+Parsing of inference requests.
+
+A request names a single image, or a list of images to be classified together:
+
+    {"image": "http://camera.local/snapshot.jpg"}
+    {"images": ["http://camera.local/1.jpg", "file:///images/2.jpg",
+                {"name": "frame-3", "data": "<base64 encoded image>"}]}
+
+Images are given by http(s) URL, by file:// URL of a file on the core (see
+FILE_IMAGE_ROOT in download.py) or inline as base64 encoded image bytes, so gateways
+which already hold the image do not need to serve it over HTTP. All images of a list
+run in a single batch and their results are published in one response.
+
+Optionally, a request sets its "priority" (higher is processed first, default 0) and
+either a "deadline" (Unix time in seconds) or a "timeout_ms" after which its result is
+no longer needed. A request which is not processed in time is answered with an
+"expired" error instead (see scheduling.py).
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import base64
+import binascii
+import os
+import threading
+import time
+from collections import namedtuple
+from ingestion import MAX_IMAGE_BYTES
+
+# maximum number of images in a single request
+MAX_IMAGES_PER_REQUEST = int(os.getenv("MAX_IMAGES_PER_REQUEST", "32"))
+
+# milliseconds after which requests without deadline expire, 0 never expires them
+REQUEST_TIMEOUT_MS = float(os.getenv("REQUEST_TIMEOUT_MS", "0"))
+
+URL_SCHEMES = ("http://", "https://", "file://")
+
+# name identifies the image in the response, source is its URL or the raw bytes of an inline image
+ImageSource = namedtuple("ImageSource", ["name", "source"])
+
+
+class InvalidRequest(ValueError):
+    """
+        Raised for requests which do not follow the request format.
+    """
+
+
+def parse_image(value, index=0):
+    """
+        Returns the ImageSource of an image parameter, index names inline images without a name.
+    """
+    if isinstance(value, str):
+        if not value.startswith(URL_SCHEMES):
+            raise InvalidRequest("Image parameter is not a URL. Please specify a valid image URL.")
+        return ImageSource(value, value)
+    if not isinstance(value, dict) or not isinstance(value.get("data"), str):
+        raise InvalidRequest("Image parameter must be a URL or an object with base64 encoded data.")
+    # base64 encodes 3 bytes in 4 characters, reject large images before decoding them
+    if len(value["data"]) * 3 // 4 > MAX_IMAGE_BYTES:
+        raise InvalidRequest("Image exceeds the maximum size of {} bytes".format(MAX_IMAGE_BYTES))
+    try:
+        data = base64.b64decode(value["data"], validate=True)
+    except (binascii.Error, ValueError) as error:
+        raise InvalidRequest("Inline image data is not valid base64: {}".format(error)) from error
+    return ImageSource(str(value.get("name") or "inline:{}".format(index)), data)
+
+
+def parse_images(event):
+    """
+        Returns the images of a request and whether their results are published in one response.
+        Raises InvalidRequest if the request does not follow the request format.
+    """
+    if "images" in event:
+        images = event["images"]
+        if not isinstance(images, list) or not images:
+            raise InvalidRequest("Images parameter must be a non-empty list.")
+        if len(images) > MAX_IMAGES_PER_REQUEST:
+            raise InvalidRequest("Request exceeds the maximum of {} images".format(MAX_IMAGES_PER_REQUEST))
+        return [parse_image(image, index) for index, image in enumerate(images)], True
+    if "image" in event:
+        return [parse_image(event["image"])], False
+    raise InvalidRequest("No image URL/location in payload")
+
+
+def parse_schedule(event, timeout_ms=REQUEST_TIMEOUT_MS):
+    """
+        Returns the priority of a request and its deadline as time.monotonic() value, or None.
+        Raises InvalidRequest if priority or deadline are not numbers.
+    """
+    try:
+        priority = int(event.get("priority", 0))
+        if "deadline" in event:
+            # convert from wall clock time, the monotonic clock does not jump
+            return priority, time.monotonic() + float(event["deadline"]) - time.time()
+        timeout_ms = float(event.get("timeout_ms", timeout_ms))
+    except (TypeError, ValueError) as error:
+        raise InvalidRequest("Priority, deadline and timeout_ms must be numbers.") from error
+    return priority, (time.monotonic() + timeout_ms / 1000.0 if timeout_ms > 0 else None)
+
+
+class Gather:
+    """
+        Collects the results of count callbacks and calls on_complete with the list of all results
+        once the last one arrived.
+    """
+
+    def __init__(self, count, on_complete):
+        self.results = [None] * count
+        self.on_complete = on_complete
+        self._remaining = count
+        self._lock = threading.Lock()
+
+    def callback(self, index):
+        """
+            Returns the callback which delivers the result at index.
+        """
+        def deliver(result):
+            self.results[index] = result
+            with self._lock:
+                self._remaining -= 1
+                complete = not self._remaining
+            if complete:
+                self.on_complete(self.results)
+        return deliver
@@ -0,0 +1,167 @@
+"""
+Low overhead per-stage latency metrics.
+
+Durations of the processing stages (download, decode, preprocess, inference, publish)
+are collected into log-scale histograms in memory. A reporter thread publishes a
+compact summary with counts, percentiles, queue depths and errors on the metrics
+topic in a fixed interval and starts the next interval with empty histograms.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# topic the metric summaries are published to, empty disables publishing
+METRICS_TOPIC = os.getenv("METRICS_TOPIC", "gg_ml_sample/metrics")
+# seconds between two metric summaries
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "60"))
+
+# upper bound in milliseconds of the first histogram bucket
+HISTOGRAM_MIN_MS = 0.05
+# every bucket is this much wider than the previous one, which bounds the error of a percentile
+HISTOGRAM_GROWTH = 1.2
+# enough buckets to cover durations up to about a minute
+HISTOGRAM_BUCKETS = 80
+
+
+class Histogram:
+    """
+        Histogram of durations in milliseconds with logarithmic buckets.
+    """
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, millis):
+        if millis <= HISTOGRAM_MIN_MS:
+            index = 0
+        else:
+            index = min(HISTOGRAM_BUCKETS - 1,
+                        int(math.log(millis / HISTOGRAM_MIN_MS, HISTOGRAM_GROWTH)) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += millis
+        self.max = max(self.max, millis)
+
+    def percentile(self, pct):
+        """
+            Returns an estimate of the given percentile, the geometric middle of the bucket holding it.
+        """
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if not index:
+                    return min(self.max, HISTOGRAM_MIN_MS)
+                return min(self.max, HISTOGRAM_MIN_MS * HISTOGRAM_GROWTH ** (index - 0.5))
+        return self.max
+
+    def summary(self):
+        return {
+            "n": self.count,
+            "avg": round(self.total / self.count, 2) if self.count else 0,
+            "p50": round(self.percentile(50), 2),
+            "p95": round(self.percentile(95), 2),
+            "p99": round(self.percentile(99), 2),
+            "max": round(self.max, 2),
+        }
+
+
+class Metrics:
+    """
+        Collects stage durations, error counts and gauges of a function.
+    """
+
+    def __init__(self):
+        self._stages = {}
+        self._errors = {}
+        self._gauges = {}
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.record(seconds * 1000)
+
+    def error(self, stage):
+        with self._lock:
+            self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    @contextmanager
+    def timer(self, stage):
+        """
+            Records the duration of the enclosed block, or an error of the stage if it raised.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.error(stage)
+            raise
+        self.record(stage, time.perf_counter() - start)
+
+    def gauge(self, name, read):
+        """
+            Registers a function whose current value is reported with every summary, e.g. a queue depth.
+        """
+        self._gauges[name] = read
+
+    def summary(self, reset=True):
+        """
+            Returns the metrics collected since the last reset.
+        """
+        now = time.monotonic()
+        with self._lock:
+            stages, errors = self._stages, self._errors
+            interval = now - self._started
+            if reset:
+                self._stages, self._errors, self._started = {}, {}, now
+        summary = {
+            "interval": round(interval, 1),
+            "stages": {name: histogram.summary() for name, histogram in stages.items()},
+            "errors": errors,
+        }
+        for name, read in self._gauges.items():
+            try:
+                summary[name] = read()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not read gauge %s", name)
+        return summary
+
+
+def start_reporter(metrics, publish, topic=METRICS_TOPIC, interval=METRICS_INTERVAL, fields=None):
+    """
+        Starts a thread which calls publish(topic, payload) with a metrics summary every interval seconds.
+        fields are added to every summary, e.g. the function ARN.
+    """
+    if not topic:
+        return None
+
+    def report():
+        while True:
+            time.sleep(interval)
+            summary = dict(fields or {})
+            summary.update(metrics.summary())
+            try:
+                publish(topic, json.dumps(summary, separators=(",", ":")))
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not publish metrics")
+
+    thread = threading.Thread(target=report, name="metrics-reporter", daemon=True)
+    thread.start()
+    return thread
@@ -1,79 +1,391 @@
+# imported first, so the startup profiler also measures the imports below
+from startup import StartupProfiler, report_startup, warm_up, warmup_batch_sizes
 import json
 import logging
 import os
-import urllib.request
+import time
+import uuid
 import greengrasssdk
-import numpy as np
-import PIL.Image as Image
-from dlr import DLRModel
+from backends import create_backend
+from batching import MicroBatcher
+from cascade import create_cascade
+from cache import ResultCache, load_cached, load_data
+from coalescing import create_coalescer
+from download import Downloader, Prefetcher
+from events import MAX_IMAGES_PER_REQUEST, Gather, InvalidRequest, parse_images, parse_schedule
+from metrics import Metrics, start_reporter
+from model_server import serve_models
+from model_update import create_updater
+from postprocessing import Postprocessor, load_labels
+from preprocessing import Preprocessor
+from reloading import ReloadingBackend
+from scheduling import RequestDropped
+from spool import create_spool
+from stream import start_stream
 
+profiler = StartupProfiler()
+profiler.mark("imports")
 
 
 logger = logging.getLogger()
 iot_client = greengrasssdk.client('iot-data')
 
 # where to find the machine learning resource
-MODEL_DIR = "/models/image_classifier/"
+MODEL_DIR = os.getenv("MODEL_DIR", "/models/image_classifier/")
 # Which topic to use for output
 DEFAULT_TOPIC_RESPONSE = 'gg_ml_sample/out'
+# whether to generate a trace id for requests which do not carry one
+TRACE_REQUESTS = os.getenv("TRACE_REQUESTS", "false").lower() == "true"
 # the parameter required in the input
 IMAGE_PARAM = "image"
 # the DEFAULT image size for the model
 IMG_SIZE = 224
-# The filesystem location where to store the image on the device
-IMAGE_FILE = '/tmp/image.jpg'
+# the inference backend used unless INFERENCE_BACKEND is set, see backends.py
+DEFAULT_BACKEND = "dlr"
 
-model = DLRModel(MODEL_DIR, 'cpu')
+backend = create_backend(MODEL_DIR, DEFAULT_BACKEND, profiler)
+# swap in new models of MODEL_DIR without restarting the function, see reloading.py
+backend = reloader = ReloadingBackend(backend)
+# serve the model to the other functions of the core if MODEL_SERVER_MODELS is set
+backend = serve_models(backend)
 logger.info("Initialized")
 
-with open('ImageNetLabels.txt', 'r') as file:
-    labels_txt = file.read()
-labels = labels_txt.split("\n")
-labels = labels[1:]
+# load labels once, postprocessing looks them up for a whole batch at once
+labels = load_labels('ImageNetLabels.txt')
+postprocessor = Postprocessor(labels)
 
-def classify_image(img_path):
+preprocessor = Preprocessor(IMG_SIZE, backend.layout, allocate=backend.allocate_batch)
+
+def prepare_image(data):
     """
-        Returns a classification label for a given image. img_path must be a local file path.
+        Returns the decoded and resized image for given raw image bytes.
     """
-    # download and prepare image for inference as required by MobileNetV3 pretrained model
-    image = Image.open(img_path).resize((IMG_SIZE, IMG_SIZE))
-    # normalize pixel values
-    image = np.array(image)/255.0
-    # convert between HWC and CWH
-    image = np.moveaxis(image, 2, 0)
-    # add dimension to conform to model input
-    image = image[np.newaxis, ...]
-    # request inference
-    output_data = model.run(image)
-    predicted_class = np.argmax(output_data[0], axis=-1)
-    return labels[predicted_class[0]]
+    with metrics.timer("decode"):
+        image = preprocessor.decode(data)
+    with metrics.timer("preprocess"):
+        return preprocessor.resize(image)
 
 
-def lambda_handler(event, context):
-    logger.info("Received request %s", event)
+def run_model(model, model_preprocessor, images, stage):
+    """
+        Returns the classification result with the top-k labels of model for each prepared image.
+        The inference time is recorded as stage.
+    """
+    results = []
+    # models with a fixed batch dimension run the batch in chunks of that size
+    step = model.batch_size or len(images)
+    for start in range(0, len(images), step):
+        chunk = images[start:start + step]
+        with metrics.timer(stage):
+            # request inference, the last chunk is padded up to the fixed batch size
+            output_data = model.run(model_preprocessor.to_batch(chunk, model.batch_size))
+        # read right after the run, the model can be swapped between two chunks
+        version, model_labels = model.version, model.labels
+        logger.debug("Output data shape: %s", output_data.shape)
+        chunk_results = postprocessor(output_data[:len(chunk)], model_labels)
+        if version:
+            for result in chunk_results:
+                result["model_version"] = version
+        results.extend(chunk_results)
+    return results
 
-    if not "image" in event:
-        iot_client.publish(topic=DEFAULT_TOPIC_RESPONSE,
-                           payload='{"Error": "No image URL/location in payload"}')
-        return
-    image = event["image"]
-    if not image.startswith("http"):
-        iot_client.publish(topic=DEFAULT_TOPIC_RESPONSE,
-                           payload='{"Error": "Image parameter is not a URL. Please specify a valid image URL."}')
+
+def classify_batch(images, escalate_all=False):
+    """
+        Returns the classification result with the top-k labels for each prepared image.
+        With a cascade, only uncertain images (or all with escalate_all) run through the full model.
+    """
+    if cascade:
+        return cascade(images, escalate_all)
+    return run_model(backend, preprocessor, images, "inference")
+
+
+def classify_image(data):
+    """
+        Returns the classification result for a given image. data must be the raw bytes of the image.
+    """
+    return classify_batch([prepare_image(data)])[0]
+
+
+def fetch_image(url, etag=None, last_modified=None):
+    """
+        Downloads an image and records the download time.
+    """
+    with metrics.timer("download"):
+        return downloader.fetch(url, etag, last_modified)
+
+
+def load_image(source):
+    """
+        Downloads and prepares an image unless its result is cached. source is a URL or the raw bytes
+        of an inline image. Runs on the download threads.
+    """
+    if isinstance(source, bytes):
+        return load_data(source, cache, prepare_image)
+    return load_cached(source, fetch_image, cache, prepare_image)
+
+
+metrics = Metrics()
+# a cheap model in front of the full one if CASCADE_BACKEND is set, see cascade.py
+cascade = create_cascade(run_model, backend, preprocessor, MODEL_DIR)
+batcher = MicroBatcher(classify_batch)
+downloader = Downloader()
+cache = ResultCache()
+prefetcher = Prefetcher(load_image)
+metrics.gauge("queue", lambda: {"download": prefetcher.pending(), "inference": batcher.qsize()})
+metrics.gauge("dropped", lambda: {"download": prefetcher.dropped(), "inference": batcher.dropped()})
+metrics.gauge("cache", cache.stats)
+if cascade:
+    metrics.gauge("cascade", cascade.stats)
+
+
+def send(topic, payload):
+    iot_client.publish(topic=topic, payload=payload)
+
+
+# keeps results which could not be published if SPOOL_DIR is set, see spool.py
+spool = create_spool()
+if spool:
+    spool.start(send)
+    metrics.gauge("spool", spool.stats)
+
+
+def publish(topic, payload):
+    """
+        Publishes payload to topic and records the publish time. If publishing fails,
+        payload is spooled to disk and published later.
+    """
+    with metrics.timer("publish"):
+        if spool:
+            # while publishing fails, messages are spooled without waiting for the publish timeout
+            spool.publish(send, topic, payload)
+        else:
+            send(topic, payload)
+
+
+start_reporter(metrics, publish, fields={"function": os.getenv('MY_FUNCTION_ARN')})
+# publishes several responses in one message if OUTPUT_MODE is coalesced, see coalescing.py
+coalescer = create_coalescer(publish, {"function": os.getenv('MY_FUNCTION_ARN')})
+if coalescer:
+    metrics.gauge("output", coalescer.stats)
+
+# batches above BATCH_MAX_SIZE: all images of a request run in one batch, and the model server
+# runs the images of several functions together
+LARGER_BATCH_SIZES = (MAX_IMAGES_PER_REQUEST, backend.max_batch_size)
+
+# run the whole inference path at every batch size before the function accepts requests,
+# through both models of a cascade
+warm_up(profiler, lambda images: classify_batch(images, escalate_all=True), IMG_SIZE,
+        warmup_batch_sizes(fixed_batch_size=backend.batch_size, larger_batch_sizes=LARGER_BATCH_SIZES))
+# the warm-up inferences are not part of the first metrics summary
+metrics.summary()
+report_startup(profiler, publish, fields={"function": os.getenv('MY_FUNCTION_ARN')})
+
+
+def validate_model(model):
+    """
+        Runs a new model through the whole inference path at every batch size before it is swapped in.
+    """
+    # the batch buffer of the shared preprocessor may hold a batch the micro-batcher is running
+    model_preprocessor = Preprocessor(IMG_SIZE, model.layout, allocate=model.allocate_batch)
+    warm_up(StartupProfiler(), lambda images: run_model(model, model_preprocessor, images, "reload"), IMG_SIZE,
+            warmup_batch_sizes(fixed_batch_size=model.batch_size, larger_batch_sizes=LARGER_BATCH_SIZES))
+
+
+# cached results of the old model are not reused once a new model is swapped in
+reloader.start(validate_model, on_swap=cache.clear)
+metrics.gauge("model", reloader.stats)
+# installs new models into MODEL_DIR from MODEL_UPDATE_URL for the reloader, see model_update.py
+updater = create_updater(MODEL_DIR)
+if updater:
+    updater.start()
+    metrics.gauge("update", updater.stats)
+
+
+def describe_error(error, action):
+    """
+        Returns the error message for a failed action. Dropped requests are reported as "expired" or "overloaded".
+    """
+    if isinstance(error, RequestDropped):
+        return str(error)
+    return "{}: {}".format(action, error)
+
+
+def respond(topic, payload):
+    """
+        Publishes a response to topic, coalesced with other responses if OUTPUT_MODE is coalesced.
+    """
+    if coalescer:
+        coalescer.add(topic, payload)
         return
+    payload = json.dumps(payload)
+    logger.debug('Publishing to %s , \n payload: %s', topic, payload)
+    publish(topic, payload)
+
+
+def publish_error(request, message):
+    """
+        Publishes an error message for a request to its response topic.
+    """
+    payload = {"image": request["image"], "Error": message}
+    if request["trace_id"]:
+        payload["trace_id"] = request["trace_id"]
+    respond(request["topic"], payload)
 
-    urllib.request.urlretrieve(image, IMAGE_FILE)
-    result = classify_image(IMAGE_FILE)
 
-    # send response
-    payload = json.dumps(
-        {
-            "image": event["image"],
-            "function" : os.getenv('MY_FUNCTION_ARN'),
-            "result": result
+def publish_result(request, key=None):
+    """
+        Returns a batcher callback which publishes the result for a request to its response topic.
+        The result is cached under key if given.
+    """
+    def callback(result):
+        if isinstance(result, Exception):
+            publish_error(request, describe_error(result, "Inference failed"))
+            return
+        if key:
+            cache.put(key, result)
+        # send response
+        payload = {
+            "image": request["image"],
+            "function": os.getenv('MY_FUNCTION_ARN'),
         }
-    )
-    logger.debug(
-        'Publishing to %s , \n payload: %s', DEFAULT_TOPIC_RESPONSE, payload)
-    iot_client.publish(topic=DEFAULT_TOPIC_RESPONSE, payload=payload)
-    return
\ No newline at end of file
+        payload.update(result)
+        if request["trace_id"]:
+            payload["trace_id"] = request["trace_id"]
+        respond(request["topic"], payload)
+        elapsed = time.perf_counter() - request["received"]
+        metrics.record("total", elapsed)
+        profiler.request_completed(elapsed)
+    return callback
+
+
+def submit_inference(request):
+    """
+        Returns a prefetcher callback which queues the prepared image for inference.
+    """
+    def callback(loaded):
+        if isinstance(loaded, Exception):
+            publish_error(request, describe_error(loaded, "Could not load image"))
+            return
+        key, result, prepared = loaded
+        if result is not None:
+            logger.debug("Cache hit for %s", request["image"])
+            publish_result(request)(result)
+            return
+        # the result is published by the batcher once the batch containing this image ran
+        batcher.submit(prepared, publish_result(request, key), request["priority"], request["deadline"])
+    return callback
+
+
+def publish_results(request, images, results):
+    """
+        Publishes the results of all images of a request in a single response.
+    """
+    payload = {
+        "function": os.getenv('MY_FUNCTION_ARN'),
+        "results": [dict({"image": image.name}, **result) for image, result in zip(images, results)],
+    }
+    if request["trace_id"]:
+        payload["trace_id"] = request["trace_id"]
+    respond(request["topic"], payload)
+    elapsed = time.perf_counter() - request["received"]
+    metrics.record("total", elapsed)
+    profiler.request_completed(elapsed)
+
+
+def classify_loaded(request, images):
+    """
+        Returns a Gather callback which runs all loaded images of a request in one batch.
+    """
+    def on_loaded(loaded):
+        results = [None] * len(images)
+        pending = []
+        for index, entry in enumerate(loaded):
+            if isinstance(entry, Exception):
+                results[index] = {"Error": describe_error(entry, "Could not load image")}
+                continue
+            key, result, prepared = entry
+            if result is not None:
+                results[index] = result
+            else:
+                pending.append((index, key, prepared))
+        if not pending:
+            publish_results(request, images, results)
+            return
+
+        def on_inferred(inferred):
+            if isinstance(inferred, Exception):
+                inferred = [{"Error": describe_error(inferred, "Inference failed")}] * len(pending)
+            for (index, key, _), result in zip(pending, inferred):
+                if key and "Error" not in result:
+                    cache.put(key, result)
+                results[index] = result
+            publish_results(request, images, results)
+        batcher.submit_many([prepared for _, _, prepared in pending], on_inferred,
+                            request["priority"], request["deadline"])
+    return on_loaded
+
+
+def classify_frame(frame, done):
+    """
+        Queues a frame of the stream for inference. done is called once its result is published.
+    """
+    request = {
+        "image": frame.name,
+        "topic": DEFAULT_TOPIC_RESPONSE,
+        "trace_id": None,
+        "received": frame.received,
+        "priority": 0,
+        "deadline": None,
+    }
+    on_result = publish_result(request)
+
+    def callback(result):
+        try:
+            on_result(result)
+        finally:
+            done()
+    try:
+        prepared = prepare_image(frame.data)
+    except Exception as error:  # pylint: disable=broad-except
+        publish_error(request, "Could not decode frame: {}".format(error))
+        done()
+        return
+    batcher.submit(prepared, callback)
+
+
+# classify a camera stream continuously if STREAM_SOURCE is set, see stream.py
+stream = start_stream(classify_frame)
+if stream:
+    metrics.gauge("stream", stream.stats)
+
+
+def lambda_handler(event, context):
+    try:
+        images, aggregate = parse_images(event)
+        priority, deadline = parse_schedule(event)
+    except InvalidRequest as error:
+        logger.info("Rejected request: %s", error)
+        publish(DEFAULT_TOPIC_RESPONSE, json.dumps({"Error": str(error)}))
+        return
+    # inline image data is not logged
+    logger.info("Received request for %s", ", ".join(image.name for image in images))
+
+    request = {
+        "image": images[0].name,
+        "topic": DEFAULT_TOPIC_RESPONSE,
+        # echoed in the response, so a slow result can be matched with its request
+        "trace_id": event.get("trace_id") or (uuid.uuid4().hex if TRACE_REQUESTS else None),
+        "received": time.perf_counter(),
+        # urgent requests are downloaded and batched first, expired ones are dropped
+        "priority": priority,
+        "deadline": deadline,
+    }
+    # download and prepare images in the background, while the model is busy with other images
+    if not aggregate:
+        prefetcher.submit(images[0].source, submit_inference(request), priority, deadline)
+        return
+    gather = Gather(len(images), classify_loaded(request, images))
+    for index, image in enumerate(images):
+        prefetcher.submit(image.source, gather.callback(index), priority, deadline)
+    return
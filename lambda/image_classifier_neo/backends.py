@@ -0,0 +1,245 @@
+"""
+Inference backends for the image classifier functions.
+
+A backend loads a model and runs batches of preprocessed images. The
+backend is selected with the INFERENCE_BACKEND environment variable, so the inference
+engine can be switched per device in the function configuration:
+
+- keras: Keras SavedModel, called directly through its serving signature
+- dlr: model compiled by SageMaker Neo, run by the Neo deep learning runtime (DLR)
+- tflite: Tensorflow Lite model, run with the XNNPACK delegate
+- remote: model held by the model server of the core, see model_server.py
+
+Machine learning libraries are imported when a backend is loaded, so a function only
+imports the library of the backend it uses. The import is a step of its own, so the
+time it takes can be told apart from loading the model.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import logging
+import os
+from contextlib import nullcontext
+import numpy as np
+from preprocessing import LAYOUT_NCHW, LAYOUT_NHWC
+
+logger = logging.getLogger()
+
+# the backend to use, overrides the default of the function
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "")
+# the batch size the Neo model was compiled for, see notebooks/02-Compile-Neo-Model.ipynb
+MODEL_BATCH_SIZE = int(os.getenv("MODEL_BATCH_SIZE", "1"))
+# file name of the Tensorflow Lite model within the model directory
+TFLITE_MODEL_FILE = os.getenv("TFLITE_MODEL_FILE", "model.tflite")
+# number of threads used by Tensorflow Lite
+TFLITE_NUM_THREADS = int(os.getenv("TFLITE_NUM_THREADS", str(os.cpu_count() or 1)))
+# whether Tensorflow Lite runs float models with the XNNPACK delegate
+TFLITE_XNNPACK = os.getenv("TFLITE_XNNPACK", "true").lower() == "true"
+
+
+class Backend:
+    """
+        Base class of all inference backends.
+    """
+    # memory layout of the model input
+    layout = LAYOUT_NHWC
+    # the batch size the model requires, None if it accepts any batch size
+    batch_size = None
+    # largest batch the model runs for other functions as well, see model_server.py
+    max_batch_size = None
+    # name of the backend in BACKENDS, set when it is loaded
+    name = None
+    # version of the model reported in the results, see reloading.py
+    version = None
+    # labels of the classes of the model output, None for the labels of the function, see reloading.py
+    labels = None
+
+    def __init__(self, model_dir):
+        self.model_dir = model_dir
+
+    def import_library(self):
+        """
+            Imports and returns the machine learning library used to run the model.
+        """
+        raise NotImplementedError
+
+    def load(self):
+        """
+            Loads the model.
+        """
+        raise NotImplementedError
+
+    def run(self, batch):
+        """
+            Returns the model output with one row of class scores per image in batch.
+        """
+        raise NotImplementedError
+
+    def allocate_batch(self, shape):
+        """
+            Returns a float32 array of the given shape the preprocessor writes batches to.
+        """
+        return np.zeros(shape, dtype=np.float32)
+
+
+class KerasBackend(Backend):
+    """
+        Runs a Keras SavedModel through its serving signature, which avoids the per call
+        overhead of Model.predict.
+    """
+
+    def import_library(self):
+        import tensorflow as tf  # pylint: disable=import-outside-toplevel
+        return tf
+
+    def load(self):
+        tf = self._tf = self.import_library()
+        self._model = tf.saved_model.load(os.path.join(self.model_dir, "saved_model"))
+        self._signature = self._model.signatures["serving_default"]
+        self._input_name = next(iter(self._signature.structured_input_signature[1]))
+        self._output_name = next(iter(self._signature.structured_outputs))
+
+    def run(self, batch):
+        outputs = self._signature(**{self._input_name: self._tf.constant(batch)})
+        return outputs[self._output_name].numpy()
+
+
+class DLRBackend(Backend):
+    """
+        Runs a model compiled by SageMaker Neo. The model is compiled for channels first
+        input and a fixed batch size.
+    """
+    layout = LAYOUT_NCHW
+    batch_size = MODEL_BATCH_SIZE
+
+    def import_library(self):
+        from dlr import DLRModel  # pylint: disable=import-outside-toplevel
+        return DLRModel
+
+    def load(self):
+        DLRModel = self.import_library()
+        self._model = DLRModel(self.model_dir, 'cpu')
+
+    def run(self, batch):
+        return self._model.run(batch)[0]
+
+
+class TFLiteBackend(Backend):
+    """
+        Runs a Tensorflow Lite model. Uses tflite_runtime if installed, the full
+        Tensorflow package otherwise.
+    """
+
+    def __init__(self, model_dir, num_threads=TFLITE_NUM_THREADS, xnnpack=TFLITE_XNNPACK):
+        super().__init__(model_dir)
+        self.num_threads = num_threads
+        self.xnnpack = xnnpack
+
+    def import_library(self):
+        """
+            Returns the Interpreter class and the OpResolverType enum of the same library.
+        """
+        try:
+            # pylint: disable=import-outside-toplevel
+            from tflite_runtime.interpreter import Interpreter, OpResolverType
+        except ImportError:
+            import tensorflow as tf  # pylint: disable=import-outside-toplevel
+            Interpreter = tf.lite.Interpreter
+            OpResolverType = tf.lite.experimental.OpResolverType
+        return Interpreter, OpResolverType
+
+    def load(self):
+        Interpreter, OpResolverType = self.import_library()
+        options = {"num_threads": self.num_threads}
+        if not self.xnnpack:
+            # XNNPACK is applied as default delegate, it can only be turned off
+            options["experimental_op_resolver_type"] = OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+        self._interpreter = Interpreter(
+            model_path=os.path.join(self.model_dir, TFLITE_MODEL_FILE), **options)
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self._allocated_batch_size = None
+
+    def run(self, batch):
+        if len(batch) != self._allocated_batch_size:
+            self._interpreter.resize_tensor_input(
+                self._input["index"], [len(batch)] + list(self._input["shape"][1:]))
+            self._interpreter.allocate_tensors()
+            self._allocated_batch_size = len(batch)
+        self._interpreter.set_tensor(self._input["index"], self._quantize(batch))
+        self._interpreter.invoke()
+        return self._dequantize(self._interpreter.get_tensor(self._output["index"]))
+
+    def _quantize(self, batch):
+        scale, zero_point = self._input["quantization"]
+        if not scale:
+            return batch
+        return np.round(batch / scale + zero_point).astype(self._input["dtype"])
+
+    def _dequantize(self, output):
+        scale, zero_point = self._output["quantization"]
+        if not scale:
+            return output
+        return (output.astype(np.float32) - zero_point) * scale
+
+
+class RemoteBackend(Backend):
+    """
+        Runs the model in the model server of the core, which holds each model once for all
+        functions. Batches are written by the preprocessor straight into memory shared with
+        the server, so only their position is sent over the socket.
+    """
+
+    def import_library(self):
+        from model_server import ModelServerClient  # pylint: disable=import-outside-toplevel
+        return ModelServerClient
+
+    def load(self):
+        ModelServerClient = self.import_library()
+        self._client = ModelServerClient()
+        # the server pads batches for models with a fixed batch size itself
+        self.layout = self._client.describe()["layout"]
+
+    def run(self, batch):
+        return self._client.run(batch)
+
+    @property
+    def version(self):
+        # the version of the model which ran the last batch, as reported by the server
+        return self._client.version
+
+    def allocate_batch(self, shape):
+        return self._client.allocate(shape)
+
+
+BACKENDS = {
+    "keras": KerasBackend,
+    "dlr": DLRBackend,
+    "tflite": TFLiteBackend,
+    "remote": RemoteBackend,
+}
+
+
+def create_backend(model_dir, default, profiler=None):
+    """
+        Returns the loaded backend selected by INFERENCE_BACKEND, or the default backend of the function.
+        The library import and the model load are recorded as steps of profiler if given.
+    """
+    return load_backend(INFERENCE_BACKEND or default, model_dir, profiler)
+
+
+def load_backend(name, model_dir, profiler=None):
+    """
+        Returns the loaded backend with the given name.
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown inference backend: {}, choose one of {}".format(
+            name, ", ".join(sorted(BACKENDS))))
+    backend = BACKENDS[name](model_dir)
+    backend.name = name
+    with profiler.step("library_import") if profiler else nullcontext():
+        backend.import_library()
+    with profiler.step("model_load") if profiler else nullcontext():
+        backend.load()
+    logger.info("Loaded %s inference backend", name)
+    return backend
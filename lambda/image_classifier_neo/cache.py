@@ -0,0 +1,233 @@
+"""
+Content-addressed cache of inference results.
+
+Results are stored under the SHA-256 hash of the raw image bytes, so a byte-identical
+frame skips decoding and inference even when it comes from a different URL. For URLs
+whose server sent an ETag or Last-Modified header, the cache also remembers which
+content the URL pointed to. The next download of that URL is a conditional request,
+and if the server answers "304 Not Modified" the image is not downloaded at all.
+
+The cache is an LRU with a time to live per entry, bounded by number of entries and by
+the approximate size of the cached results. It can optionally be persisted to disk, so
+cached results survive a restart of the function.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# maximum number of cached results, 0 disables the cache
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+# maximum approximate size in bytes of all cached results
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(1024 * 1024)))
+# seconds a cached result stays valid
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+# file the cache is persisted to, empty keeps the cache in memory only
+CACHE_PATH = os.getenv("CACHE_PATH", "")
+# minimum seconds between two writes of the cache file
+CACHE_SAVE_INTERVAL = float(os.getenv("CACHE_SAVE_INTERVAL", "60"))
+
+
+def content_key(data):
+    """
+        Returns the cache key for raw image bytes.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResultCache:
+    """
+        LRU cache of inference results with time to live and optional persistence.
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 ttl=CACHE_TTL, path=CACHE_PATH):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (expires at, size, result)
+        self._results = OrderedDict()
+        # url -> (key, etag, last modified)
+        self._urls = OrderedDict()
+        self._bytes = 0
+        self._last_save = time.monotonic()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        """
+            Returns the cached result for key, or None.
+        """
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is not None and entry[0] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, result):
+        """
+            Caches result for key, evicting the least recently used results if needed.
+        """
+        if not self.enabled:
+            return
+        size = len(key) + len(json.dumps(result))
+        with self._lock:
+            if key in self._results:
+                self._remove(key)
+            self._results[key] = (time.time() + self.ttl, size, result)
+            self._bytes += size
+            while self._results and (len(self._results) > self.max_entries or
+                                     self._bytes > self.max_bytes):
+                self._remove(next(iter(self._results)))
+                self.evictions += 1
+            save = self.path and time.monotonic() - self._last_save > CACHE_SAVE_INTERVAL
+        if save:
+            self.save()
+
+    def validators(self, url):
+        """
+            Returns the key, ETag and Last-Modified value last seen for url, if its result is still cached.
+        """
+        with self._lock:
+            known = self._urls.get(url)
+            if known is None:
+                return None
+            entry = self._results.get(known[0])
+            if entry is None or entry[0] < time.time():
+                del self._urls[url]
+                return None
+            self._urls.move_to_end(url)
+            return known
+
+    def remember_url(self, url, key, etag, last_modified):
+        """
+            Remembers which content url pointed to, if the server sent validators for it.
+        """
+        if not self.enabled or not (etag or last_modified):
+            return
+        with self._lock:
+            self._urls[url] = (key, etag, last_modified)
+            self._urls.move_to_end(url)
+            while len(self._urls) > self.max_entries:
+                self._urls.popitem(last=False)
+
+    def clear(self):
+        """
+            Removes all cached results, e.g. after the model changed.
+        """
+        with self._lock:
+            self._results.clear()
+            self._urls.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._results),
+                "bytes": self._bytes,
+            }
+
+    def save(self):
+        """
+            Writes the cache to its file. The file is replaced atomically.
+        """
+        with self._lock:
+            content = {
+                "results": [[key, entry[0], entry[2]] for key, entry in self._results.items()],
+                "urls": [[url] + list(known) for url, known in self._urls.items()],
+            }
+            self._last_save = time.monotonic()
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as file:
+                json.dump(content, file)
+            os.replace(temp_path, self.path)
+        except OSError as error:
+            logger.warning("Could not save result cache to %s: %s", self.path, error)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                content = json.load(file)
+        except (OSError, ValueError) as error:
+            logger.warning("Could not load result cache from %s: %s", self.path, error)
+            return
+        now = time.time()
+        for key, expires, result in content.get("results", []):
+            if expires > now:
+                size = len(key) + len(json.dumps(result))
+                self._results[key] = (expires, size, result)
+                self._bytes += size
+        for url, key, etag, last_modified in content.get("urls", []):
+            self._urls[url] = (key, etag, last_modified)
+        logger.info("Loaded %d cached results from %s", len(self._results), self.path)
+
+    def _remove(self, key):
+        self._bytes -= self._results.pop(key)[1]
+
+
+def load_cached(url, fetch, cache, prepare):
+    """
+        Downloads and prepares the image at url unless its result is cached.
+        fetch is Downloader.fetch or a function with the same signature.
+
+        Returns the cache key of the image, the cached result and the prepared image.
+        Only one of cached result and prepared image is set.
+    """
+    known = cache.validators(url) if cache.enabled else None
+    if known:
+        download = fetch(url, etag=known[1], last_modified=known[2])
+        if download.data is None:
+            # not modified since the last download
+            result = cache.get(known[0])
+            if result is not None:
+                return known[0], result, None
+            # the cached result expired in the meantime, download the full image again
+            download = fetch(url)
+    else:
+        download = fetch(url)
+    if not cache.enabled:
+        return None, None, prepare(download.data)
+    key = content_key(download.data)
+    cache.remember_url(url, key, download.etag, download.last_modified)
+    return load_data(download.data, cache, prepare, key)
+
+
+def load_data(data, cache, prepare, key=None):
+    """
+        Prepares raw image bytes unless their result is cached, e.g. for images sent inline.
+        Returns the same as load_cached.
+    """
+    if not cache.enabled:
+        return None, None, prepare(data)
+    key = key or content_key(data)
+    result = cache.get(key)
+    if result is not None:
+        return key, result, None
+    return key, None, prepare(data)
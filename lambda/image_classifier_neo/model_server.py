@@ -0,0 +1,455 @@
+"""
+Model server shared by the image classifier functions of a core.
+
+Without it, every function loads its own copy of the machine learning library and the
+model. With MODEL_SERVER_MODELS set, one function (usually the one running without
+container) holds the models once and serves them to the other functions over a Unix
+domain socket (MODEL_SERVER_SOCKET). The other functions use INFERENCE_BACKEND=remote.
+
+Batches are not sent through the socket. A client creates a file in shared memory
+(MODEL_SERVER_SHM_DIR), maps it and passes its file descriptor to the server once.
+The preprocessor writes batches straight into that mapping, so a request only carries
+the offset and shape of the batch. The server runs the model on the mapped batch in
+place and sends the class scores back over the socket.
+
+The server runs the requests of all functions through a micro-batcher per model, so
+images of different functions share a model call. Only such a shared batch is copied
+into one array.
+
+Only functions running as the user of the server, or in its group or a group of
+MODEL_SERVER_ALLOWED_GIDS, may connect. The socket directory is created readable by
+the group only.
+
+Messages are a length prefix with the size of a JSON header and of a binary payload,
+followed by header and payload.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import array
+import json
+import logging
+import mmap
+import os
+import socket
+import stat
+import struct
+import tempfile
+import threading
+import time
+import numpy as np
+from backends import Backend, load_backend
+from batching import BATCH_MAX_WAIT_MS, MicroBatcher
+
+logger = logging.getLogger()
+
+# path of the Unix domain socket, it must be accessible to all functions using the server
+MODEL_SERVER_SOCKET = os.getenv("MODEL_SERVER_SOCKET", "/tmp/gg_ml_sample/model_server.sock")
+# models served by this function: comma separated list of name=backend:model_dir,
+# a name alone serves the model of the function itself, empty does not start a server
+MODEL_SERVER_MODELS = os.getenv("MODEL_SERVER_MODELS", "")
+# model a client uses
+MODEL_SERVER_MODEL = os.getenv("MODEL_SERVER_MODEL", "image_classifier")
+# maximum number of images of all clients the server runs in a single model call
+MODEL_SERVER_BATCH_SIZE = int(os.getenv("MODEL_SERVER_BATCH_SIZE", "16"))
+# seconds a client waits for the server when the function starts
+MODEL_SERVER_CONNECT_TIMEOUT = float(os.getenv("MODEL_SERVER_CONNECT_TIMEOUT", "120"))
+# tmpfs directory the shared memory files of a client are created in
+MODEL_SERVER_SHM_DIR = os.getenv("MODEL_SERVER_SHM_DIR", "/dev/shm")
+# comma separated ids of further groups whose functions may use the server, besides its own group
+MODEL_SERVER_ALLOWED_GIDS = os.getenv("MODEL_SERVER_ALLOWED_GIDS", "")
+
+PREFIX = struct.Struct("!II")
+PEER_CREDENTIALS = struct.Struct("3i")
+DTYPE = np.float32
+FD_SIZE = array.array("i").itemsize
+
+
+class ModelServerError(Exception):
+    """
+        Raised when the model server rejected or failed a request.
+    """
+
+
+def send_message(connection, header, payload=b"", fds=None):
+    """
+        Sends a message, optionally passing file descriptors along with it.
+    """
+    data = json.dumps(header).encode()
+    prefix = PREFIX.pack(len(data), len(payload))
+    if fds:
+        connection.sendmsg([prefix], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        connection.sendall(data)
+    else:
+        connection.sendall(prefix + data)
+    if len(payload):
+        connection.sendall(payload)
+
+
+def receive_exactly(connection, size):
+    buffer = bytearray(size)
+    with memoryview(buffer) as view:
+        received = 0
+        while received < size:
+            count = connection.recv_into(view[received:])
+            if not count:
+                raise ConnectionError("Model server connection closed")
+            received += count
+    return buffer
+
+
+def receive_message(connection):
+    """
+        Returns header, payload and the file descriptors passed along with the next message.
+    """
+    prefix = b""
+    fds = []
+    while len(prefix) < PREFIX.size:
+        data, ancillary, _, _ = connection.recvmsg(PREFIX.size - len(prefix), socket.CMSG_SPACE(FD_SIZE))
+        if not data:
+            raise ConnectionError("Model server connection closed")
+        prefix += data
+        for level, kind, value in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.extend(array.array("i", value[:len(value) - len(value) % FD_SIZE]))
+    header_size, payload_size = PREFIX.unpack(prefix)
+    header = json.loads(receive_exactly(connection, header_size).decode())
+    return header, receive_exactly(connection, payload_size), fds
+
+
+def join_rows(rows):
+    """
+        Returns a list of single images as one batch. Consecutive rows of the same array, like
+        the batch of a single client in shared memory, are viewed in place instead of copied.
+    """
+    first = rows[0]
+    address = first.__array_interface__["data"][0]
+    if first.base is not None and all(
+            row.base is first.base and row.dtype == first.dtype and row.shape == first.shape
+            and row.flags.c_contiguous and row.__array_interface__["data"][0] == address + index * first.nbytes
+            for index, row in enumerate(rows)):
+        return np.lib.stride_tricks.as_strided(first, (len(rows),) + first.shape, (first.nbytes,) + first.strides)
+    return np.stack(rows)
+
+
+def run_rows(backend, rows):
+    """
+        Runs a list of single images through backend, returns the class scores with one row per image.
+    """
+    batch = join_rows(rows)
+    if not backend.batch_size or len(batch) == backend.batch_size:
+        return np.asarray(backend.run(batch))
+    # the model was compiled for a fixed batch size, pad the last chunk with blank images
+    outputs = []
+    for start in range(0, len(batch), backend.batch_size):
+        chunk = batch[start:start + backend.batch_size]
+        if len(chunk) < backend.batch_size:
+            padded = np.zeros((backend.batch_size,) + chunk.shape[1:], dtype=DTYPE)
+            padded[:len(chunk)] = chunk
+            chunk = padded
+        outputs.append(backend.run(chunk)[:len(batch) - start])
+    return np.concatenate(outputs)
+
+
+def peer_groups(connection):
+    """
+        Returns the user id and the set of group ids of the process at the other end of connection.
+    """
+    pid, uid, gid = PEER_CREDENTIALS.unpack(
+        connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEER_CREDENTIALS.size))
+    groups = {gid}
+    # supplementary groups, e.g. the group owner of a local volume resource added by Greengrass
+    try:
+        with open("/proc/{}/status".format(pid)) as file:
+            for line in file:
+                if line.startswith("Groups:"):
+                    groups.update(int(group) for group in line.split()[1:])
+    except (OSError, ValueError):
+        pass
+    return uid, groups
+
+
+class ModelServer:
+    """
+        Serves backends by name over a Unix domain socket.
+    """
+
+    def __init__(self, backends, path=MODEL_SERVER_SOCKET, max_batch_size=MODEL_SERVER_BATCH_SIZE,
+                 max_wait_ms=BATCH_MAX_WAIT_MS, allowed_gids=MODEL_SERVER_ALLOWED_GIDS):
+        self.path = path
+        self.backends = backends
+        self.allowed_gids = {os.getgid()} | {int(gid) for gid in allowed_gids.split(",") if gid.strip()}
+        self.rejected = 0
+        # clients bound their own queues, the server does not drop their requests
+        self.batchers = {
+            name: MicroBatcher(lambda rows, backend=backend: run_rows(backend, rows), max_batch_size,
+                               max_wait_ms, max_pending=0)
+            for name, backend in backends.items()
+        }
+
+    def start(self):
+        directory = os.path.dirname(self.path) or "."
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            os.chmod(directory, 0o750)
+        if os.stat(directory).st_mode & stat.S_IWOTH:
+            raise ModelServerError("{} is writable by all users, they could replace the socket".format(directory))
+        if os.path.exists(self.path):
+            # left behind by a previous run of the function
+            os.unlink(self.path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        # the functions of the core run as different users, which share a group with the server
+        os.chmod(self.path, 0o660)
+        listener.listen()
+        threading.Thread(target=self._accept, args=(listener,), name="model-server", daemon=True).start()
+        logger.info("Serving models %s on %s", ", ".join(sorted(self.backends)), self.path)
+
+    def run(self, name, batch):
+        """
+            Runs batch in the next model call of the named model, together with images of other clients.
+        """
+        done = threading.Event()
+        outcome = []
+
+        def callback(results):
+            outcome.append(results)
+            done.set()
+        # the rows are views of batch, they are joined into a batch again without copying
+        self.batchers[name].submit_many(list(batch), callback)
+        done.wait()
+        if isinstance(outcome[0], Exception):
+            raise outcome[0]
+        # the rows of this batch within the output of the model call
+        return np.ascontiguousarray(outcome[0], dtype=DTYPE)
+
+    def allowed(self, connection):
+        """
+            Returns whether the process at the other end of connection may use the server.
+        """
+        uid, groups = peer_groups(connection)
+        return uid in (0, os.getuid()) or bool(groups & self.allowed_gids)
+
+    def _accept(self, listener):
+        while True:
+            connection, _ = listener.accept()
+            if not self.allowed(connection):
+                self.rejected += 1
+                logger.warning("Rejected model server connection of user %d", peer_groups(connection)[0])
+                connection.close()
+                continue
+            threading.Thread(target=self._serve, args=(connection,), name="model-server-client",
+                             daemon=True).start()
+
+    def _serve(self, connection):
+        shared = None
+        try:
+            while True:
+                header, _, fds = receive_message(connection)
+                try:
+                    if header["op"] == "attach":
+                        if not fds:
+                            raise ModelServerError("attach without file descriptor")
+                        shared = mmap.mmap(fds[0], header["size"])
+                        send_message(connection, {"ok": True})
+                    elif header["op"] == "describe":
+                        backend = self._backend(header["model"])
+                        send_message(connection, {"layout": backend.layout, "batch_size": backend.batch_size})
+                    elif header["op"] == "run":
+                        backend = self._backend(header["model"])
+                        if shared is None:
+                            raise ModelServerError("no shared memory attached")
+                        batch = np.ndarray(header["shape"], dtype=DTYPE, buffer=shared, offset=header["offset"])
+                        output = self.run(header["model"], batch)
+                        send_message(connection, {"shape": output.shape, "version": backend.version},
+                                     memoryview(output).cast("B"))
+                    else:
+                        raise ModelServerError("unknown operation {}".format(header["op"]))
+                except (ModelServerError, KeyError, TypeError, ValueError) as error:
+                    send_message(connection, {"error": str(error)})
+                except Exception as error:  # pylint: disable=broad-except
+                    logger.exception("Model server request failed")
+                    send_message(connection, {"error": "Inference failed: {}".format(error)})
+                finally:
+                    for fd in fds:
+                        os.close(fd)
+        except OSError:
+            # the client disconnected
+            pass
+        finally:
+            connection.close()
+
+    def _backend(self, name):
+        if name not in self.backends:
+            raise ModelServerError("unknown model {}".format(name))
+        return self.backends[name]
+
+
+class ServedBackend(Backend):
+    """
+        Backend of the function hosting the server. Its requests run in the batches of the server
+        like the requests of all other functions.
+    """
+
+    def __init__(self, server, name):
+        super().__init__(server.backends[name].model_dir)
+        self.server = server
+        self.name = name
+        self.layout = server.backends[name].layout
+
+    def import_library(self):
+        return None
+
+    def load(self):
+        pass
+
+    def run(self, batch):
+        return self.server.run(self.name, batch)
+
+    @property
+    def max_batch_size(self):
+        return self.server.batchers[self.name].max_batch_size
+
+    @property
+    def version(self):
+        return self.server.backends[self.name].version
+
+    @property
+    def labels(self):
+        return self.server.backends[self.name].labels
+
+
+def serve_models(backend, models=MODEL_SERVER_MODELS, path=MODEL_SERVER_SOCKET):
+    """
+        Starts the model server if models are configured. Returns the backend the function uses
+        for its own model, which is the given backend unless the server serves it as well.
+    """
+    if not models:
+        return backend
+    served = {}
+    own = None
+    for entry in models.split(","):
+        name, _, spec = entry.strip().partition("=")
+        if not spec:
+            served[name] = backend
+            own = name
+            continue
+        backend_name, _, model_dir = spec.partition(":")
+        served[name] = load_backend(backend_name, model_dir)
+    server = ModelServer(served, path)
+    server.start()
+    return ServedBackend(server, own) if own else backend
+
+
+class ModelServerClient:
+    """
+        Connection of a function to the model server. Thread-safe, the requests of all threads
+        share the connection one at a time.
+    """
+
+    def __init__(self, path=MODEL_SERVER_SOCKET, model=MODEL_SERVER_MODEL,
+                 connect_timeout=MODEL_SERVER_CONNECT_TIMEOUT, shm_dir=MODEL_SERVER_SHM_DIR):
+        self.path = path
+        self.model = model
+        self.connect_timeout = connect_timeout
+        self.shm_dir = shm_dir if os.path.isdir(shm_dir) else tempfile.gettempdir()
+        self._connection = None
+        self._file = None
+        self._shared = None
+        self._buffer = None
+        # held for a whole request, a batch copied into the shared memory must not be overwritten before it ran
+        self._lock = threading.RLock()
+        # version of the model which ran the last batch
+        self.version = None
+
+    def describe(self):
+        with self._lock:
+            return self._request({"op": "describe", "model": self.model})[0]
+
+    def allocate(self, shape):
+        """
+            Returns a float32 array of the given shape in memory shared with the server.
+        """
+        size = int(np.prod(shape)) * np.dtype(DTYPE).itemsize
+        with self._lock:
+            # the file is deleted right away, it lives as long as the client and the server map it
+            self._file = tempfile.TemporaryFile(dir=self.shm_dir)
+            self._file.truncate(size)
+            self._shared = mmap.mmap(self._file.fileno(), size)
+            self._buffer = np.ndarray(shape, dtype=DTYPE, buffer=self._shared)
+            if self._connection:
+                self._attach()
+            return self._buffer
+
+    def run(self, batch):
+        """
+            Returns the model output for batch. Batches in the shared memory are not copied.
+        """
+        with self._lock:
+            offset = self._offset(batch)
+            if offset is None:
+                if self._buffer is None or self._buffer.nbytes < batch.nbytes:
+                    self.allocate(batch.shape)
+                shared = self._buffer.reshape(-1)[:batch.size].reshape(batch.shape)
+                shared[...] = batch
+                offset = 0
+            header, payload = self._request(
+                {"op": "run", "model": self.model, "offset": offset, "shape": list(batch.shape)})
+            self.version = header.get("version")
+        return np.frombuffer(payload, dtype=DTYPE).reshape(header["shape"])
+
+    def _offset(self, batch):
+        """
+            Returns the offset of batch within the shared memory, None if it is not located there.
+        """
+        if self._buffer is None or not batch.flags.c_contiguous or batch.dtype != DTYPE:
+            return None
+        offset = batch.__array_interface__["data"][0] - self._buffer.__array_interface__["data"][0]
+        if offset < 0 or offset + batch.nbytes > self._buffer.nbytes:
+            return None
+        return offset
+
+    def _request(self, header):
+        for attempt in range(2):
+            try:
+                if self._connection is None:
+                    self._connect()
+                send_message(self._connection, header)
+                response, payload, _ = receive_message(self._connection)
+                break
+            except (ConnectionError, OSError):
+                self._close()
+                if attempt:
+                    raise
+                logger.warning("Lost connection to model server, reconnecting")
+        if "error" in response:
+            raise ModelServerError(response["error"])
+        return response, payload
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                connection.connect(self.path)
+                break
+            except OSError:
+                connection.close()
+                if time.monotonic() >= deadline:
+                    raise
+                logger.info("Waiting for model server on %s", self.path)
+                time.sleep(1)
+        self._connection = connection
+        if self._shared is not None:
+            self._attach()
+
+    def _attach(self):
+        send_message(self._connection, {"op": "attach", "size": len(self._shared)}, fds=[self._file.fileno()])
+        response, _, _ = receive_message(self._connection)
+        if "error" in response:
+            raise ModelServerError(response["error"])
+
+    def _close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
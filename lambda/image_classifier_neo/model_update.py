@@ -0,0 +1,400 @@
+"""
+Delta updates of the model directory from a content-addressed chunk store.
+
+scripts/model_package.py splits a model package into chunks of up to chunk_size bytes
+per file, each stored compressed under the SHA-256 of its content, and a manifest which
+lists the chunks of every file:
+
+    <store>/latest.json              manifest of the latest version
+    <store>/manifests/<version>.json
+    <store>/chunks/<sha256>          zlib compressed chunk
+
+Every MODEL_UPDATE_INTERVAL seconds, ModelUpdater reads latest.json from the store at
+MODEL_UPDATE_URL (http(s)://, s3:// or a local directory). If it lists a new version,
+the files of the new version are assembled in a directory next to MODEL_DIR. Chunks
+which the installed model or a kept version already has are copied from their files,
+only the missing ones are fetched. Every chunk is verified against its hash before it is written. Once the
+new version is complete, the symlink MODEL_DIR is switched to it in one rename, so the
+model directory never holds a partial model. A plain MODEL_DIR directory is moved next
+to it at the first update. The previous MODEL_KEEP_VERSIONS versions are kept.
+
+MODEL_DIR and its parent directory must be writable, e.g. a local volume resource. The
+updated model gets the version of the manifest in its VERSION file, so the
+ReloadingBackend of each function (see reloading.py) swaps it in. Functions of the same
+core can share the directory, only one of them updates it at a time.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from download import Downloader
+
+logger = logging.getLogger()
+
+# store with the chunked model packages, empty disables updates
+MODEL_UPDATE_URL = os.getenv("MODEL_UPDATE_URL", "")
+# seconds between two checks of the store for a new version
+MODEL_UPDATE_INTERVAL = float(os.getenv("MODEL_UPDATE_INTERVAL", "300"))
+# number of chunks fetched in parallel
+MODEL_UPDATE_WORKERS = int(os.getenv("MODEL_UPDATE_WORKERS", "4"))
+# number of versions kept next to the installed one, to roll back to
+MODEL_KEEP_VERSIONS = int(os.getenv("MODEL_KEEP_VERSIONS", "1"))
+# maximum size in bytes of a manifest or a chunk read from the store
+MAX_OBJECT_BYTES = 64 * 1024 * 1024
+
+# file within an updated model directory with the manifest of the installed version
+MANIFEST_FILE = ".manifest.json"
+# version of the manifest format
+MANIFEST_FORMAT = 1
+# suffix of the directory next to MODEL_DIR which holds the versions
+VERSIONS_SUFFIX = ".versions"
+
+
+class UpdateError(Exception):
+    """
+        Raised when a model version could not be fetched or assembled.
+    """
+
+
+def chunk_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_chunks(path, chunk_size):
+    """
+        Yields the consecutive chunks of chunk_size bytes of the file at path.
+    """
+    with open(path, "rb") as file:
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                return
+            yield data
+
+
+def is_within(root, path):
+    """
+        Returns whether path is root or within it once the symlinks of both are resolved.
+    """
+    real_root = os.path.realpath(root)
+    return os.path.commonpath([os.path.realpath(path), real_root]) == real_root
+
+
+def checked_path(root, relative):
+    """
+        Returns relative joined to root. Raises UpdateError if it points outside of root,
+        also through a symlink, so it is checked again right before every write.
+    """
+    path = os.path.normpath(os.path.join(root, relative))
+    if (os.path.isabs(relative) or os.path.commonpath([path, root]) != root or path == root
+            or not is_within(root, path)):
+        raise UpdateError("Invalid path {} in manifest".format(relative))
+    return path
+
+
+def checked_link(root, path, target):
+    """
+        Returns target of the symlink at path. Raises UpdateError if it is absolute or resolves outside of root.
+    """
+    if os.path.isabs(target) or not is_within(root, os.path.join(os.path.dirname(path), target)):
+        raise UpdateError("Invalid link {} -> {} in manifest".format(os.path.relpath(path, root), target))
+    return target
+
+
+class ChunkStore:
+    """
+        Reads the objects of a chunk store at an http(s)://, s3:// or file:// URL or a local path.
+    """
+
+    def __init__(self, url, downloader=None):
+        self.url = url.rstrip("/")
+        self.scheme = urllib.parse.urlsplit(self.url).scheme
+        self.fetched_bytes = 0
+        self._lock = threading.Lock()
+        if self.scheme in ("http", "https"):
+            self._downloader = downloader or Downloader(max_bytes=MAX_OBJECT_BYTES)
+        elif self.scheme == "s3":
+            import boto3  # pylint: disable=import-outside-toplevel
+            parts = urllib.parse.urlsplit(self.url)
+            self._s3 = boto3.client("s3")
+            self._bucket = parts.netloc
+            self._prefix = parts.path.strip("/")
+
+    def read(self, key):
+        """
+            Returns the raw bytes of the object key of the store.
+        """
+        if self.scheme in ("http", "https"):
+            data = self._downloader.fetch(self.url + "/" + key).data
+        elif self.scheme == "s3":
+            response = self._s3.get_object(Bucket=self._bucket, Key="/".join(filter(None, [self._prefix, key])))
+            data = response["Body"].read()
+        else:
+            path = urllib.parse.unquote(urllib.parse.urlsplit(self.url).path) if self.scheme == "file" else self.url
+            with open(os.path.join(path, key), "rb") as file:
+                data = file.read()
+        with self._lock:
+            self.fetched_bytes += len(data)
+        return data
+
+    def manifest(self, version=None):
+        """
+            Returns the manifest of version, of the latest version if version is None.
+        """
+        key = "manifests/{}.json".format(version) if version else "latest.json"
+        manifest = json.loads(self.read(key))
+        if manifest.get("format") != MANIFEST_FORMAT:
+            raise UpdateError("Unsupported manifest format {}".format(manifest.get("format")))
+        return manifest
+
+    def chunk(self, digest):
+        """
+            Returns the content of the chunk with the SHA-256 digest. Raises UpdateError if it does not match.
+        """
+        data = zlib.decompress(self.read("chunks/" + digest))
+        if chunk_hash(data) != digest:
+            raise UpdateError("Chunk {} does not match its hash".format(digest))
+        return data
+
+
+def local_chunks(model_dir, chunk_size):
+    """
+        Returns the location (path, offset, size) of each chunk of the files in model_dir by its hash.
+        Uses the manifest of the installed version if it has one, otherwise reads all files.
+    """
+    locations = {}
+    try:
+        with open(os.path.join(model_dir, MANIFEST_FILE), "r") as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = None
+    if manifest and manifest.get("chunk_size") == chunk_size:
+        for entry in manifest["files"]:
+            offset = 0
+            for digest, size in zip(entry.get("chunks", []), entry.get("sizes", [])):
+                locations.setdefault(digest, (os.path.join(model_dir, entry["path"]), offset, size))
+                offset += size
+        return locations
+    for root, _, files in os.walk(model_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                continue
+            offset = 0
+            try:
+                for data in read_chunks(path, chunk_size):
+                    locations.setdefault(chunk_hash(data), (path, offset, len(data)))
+                    offset += len(data)
+            except OSError:
+                continue
+    return locations
+
+
+def read_local(location, digest):
+    """
+        Returns the chunk at location, None if the file changed and the chunk no longer matches.
+    """
+    path, offset, size = location
+    try:
+        with open(path, "rb") as file:
+            file.seek(offset)
+            data = file.read(size)
+    except OSError:
+        return None
+    return data if chunk_hash(data) == digest else None
+
+
+class ModelUpdater:
+    """
+        Installs new model versions from a ChunkStore into the symlink model_dir.
+    """
+
+    def __init__(self, store, model_dir, interval=MODEL_UPDATE_INTERVAL,
+                 workers=MODEL_UPDATE_WORKERS, keep=MODEL_KEEP_VERSIONS):
+        self.store = store
+        self.model_dir = os.path.normpath(model_dir)
+        self.versions_dir = self.model_dir + VERSIONS_SUFFIX
+        self.interval = interval
+        self.workers = workers
+        self.keep = keep
+        self.updates = 0
+        self.failures = 0
+        self.last = None
+
+    def installed_version(self):
+        try:
+            with open(os.path.join(self.model_dir, MANIFEST_FILE), "r") as file:
+                return json.load(file)["version"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def update(self, version=None):
+        """
+            Installs version, or the latest version of the store. Returns a report of the update,
+            None if the version is already installed or another process is updating.
+        """
+        started = time.monotonic()
+        fetched_before = self.store.fetched_bytes
+        manifest = self.store.manifest(version)
+        if manifest["version"] == self.installed_version():
+            return None
+        os.makedirs(self.versions_dir, exist_ok=True)
+        with open(os.path.join(self.versions_dir, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.info("Another process is updating %s", self.model_dir)
+                return None
+            if manifest["version"] == self.installed_version():
+                return None
+            report = self._install(manifest)
+        report["fetched_bytes"] = self.store.fetched_bytes - fetched_before
+        report["seconds"] = round(time.monotonic() - started, 3)
+        self.updates += 1
+        self.last = report
+        logger.info("Installed model version %s: fetched %d of %d chunks, %d bytes instead of %d bytes",
+                    report["version"], report["fetched_chunks"], report["chunks"],
+                    report["fetched_bytes"], report["package_bytes"])
+        return report
+
+    def _install(self, manifest):
+        version = manifest["version"]
+        target = checked_path(self.versions_dir, version)
+        staging = os.path.join(self.versions_dir, ".staging-" + os.path.basename(target))
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        try:
+            fetched, chunks = self._assemble(manifest, staging)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(staging, target)
+        self._switch(target)
+        self._prune(target)
+        return {"version": version, "files": len(manifest["files"]), "chunks": chunks,
+                "fetched_chunks": fetched, "package_bytes": manifest.get("package_bytes", 0)}
+
+    def _local_chunks(self, chunk_size):
+        """
+            Returns the location of the chunks of the kept versions and of the installed model by hash.
+        """
+        locations = {}
+        for name in os.listdir(self.versions_dir):
+            path = os.path.join(self.versions_dir, name)
+            # kept versions without a manifest are not read, only the installed model is
+            if os.path.isfile(os.path.join(path, MANIFEST_FILE)):
+                locations.update(local_chunks(path, chunk_size))
+        if os.path.isdir(self.model_dir):
+            locations.update(local_chunks(self.model_dir, chunk_size))
+        return locations
+
+    def _assemble(self, manifest, staging):
+        """
+            Writes the files of manifest to staging. Returns the number of fetched chunks and of all chunks.
+        """
+        local = self._local_chunks(manifest["chunk_size"])
+
+        # create all files first, so the chunks can be written at their offsets in any order
+        positions = {}
+        for entry in manifest["files"]:
+            path = checked_path(staging, entry["path"])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if "link" in entry:
+                os.symlink(checked_link(staging, path, entry["link"]), path)
+                continue
+            with open(path, "wb") as file:
+                file.truncate(entry["size"])
+            offset = 0
+            for digest, size in zip(entry["chunks"], entry["sizes"]):
+                positions.setdefault(digest, []).append((entry["path"], offset))
+                offset += size
+
+        def place(digest):
+            data = read_local(local[digest], digest) if digest in local else None
+            fetched = data is None
+            if fetched:
+                data = self.store.chunk(digest)
+            for relative, offset in positions[digest]:
+                # checked again, all links of the manifest are in place by now
+                with open(checked_path(staging, relative), "r+b") as file:
+                    file.seek(offset)
+                    file.write(data)
+            return fetched
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            fetched = sum(executor.map(place, positions))
+
+        # resolves every path again, a link must not point outside of staging through a later link either
+        for entry in manifest["files"]:
+            path = checked_path(staging, entry["path"])
+            if "link" not in entry:
+                os.chmod(path, entry.get("mode", 0o644))
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        if not any(entry["path"] == "VERSION" for entry in manifest["files"]):
+            with open(checked_path(staging, "VERSION"), "w") as file:
+                file.write(manifest["version"] + "\n")
+        with open(checked_path(staging, MANIFEST_FILE), "w") as file:
+            json.dump(manifest, file)
+        return fetched, len(positions)
+
+    def _switch(self, target):
+        if os.path.isdir(self.model_dir) and not os.path.islink(self.model_dir):
+            # first update of a plain directory, it is missing for the moment between the two renames
+            previous = os.path.join(self.versions_dir, ".initial-{}".format(int(time.time())))
+            os.rename(self.model_dir, previous)
+        # a relative link also resolves where the parent directory is mounted at another path
+        link = self.model_dir + ".tmp"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.relpath(target, os.path.dirname(self.model_dir)), link)
+        os.replace(link, self.model_dir)
+
+    def _prune(self, current):
+        versions = [os.path.join(self.versions_dir, name) for name in os.listdir(self.versions_dir)
+                    if name not in (".lock",) and not name.startswith(".staging-")]
+        versions = sorted((path for path in versions if path != current and os.path.isdir(path)),
+                          key=os.path.getmtime, reverse=True)
+        for path in versions[self.keep:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def start(self):
+        """
+            Starts the thread which checks the store for new versions.
+        """
+        threading.Thread(target=self._watch, name="model-updater", daemon=True).start()
+        logger.info("Checking %s for new models every %.0f seconds", self.store.url, self.interval)
+
+    def stats(self):
+        return {"version": self.installed_version(), "updates": self.updates, "failures": self.failures,
+                "last": self.last}
+
+    def _watch(self):
+        while True:
+            try:
+                self.update()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not update the model from %s", self.store.url)
+                self.failures += 1
+            time.sleep(self.interval)
+
+
+def create_updater(model_dir, url=MODEL_UPDATE_URL):
+    """
+        Returns the ModelUpdater of model_dir, or None if updates are disabled.
+    """
+    return ModelUpdater(ChunkStore(url), model_dir) if url else None
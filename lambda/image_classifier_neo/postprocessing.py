@@ -0,0 +1,82 @@
+"""
+Vectorized postprocessing of the model output.
+
+Turns the class scores of a whole batch into top-k labels and scores in one go:
+np.argpartition selects the k best classes per image without sorting all classes,
+and only those k are sorted. Labels are kept in a NumPy array, so the label names of
+all images in a batch are looked up with a single indexing operation.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import os
+import numpy as np
+
+# number of labels and scores returned per image
+TOP_K = int(os.getenv("TOP_K", "5"))
+# labels with a lower score are left out of the top-k results
+MIN_CONFIDENCE = float(os.getenv("MIN_CONFIDENCE", "0"))
+# apply a softmax to the model output, for models which return logits instead of probabilities
+SOFTMAX = os.getenv("SOFTMAX", "false").lower() == "true"
+# temperature of the softmax, values above 1 make scores less confident
+SOFTMAX_TEMPERATURE = float(os.getenv("SOFTMAX_TEMPERATURE", "1"))
+# decimals of the scores in the response
+SCORE_DECIMALS = 4
+
+
+def load_labels(path):
+    """
+        Returns the labels of the model as NumPy array.
+    """
+    with open(path, 'r') as file:
+        labels_txt = file.read()
+    # remove background class which is not used by this model
+    return np.array(labels_txt.split("\n")[1:])
+
+
+def softmax(scores, temperature=1.0):
+    scores = scores / temperature
+    # subtract the maximum for numerical stability
+    exp = np.exp(scores - scores.max(axis=-1, keepdims=True))
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class Postprocessor:
+    """
+        Converts the class scores of a batch into a result per image.
+    """
+
+    def __init__(self, labels, k=TOP_K, min_confidence=MIN_CONFIDENCE,
+                 apply_softmax=SOFTMAX, temperature=SOFTMAX_TEMPERATURE):
+        self.labels = labels
+        self.k = max(1, k)
+        self.min_confidence = min_confidence
+        self.apply_softmax = apply_softmax
+        self.temperature = temperature
+
+    def __call__(self, scores, labels=None):
+        """
+            Returns a result per row of scores with the top-1 label, its score and the top-k labels.
+            labels replaces the labels of the postprocessor, e.g. those of a reloaded model.
+        """
+        if self.apply_softmax:
+            scores = softmax(scores, self.temperature)
+        k = min(self.k, scores.shape[-1])
+        top = np.argpartition(scores, -k, axis=-1)[:, -k:]
+        top_scores = np.take_along_axis(scores, top, axis=-1)
+        # sort only the k selected classes, best first
+        order = np.argsort(-top_scores, axis=-1)
+        top = np.take_along_axis(top, order, axis=-1)
+        # round in float64, rounded float32 values are not exact in JSON
+        top_scores = np.take_along_axis(top_scores, order, axis=-1).astype(np.float64).round(SCORE_DECIMALS).tolist()
+        top_labels = (self.labels if labels is None else labels)[top].tolist()
+        results = []
+        for labels, label_scores in zip(top_labels, top_scores):
+            results.append({
+                "result": labels[0],
+                "confidence": label_scores[0],
+                "top_k": [{"label": label, "score": score}
+                          for label, score in zip(labels, label_scores)
+                          if score >= self.min_confidence],
+            })
+        return results
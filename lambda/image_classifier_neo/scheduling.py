@@ -0,0 +1,137 @@
+"""
+Deadline and priority aware work queue.
+
+Requests can carry a priority and a deadline (see events.py). Pending downloads and
+pending inferences wait in a WorkQueue, which hands out the most urgent entry first:
+higher priority first, then earlier deadline, then order of arrival. An entry whose
+deadline passed is dropped when it comes up, before any work is spent on it. When
+more than MAX_PENDING_REQUESTS entries wait, the least urgent one is shed, so the
+waiting time and with it the tail latency stay bounded under overload.
+
+Dropped entries are passed to on_drop together with a RequestExpired or Overloaded
+error, so their requests can be answered with an error right away.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import heapq
+import itertools
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger()
+
+# maximum number of requests waiting for download and for inference each, 0 is unlimited
+MAX_PENDING_REQUESTS = int(os.getenv("MAX_PENDING_REQUESTS", "100"))
+
+
+class RequestDropped(Exception):
+    """
+        Base class of the reasons a request was dropped without being processed.
+    """
+
+
+class RequestExpired(RequestDropped):
+    """
+        Raised for requests whose deadline passed before they were processed.
+    """
+
+    def __init__(self):
+        super().__init__("expired")
+
+
+class Overloaded(RequestDropped):
+    """
+        Raised for requests shed because too many requests were waiting.
+    """
+
+    def __init__(self):
+        super().__init__("overloaded")
+
+
+class WorkQueue:
+    """
+        Thread-safe priority queue with deadlines and a size limit. The interface follows queue.Queue.
+    """
+
+    def __init__(self, maxsize=MAX_PENDING_REQUESTS, on_drop=None):
+        self.maxsize = maxsize
+        self.on_drop = on_drop
+        self.expired = 0
+        self.shed = 0
+        self._heap = []
+        # number of entries queued with force, they neither count towards maxsize nor are shed
+        self._forced = 0
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+
+    def put(self, entry, priority=0, deadline=None, force=False):
+        """
+            Queues entry. deadline is a time.monotonic() value, None never expires.
+            With force, entry is queued even if the queue is full, and is never shed by later entries.
+        """
+        # the counter makes every key unique, so neither the flags nor the entries are ever compared
+        item = ((-priority, math.inf if deadline is None else deadline, next(self._counter)), force, entry)
+        shed = None
+        with self._condition:
+            if force:
+                self._forced += 1
+            elif self.maxsize and len(self._heap) - self._forced >= self.maxsize:
+                least_urgent = max(queued for queued in self._heap if not queued[1])
+                if least_urgent[0] < item[0]:
+                    shed = item
+                else:
+                    self._heap.remove(least_urgent)
+                    heapq.heapify(self._heap)
+                    shed = least_urgent
+                self.shed += 1
+            if shed is not item:
+                heapq.heappush(self._heap, item)
+                self._condition.notify()
+        if shed:
+            self._drop(shed[2], Overloaded())
+
+    def get(self, timeout=None):
+        """
+            Returns the most urgent entry which did not expire. Waits up to timeout seconds
+            for one, forever if None. Raises queue.Empty if there is none.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                while not self._heap:
+                    if end is None:
+                        self._condition.wait()
+                        continue
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._condition.wait(remaining)
+                key, forced, entry = heapq.heappop(self._heap)
+                if forced:
+                    self._forced -= 1
+                expired = key[1] < time.monotonic()
+                if expired:
+                    self.expired += 1
+            if not expired:
+                return entry
+            self._drop(entry, RequestExpired())
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def qsize(self):
+        with self._condition:
+            return len(self._heap) - self._forced
+
+    def _drop(self, entry, error):
+        if self.on_drop is None:
+            return
+        try:
+            self.on_drop(entry, error)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Could not drop %s request", error)
@@ -0,0 +1,156 @@
+"""
+Micro-batching of inference requests.
+
+The lambda handler queues single requests and returns immediately. A worker thread
+collects queued requests into a batch and runs the model once for the whole batch.
+A batch is started as soon as it holds max_batch_size requests or the oldest request
+has waited max_wait_ms, whichever happens first. The images of a multi-image request
+are queued as a group, which always runs within a single batch. Requests wait in a
+WorkQueue (see scheduling.py), so urgent requests are batched first and expired
+requests never reach the model.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import logging
+import math
+import os
+import queue
+import threading
+import time
+from scheduling import MAX_PENDING_REQUESTS, WorkQueue
+
+logger = logging.getLogger()
+
+# maximum number of images sent to the model in a single call
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+# maximum time in milliseconds a request waits for its batch to fill up
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# marker put on the queue to stop the worker thread
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+        Collects requests into batches and runs each batch with a single model call.
+
+        run_batch is called with a list of inputs and must return one result per input.
+        The callback passed to submit() is called from the worker thread with the result
+        of its request, or with the exception raised by run_batch. The callback passed to
+        submit_many() is called with the list of results of its inputs instead. Requests
+        dropped by the queue get a RequestExpired or Overloaded error instead of a result.
+    """
+
+    def __init__(self, run_batch, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+                 max_pending=MAX_PENDING_REQUESTS):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = WorkQueue(max_pending, on_drop=self._drop)
+        # a group which did not fit into the previous batch, it starts the next one
+        self._held = None
+        self._worker = threading.Thread(
+            target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, item, callback, priority=0, deadline=None):
+        """
+            Queues a single input. callback(result) is called once the batch containing it ran.
+            deadline is the time.monotonic() after which the input is dropped instead.
+        """
+        self._queue.put(([item], callback, True), priority, deadline)
+
+    def submit_many(self, items, callback, priority=0, deadline=None):
+        """
+            Queues several inputs which run in the same batch, which may exceed max_batch_size
+            for that. callback(results) is called with the list of their results once it ran.
+        """
+        self._queue.put((list(items), callback, False), priority, deadline)
+
+    def qsize(self):
+        """
+            Returns the number of requests waiting for a batch.
+        """
+        return self._queue.qsize()
+
+    def dropped(self):
+        """
+            Returns the number of requests dropped because they expired or were shed.
+        """
+        return {"expired": self._queue.expired, "shed": self._queue.shed}
+
+    def close(self, timeout=None):
+        """
+            Runs all queued requests and stops the worker thread.
+        """
+        # the stop marker must not be shed by a full queue, the worker would never stop
+        self._queue.put(_STOP, priority=-math.inf, force=True)
+        self._worker.join(timeout)
+
+    @staticmethod
+    def _drop(entry, error):
+        if entry is _STOP:
+            return
+        _, callback, _ = entry
+        callback(error)
+
+    def _collect(self):
+        """
+            Blocks until a batch is ready. Returns the batch and whether the worker should stop.
+        """
+        first, self._held = self._held or self._queue.get(), None
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    entry = self._queue.get(timeout=remaining)
+                else:
+                    # take whatever is already queued without waiting any longer
+                    entry = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _STOP:
+                return batch, True
+            if size + len(entry[0]) > self.max_batch_size:
+                # do not split a group, it starts the next batch instead
+                self._held = entry
+                break
+            batch.append(entry)
+            size += len(entry[0])
+        return batch, False
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if not batch:
+                continue
+            inputs = [item for items, _, _ in batch for item in items]
+            failure = None
+            try:
+                results = self.run_batch(inputs)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.exception("Inference failed for batch of %d", len(inputs))
+                failure = error
+            logger.debug("Ran batch of %d", len(inputs))
+            offset = 0
+            for items, callback, single in batch:
+                if failure is not None:
+                    result = failure
+                elif single:
+                    result = results[offset]
+                else:
+                    result = results[offset:offset + len(items)]
+                offset += len(items)
+                try:
+                    callback(result)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Result callback failed")
@@ -0,0 +1,182 @@
+"""
+Coalesced publishing of responses.
+
+By default every response is published as its own JSON message, which repeats the
+function ARN and the field names of every result. At high request or frame rates, the
+number and size of MQTT messages dominate the AWS IoT costs and the upstream bandwidth.
+With OUTPUT_MODE=coalesced, responses are collected per topic and published together
+once OUTPUT_WINDOW_COUNT responses are collected or the oldest one waited
+OUTPUT_WINDOW_MS:
+
+    {"function": "<function ARN>", "responses": [{"image": "...", "result": "...",
+        "confidence": 0.93, "top_k": [["tabby", 0.93], ["tiger cat", 0.05]]}, ...]}
+
+The function ARN is sent once in the header and top-k scores are sent as
+[label, score] pairs. Messages are encoded with msgpack (OUTPUT_ENCODING=msgpack) or
+as compact JSON (OUTPUT_ENCODING=json). A message larger than OUTPUT_MAX_BYTES is
+split in two until the parts fit.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger()
+
+# "json" publishes every response on its own, "coalesced" publishes several responses in one message
+OUTPUT_MODE = os.getenv("OUTPUT_MODE", "json")
+# encoding of coalesced messages, msgpack or json
+OUTPUT_ENCODING = os.getenv("OUTPUT_ENCODING", "msgpack")
+# milliseconds a response waits at most for more responses
+OUTPUT_WINDOW_MS = float(os.getenv("OUTPUT_WINDOW_MS", "1000"))
+# maximum number of responses in one message
+OUTPUT_WINDOW_COUNT = int(os.getenv("OUTPUT_WINDOW_COUNT", "100"))
+# maximum size of a message in bytes, AWS IoT accepts up to 128 KB
+OUTPUT_MAX_BYTES = int(os.getenv("OUTPUT_MAX_BYTES", str(128 * 1024)))
+
+
+def create_encoder(encoding):
+    """
+        Returns the function which encodes a message with msgpack or as compact JSON.
+    """
+    if encoding == "msgpack":
+        import msgpack  # pylint: disable=import-outside-toplevel
+        return lambda message: msgpack.packb(message, use_bin_type=True)
+    if encoding == "json":
+        return lambda message: json.dumps(message, separators=(",", ":"))
+    raise ValueError("Unknown output encoding {}".format(encoding))
+
+
+def compact(response):
+    """
+        Returns a response with top-k scores as [label, score] pairs, also in the results of an aggregated response.
+    """
+    response = dict(response)
+    if "top_k" in response:
+        response["top_k"] = [[entry["label"], entry["score"]] for entry in response["top_k"]]
+    if "results" in response:
+        response["results"] = [compact(result) for result in response["results"]]
+    return response
+
+
+class Coalescer:
+    """
+        Collects responses per topic and publishes them in coalesced messages with publish(topic, payload).
+        Fields of the header are sent once per message and removed from the responses.
+    """
+
+    def __init__(self, publish, header, encoding=OUTPUT_ENCODING, window_ms=OUTPUT_WINDOW_MS,
+                 window_count=OUTPUT_WINDOW_COUNT, max_bytes=OUTPUT_MAX_BYTES):
+        self.publish = publish
+        self.header = header
+        self.encode = create_encoder(encoding)
+        self.window = window_ms / 1000.0
+        self.window_count = max(1, window_count)
+        self.max_bytes = max_bytes
+        self.messages = 0
+        self.responses = 0
+        self.bytes = 0
+        # topic -> (time.monotonic() of the oldest response, responses)
+        self._pending = {}
+        self._condition = threading.Condition()
+
+    def add(self, topic, response):
+        """
+            Queues a response for topic.
+        """
+        response = compact({key: value for key, value in response.items() if key not in self.header})
+        with self._condition:
+            if topic not in self._pending:
+                self._pending[topic] = (time.monotonic(), [])
+                self._condition.notify()
+            responses = self._pending[topic][1]
+            responses.append(response)
+            full = len(responses) >= self.window_count
+            if full:
+                del self._pending[topic]
+        if full:
+            self._publish(topic, responses)
+
+    def start(self):
+        """
+            Starts the thread which publishes responses whose window ended.
+        """
+        threading.Thread(target=self._run, name="coalescer", daemon=True).start()
+
+    def flush(self):
+        """
+            Publishes all queued responses.
+        """
+        with self._condition:
+            pending, self._pending = self._pending, {}
+        for topic, (_, responses) in pending.items():
+            self._publish(topic, responses)
+
+    def stats(self):
+        """
+            Returns the number of messages, responses and bytes published since the previous call.
+        """
+        with self._condition:
+            stats = {"messages": self.messages, "responses": self.responses, "bytes": self.bytes}
+            self.messages = self.responses = self.bytes = 0
+        return stats
+
+    def _run(self):
+        while True:
+            due = []
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                now = time.monotonic()
+                for topic, (started, responses) in list(self._pending.items()):
+                    if now - started >= self.window:
+                        due.append((topic, responses))
+                        del self._pending[topic]
+                if not due:
+                    oldest = min(started for started, _ in self._pending.values())
+                    self._condition.wait(oldest + self.window - now)
+            for topic, responses in due:
+                self._publish(topic, responses)
+
+    def _publish(self, topic, responses):
+        for payload in self._encode(responses):
+            try:
+                self.publish(topic, payload)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not publish %d coalesced responses to %s", len(responses), topic)
+                continue
+            with self._condition:
+                self.messages += 1
+                self.bytes += len(payload)
+        with self._condition:
+            self.responses += len(responses)
+
+    def _encode(self, responses):
+        """
+            Returns the messages of responses, split until each fits into max_bytes.
+        """
+        payload = self.encode(dict(self.header, responses=responses))
+        if len(payload) <= self.max_bytes:
+            return [payload]
+        if len(responses) == 1:
+            logger.warning("Response of %d bytes exceeds OUTPUT_MAX_BYTES", len(payload))
+            return [payload]
+        half = len(responses) // 2
+        return self._encode(responses[:half]) + self._encode(responses[half:])
+
+
+def create_coalescer(publish, header, mode=OUTPUT_MODE):
+    """
+        Returns the started Coalescer, or None if responses are published on their own.
+    """
+    if mode == "json":
+        return None
+    if mode != "coalesced":
+        raise ValueError("Unknown output mode {}".format(mode))
+    coalescer = Coalescer(publish, header)
+    coalescer.start()
+    return coalescer
@@ -0,0 +1,293 @@
+"""
+Concurrent image downloads with persistent connections.
+
+Downloader keeps idle HTTP(S) connections per host and reuses them, so images from
+the same camera gateway do not pay for a new TCP/TLS handshake each. Every request
+has a timeout and failed requests are retried with exponential backoff. file:// URLs
+are read from the local file system, within FILE_IMAGE_ROOT only.
+
+Prefetcher runs downloads on a pool of worker threads, so images are downloaded and
+decoded while the model is busy with previous requests. Pending downloads wait in a
+WorkQueue (see scheduling.py), urgent ones first, and expired ones are never started.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import http.client
+import logging
+import math
+import os
+import threading
+import time
+import urllib.parse
+from collections import namedtuple
+from ingestion import MAX_IMAGE_BYTES, read_limited
+from scheduling import MAX_PENDING_REQUESTS, WorkQueue
+
+logger = logging.getLogger()
+
+# number of images downloaded in parallel
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "4"))
+# timeout in seconds for connecting and for each read from the connection
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "10"))
+# number of retries after a failed download
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "2"))
+# seconds to wait before the first retry, doubled for every further retry
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", "0.2"))
+# maximum number of redirects followed for a single download
+MAX_REDIRECTS = 5
+# directory file:// images must be located in, empty rejects file:// images
+FILE_IMAGE_ROOT = os.getenv("FILE_IMAGE_ROOT", "")
+
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+# status codes worth another try, all other errors are reported right away
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# errors raised by a keep-alive connection the server closed while it was idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected,
+                           ConnectionResetError, BrokenPipeError)
+
+
+# data is None if the server answered a conditional request with "304 Not Modified"
+Download = namedtuple("Download", ["url", "data", "etag", "last_modified"])
+
+
+class DownloadError(Exception):
+    """
+        Raised when an image could not be downloaded.
+    """
+
+    def __init__(self, url, reason, status=None):
+        super().__init__("Download of {} failed: {}".format(url, reason))
+        self.url = url
+        self.status = status
+
+
+def read_file(url, root=FILE_IMAGE_ROOT, max_bytes=MAX_IMAGE_BYTES):
+    """
+        Returns a Download with the raw bytes of a file:// URL. Raises DownloadError if the file
+        is outside of root or could not be read.
+    """
+    if not root:
+        raise DownloadError(url, "file:// images are disabled, set FILE_IMAGE_ROOT to allow them")
+    root = os.path.realpath(root)
+    path = os.path.realpath(urllib.parse.unquote(urllib.parse.urlsplit(url).path))
+    if os.path.commonpath([path, root]) != root:
+        raise DownloadError(url, "not within {}".format(root))
+    try:
+        with open(path, "rb") as file:
+            return Download(url, read_limited(file, max_bytes), None, None)
+    except OSError as error:
+        raise DownloadError(url, error) from error
+
+
+class ConnectionPool:
+    """
+        Keeps idle connections per (scheme, host, port) for reuse.
+    """
+
+    def __init__(self, timeout=DOWNLOAD_TIMEOUT, max_idle=DOWNLOAD_WORKERS):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+            Returns a connection for key and whether it was reused from the pool.
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, key, connection):
+        """
+            Returns a connection with no pending response to the pool.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            connections = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+        for connection in connections:
+            connection.close()
+
+
+class Downloader:
+    """
+        Downloads images into memory over pooled connections.
+    """
+
+    def __init__(self, timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES,
+                 backoff=DOWNLOAD_BACKOFF, max_bytes=MAX_IMAGE_BYTES, pool=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self.pool = pool or ConnectionPool(timeout)
+
+    def fetch(self, url, etag=None, last_modified=None):
+        """
+            Returns a Download with the raw bytes found at url. Raises DownloadError if all attempts failed.
+            If etag or last_modified of a previous download are given, the download is skipped
+            in case the image did not change.
+        """
+        if url.startswith("file://"):
+            return read_file(url, max_bytes=self.max_bytes)
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        attempt = 0
+        while True:
+            try:
+                return self._fetch(url, headers)
+            except (DownloadError, OSError, http.client.HTTPException) as error:
+                retryable = not isinstance(error, DownloadError) or error.status in RETRY_STATUS
+                if not retryable or attempt >= self.retries:
+                    if isinstance(error, DownloadError):
+                        raise
+                    raise DownloadError(url, error) from error
+            delay = self.backoff * (2 ** attempt)
+            attempt += 1
+            logger.info("Retrying download of %s in %.2fs (%d/%d)",
+                        url, delay, attempt, self.retries)
+            time.sleep(delay)
+
+    def _fetch(self, url, headers):
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https") or not parts.hostname:
+                raise DownloadError(url, "not a valid http(s) URL")
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+            status, response_headers, data = self._request(
+                key, dict(headers, Host=parts.netloc), path)
+            if status in REDIRECT_STATUS and response_headers.get("Location"):
+                url = urllib.parse.urljoin(url, response_headers["Location"])
+                continue
+            if status not in (200, 304) or (status == 304 and not headers):
+                raise DownloadError(url, "HTTP status {}".format(status), status)
+            return Download(url, data, response_headers.get("ETag"), response_headers.get("Last-Modified"))
+        raise DownloadError(url, "too many redirects")
+
+    def _request(self, key, headers, path):
+        """
+            Sends a GET request over a pooled connection. Returns status, headers and body.
+        """
+        connection, reused = self.pool.acquire(key)
+        try:
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                if not reused:
+                    raise
+                # the server closed the idle connection, retry once on a new one
+                connection.close()
+                connection, reused = self.pool.acquire(key)
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            if response.status == 200:
+                length = response.getheader("Content-Length")
+                data = read_limited(response, self.max_bytes, int(length) if length else None)
+            else:
+                # drain the body so the connection can be reused
+                response.read()
+                data = None
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.release(key, connection)
+        return response.status, response.headers, data
+
+
+class Prefetcher:
+    """
+        Downloads and prepares images on a pool of worker threads.
+
+        load is called with the source of an image on a worker thread, e.g. to download
+        and decode the image at a URL with a Downloader.
+    """
+
+    def __init__(self, load, workers=DOWNLOAD_WORKERS, max_pending=MAX_PENDING_REQUESTS):
+        self.load = load
+        self._queue = WorkQueue(max_pending, on_drop=self._drop)
+        self._loading = 0
+        self._lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, name="prefetcher-{}".format(index), daemon=True)
+                         for index in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, source, callback, priority=0, deadline=None):
+        """
+            Loads source in the background. callback is called from the worker thread with
+            the result of load, or with the exception raised. If the time.monotonic() deadline
+            passes before a worker is free, callback gets a RequestExpired error instead.
+        """
+        self._queue.put((source, callback), priority, deadline)
+
+    def pending(self):
+        """
+            Returns the number of submitted images which are not loaded yet.
+        """
+        return self._queue.qsize() + self._loading
+
+    def dropped(self):
+        """
+            Returns the number of requests dropped because they expired or were shed.
+        """
+        return {"expired": self._queue.expired, "shed": self._queue.shed}
+
+    def _work(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            with self._lock:
+                self._loading += 1
+            try:
+                self._run(*entry)
+            finally:
+                with self._lock:
+                    self._loading -= 1
+
+    def _run(self, source, callback):
+        try:
+            result = self.load(source)
+        except Exception as error:  # pylint: disable=broad-except
+            result = error
+        try:
+            callback(result)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Load callback failed for %.200r", source)
+
+    @staticmethod
+    def _drop(entry, error):
+        if entry is not None:
+            _, callback = entry
+            callback(error)
+
+    def close(self):
+        """
+            Loads all queued images and stops the worker threads.
+        """
+        for _ in self._workers:
+            # the stop markers must not be shed by a full queue, the workers would never stop
+            self._queue.put(None, priority=-math.inf, force=True)
+        for worker in self._workers:
+            worker.join()
@@ -0,0 +1,67 @@
+"""
+In-memory image ingestion.
+
+Images are streamed from the HTTP response (see download.py) into a memory buffer
+and decoded from there, so no temporary file is written on the device. Every request
+gets its own buffer, which makes ingestion safe when several requests are handled
+at once.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import io
+import os
+import PIL.Image as Image
+
+# maximum size in bytes of an image accepted for inference
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+# number of bytes read from the network at once
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageTooLargeError(ValueError):
+    """
+        Raised when an image exceeds the maximum accepted size.
+    """
+
+    def __init__(self, max_bytes):
+        super().__init__(
+            "Image exceeds the maximum size of {} bytes".format(max_bytes))
+        self.max_bytes = max_bytes
+
+
+def read_limited(stream, max_bytes=MAX_IMAGE_BYTES, length=None):
+    """
+        Reads a binary stream into memory. Raises ImageTooLargeError if it holds more than max_bytes.
+        length is the expected size (e.g. from the Content-Length header) if known.
+    """
+    if length is not None:
+        if length > max_bytes:
+            raise ImageTooLargeError(max_bytes)
+        # size is known up front, read straight into a single preallocated buffer
+        buffer = bytearray(length)
+        with memoryview(buffer) as view:
+            received = 0
+            while received < length:
+                count = stream.readinto(view[received:])
+                if not count:
+                    break
+                received += count
+        # trim the buffer in case the connection closed early
+        del buffer[received:]
+        return buffer
+    buffer = bytearray()
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return buffer
+        buffer += chunk
+        if len(buffer) > max_bytes:
+            raise ImageTooLargeError(max_bytes)
+
+
+def open_image(data):
+    """
+        Returns a PIL image decoded from raw image bytes.
+    """
+    return Image.open(io.BytesIO(data))
@@ -0,0 +1,88 @@
+"""
+Image preprocessing for the image classifier models.
+
+Preprocessing runs in two steps:
+- load() decodes and resizes a single image. JPEG images are decoded in draft mode,
+  which lets the decoder scale them down by a power of two (1/2, 1/4, 1/8) while
+  decoding, so a large camera frame is never decoded at full resolution.
+- to_batch() normalizes a list of loaded images into a preallocated float32 batch
+  buffer in the memory layout of the model (NHWC or NCHW).
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import os
+import numpy as np
+import PIL.Image as Image
+from ingestion import open_image
+
+# PIL resampling filter used to scale images to the model input size,
+# e.g. NEAREST, BILINEAR, BICUBIC or LANCZOS
+RESAMPLE_FILTER = os.getenv("RESAMPLE_FILTER", "BILINEAR")
+
+# channels last, as used by Tensorflow/Keras
+LAYOUT_NHWC = "NHWC"
+# channels first, as used by the SageMaker Neo compiled model
+LAYOUT_NCHW = "NCHW"
+
+
+class Preprocessor:
+    """
+        Turns raw image bytes into model input of size x size pixels in the given layout.
+        allocate(shape) returns the float32 array batches are written to, e.g. in shared memory.
+    """
+
+    def __init__(self, size, layout=LAYOUT_NHWC, resample=RESAMPLE_FILTER, allocate=None):
+        if layout not in (LAYOUT_NHWC, LAYOUT_NCHW):
+            raise ValueError("Unsupported layout: {}".format(layout))
+        self.size = size
+        self.layout = layout
+        self.resample = getattr(Image, resample.upper())
+        if layout == LAYOUT_NCHW:
+            self.image_shape = (3, size, size)
+        else:
+            self.image_shape = (size, size, 3)
+        self.allocate = allocate or (lambda shape: np.zeros(shape, dtype=np.float32))
+        self._buffer = np.zeros((0,) + self.image_shape, dtype=np.float32)
+
+    def decode(self, data):
+        """
+            Returns the decoded RGB image, scaled down by the JPEG decoder where possible.
+        """
+        image = open_image(data)
+        # only has an effect on JPEG images, picks the smallest power of two scale
+        # which still keeps the image at least size x size pixels
+        image.draft("RGB", (self.size, self.size))
+        return image.convert("RGB")
+
+    def resize(self, image):
+        """
+            Returns the image resized to the model input size as uint8 HWC array.
+        """
+        return np.asarray(image.resize((self.size, self.size), self.resample))
+
+    def load(self, data):
+        """
+            Decodes and resizes raw image bytes. The result is passed to to_batch().
+        """
+        return self.resize(self.decode(data))
+
+    def to_batch(self, images, batch_size=None):
+        """
+            Returns a float32 batch with the normalized images in the model layout.
+
+            The returned array is a view of a buffer which is reused by the next call,
+            so it must not be kept after the model ran. batch_size pads the batch with
+            zeros if the model needs a fixed batch size.
+        """
+        batch_size = max(batch_size or 0, len(images))
+        if len(self._buffer) < batch_size:
+            self._buffer = self.allocate((batch_size,) + self.image_shape)
+        batch = self._buffer[:batch_size]
+        for index, image in enumerate(images):
+            if self.layout == LAYOUT_NCHW:
+                image = image.transpose(2, 0, 1)
+            # normalize pixel values, written straight into the batch buffer
+            np.divide(image, np.float32(255.0), out=batch[index])
+        batch[len(images):] = 0
+        return batch
@@ -0,0 +1,189 @@
+"""
+Hot swapping of the model without restarting the function.
+
+The model of a function is wrapped in a ReloadingBackend. Every MODEL_RELOAD_INTERVAL
+seconds it checks whether the model in the model directory changed. The version of the
+model is the content of the file MODEL_VERSION_FILE in the model directory if there is
+one, otherwise a hash of the names, sizes and modification times of the model files:
+the files directly in the model directory and the files of MODEL_VERSION_DIRS. Other
+directories, like the dependencies/ of the full Tensorflow package, are not read. A new
+version is only loaded once it did not change between two checks, so a model which is
+still being copied is not loaded.
+
+A new model comes with its labels if the model directory has a MODEL_LABELS_FILE, they
+are swapped in together with the model. Otherwise it keeps the labels of the function.
+
+The new model is loaded in the background, while requests keep running on the old
+model. It is validated by a warm-up inference through the whole inference path and then
+swapped in between two batches. Batches which already started finish on the old model,
+which is released afterwards. A model which fails to load or to validate is not retried
+until its version changes again.
+
+Results report the version of the model which classified them as "model_version".
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from backends import Backend, load_backend
+from postprocessing import load_labels
+
+logger = logging.getLogger()
+
+# seconds between two checks of the model directory for a new model, 0 disables reloading
+MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "30"))
+# file within the model directory with the version of the model
+MODEL_VERSION_FILE = os.getenv("MODEL_VERSION_FILE", "VERSION")
+# file within the model directory with the labels of the model
+MODEL_LABELS_FILE = os.getenv("MODEL_LABELS_FILE", "ImageNetLabels.txt")
+# directories within the model directory which hold model files, e.g. the Keras SavedModel
+MODEL_VERSION_DIRS = ("saved_model",)
+
+
+def model_files(model_dir):
+    """
+        Yields the paths of the model files in model_dir in a stable order.
+    """
+    try:
+        names = sorted(os.listdir(model_dir))
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(model_dir, name)
+        if not os.path.isdir(path):
+            yield path
+        elif name in MODEL_VERSION_DIRS:
+            for root, directories, files in os.walk(path):
+                directories.sort()
+                for file_name in sorted(files):
+                    yield os.path.join(root, file_name)
+
+
+def model_version(model_dir, version_file=MODEL_VERSION_FILE):
+    """
+        Returns the version of the model in model_dir, None if there is no model.
+    """
+    try:
+        with open(os.path.join(model_dir, version_file), "r") as file:
+            return file.read().strip()
+    except OSError:
+        pass
+    digest = hashlib.sha1()
+    found = False
+    for path in model_files(model_dir):
+        try:
+            status = os.stat(path)
+        except OSError:
+            # the file was replaced while listing, the next check sees the new one
+            continue
+        found = True
+        digest.update("{}:{}:{}\n".format(
+            os.path.relpath(path, model_dir), status.st_size, status.st_mtime_ns).encode())
+    return digest.hexdigest()[:12] if found else None
+
+
+class ReloadingBackend(Backend):
+    """
+        Backend which runs batches on the current model and swaps in new models of its model directory.
+    """
+
+    def __init__(self, backend, interval=MODEL_RELOAD_INTERVAL):
+        super().__init__(backend.model_dir)
+        self.name = backend.name
+        self.layout = backend.layout
+        self.batch_size = backend.batch_size
+        self.interval = interval
+        self.reloads = 0
+        self.failures = 0
+        # the model server of the core reports the version of remote models itself
+        if backend.name != "remote":
+            backend.version = model_version(self.model_dir)
+        self._current = backend
+        # version of the model which ran the last batch of each thread
+        self._ran = threading.local()
+
+    @property
+    def version(self):
+        """
+            Returns the version of the model which ran the last batch of this thread, or the current version.
+        """
+        return getattr(self._ran, "version", None) or self._current.version
+
+    @property
+    def labels(self):
+        """
+            Returns the labels of the model which ran the last batch of this thread, or the current labels.
+        """
+        ran = getattr(self._ran, "backend", None) or self._current
+        return ran.labels
+
+    def import_library(self):
+        return self._current.import_library()
+
+    def load(self):
+        pass
+
+    def run(self, batch):
+        # the batch runs to its end on the model it started on, even if it is swapped meanwhile
+        backend = self._current
+        output = backend.run(batch)
+        self._ran.version = backend.version
+        self._ran.backend = backend
+        return output
+
+    def allocate_batch(self, shape):
+        return self._current.allocate_batch(shape)
+
+    def start(self, validate, on_swap=None):
+        """
+            Starts the thread which checks for new models. validate(backend) runs a warm-up inference
+            with a new model and raises if it fails, on_swap() is called after a new model was swapped in.
+        """
+        if not self.interval or self.name == "remote":
+            return
+        threading.Thread(target=self._watch, args=(validate, on_swap), name="model-reloader",
+                         daemon=True).start()
+        logger.info("Checking %s for new models every %.0f seconds", self.model_dir, self.interval)
+
+    def stats(self):
+        return {"version": self._current.version, "reloads": self.reloads, "failures": self.failures}
+
+    def _watch(self, validate, on_swap):
+        seen = self._current.version
+        failed = None
+        while True:
+            time.sleep(self.interval)
+            version = model_version(self.model_dir)
+            settled = version == seen
+            seen = version
+            if not settled or version in (None, self._current.version, failed):
+                continue
+            try:
+                self._swap(version, validate)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not load model version %s, keeping version %s",
+                                 version, self._current.version)
+                failed = version
+                self.failures += 1
+                continue
+            if on_swap:
+                on_swap()
+
+    def _swap(self, version, validate):
+        logger.info("Loading model version %s", version)
+        backend = load_backend(self.name, self.model_dir)
+        if (backend.layout, backend.batch_size) != (self.layout, self.batch_size):
+            raise ValueError("Model input changed from {} with batch size {} to {} with batch size {}".format(
+                self.layout, self.batch_size, backend.layout, backend.batch_size))
+        backend.version = version
+        labels_path = os.path.join(self.model_dir, MODEL_LABELS_FILE)
+        # validated together with the model, a label file which does not fit its output fails the warm-up
+        backend.labels = load_labels(labels_path) if os.path.isfile(labels_path) else self._current.labels
+        validate(backend)
+        previous, self._current = self._current, backend
+        self.reloads += 1
+        logger.info("Swapped model version %s for version %s", previous.version, version)
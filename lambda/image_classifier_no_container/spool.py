@@ -0,0 +1,361 @@
+"""
+Disk-backed spool for results which could not be published.
+
+When publishing fails, e.g. because the core lost its connection, the message is
+appended to a spool in SPOOL_DIR instead of being lost. From then on the spool is
+offline: further messages are appended right away without trying to publish them, so
+requests do not wait for the publish timeout during an outage. The flusher probes the
+connection with the spooled messages, and the spool is online again once it published
+one. The spool is a ring buffer of append-only segment files: a new segment is started
+every SPOOL_SEGMENT_BYTES, and the oldest segments are deleted when the spool grows
+beyond SPOOL_MAX_BYTES, except for a segment the flusher is reading.
+
+A flusher thread publishes the spooled messages once publishing works again. Up to
+SPOOL_FLUSH_BATCH consecutive messages of the same topic are coalesced into a single
+message {"spooled": [...]} of at most OUTPUT_MAX_BYTES, and at most SPOOL_FLUSH_RATE
+messages are sent per second, so the backlog does not flood the connection. Binary
+messages, e.g. coalesced responses encoded with msgpack, and messages too large to be
+wrapped are published on their own as they are. Segments are deleted once they are
+published. Messages are delivered at least once: after a restart, a partly published
+segment is published again from its start.
+
+A coalesced message which failed SPOOL_MAX_ATTEMPTS times is retried one message at a
+time. When a single message failed as often, the message behind it is published first.
+If that works, the failing message is rejected for itself and is moved to the file
+dead-letter.jsonl of the spool, so it does not hold up the messages behind it.
+Otherwise publishing fails in general, e.g. while the core is offline, and the message
+is retried.
+
+Appending only writes to a file, it does not block the inference loop.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import base64
+import json
+import logging
+import os
+import threading
+import time
+from coalescing import OUTPUT_MAX_BYTES
+
+logger = logging.getLogger()
+
+# directory of the spool, empty disables spooling
+SPOOL_DIR = os.getenv("SPOOL_DIR", "")
+# maximum size in bytes of all segments, the oldest segments are deleted beyond that
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(64 * 1024 * 1024)))
+# size in bytes after which a new segment is started
+SPOOL_SEGMENT_BYTES = int(os.getenv("SPOOL_SEGMENT_BYTES", str(1024 * 1024)))
+# maximum number of messages per second sent while flushing
+SPOOL_FLUSH_RATE = float(os.getenv("SPOOL_FLUSH_RATE", "5"))
+# maximum number of spooled messages coalesced into one message
+SPOOL_FLUSH_BATCH = int(os.getenv("SPOOL_FLUSH_BATCH", "100"))
+# seconds to wait after a failed flush before trying again
+SPOOL_RETRY_INTERVAL = float(os.getenv("SPOOL_RETRY_INTERVAL", "10"))
+# failed attempts after which a message is retried on its own, or dead-lettered if it was on its own
+SPOOL_MAX_ATTEMPTS = int(os.getenv("SPOOL_MAX_ATTEMPTS", "5"))
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+DEAD_LETTER_FILE = "dead-letter.jsonl"
+# bytes of coalesce() around the payloads
+COALESCE_OVERHEAD = len('{"spooled":[]}')
+
+
+def coalesce(payloads):
+    """
+        Returns a single message with a list of JSON payloads, without parsing them.
+    """
+    return '{"spooled":[' + ",".join(payloads) + ']}'
+
+
+class Spool:
+    """
+        Persistent ring buffer of messages, published by a flusher thread.
+    """
+
+    def __init__(self, directory, max_bytes=SPOOL_MAX_BYTES, segment_bytes=SPOOL_SEGMENT_BYTES,
+                 flush_rate=SPOOL_FLUSH_RATE, flush_batch=SPOOL_FLUSH_BATCH,
+                 retry_interval=SPOOL_RETRY_INTERVAL, max_message_bytes=OUTPUT_MAX_BYTES,
+                 max_attempts=SPOOL_MAX_ATTEMPTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.flush_interval = 1.0 / flush_rate if flush_rate > 0 else 0
+        self.flush_batch = max(1, flush_batch)
+        self.retry_interval = retry_interval
+        self.max_message_bytes = max_message_bytes
+        self.max_attempts = max(1, max_attempts)
+        self.spooled = 0
+        self.flushed = 0
+        self.dropped_bytes = 0
+        self.dead_lettered = 0
+        # whether publishing failed and messages are spooled without trying to publish them
+        self.offline = False
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._file = None
+        # segment read by the flusher, it is not deleted by _limit_size meanwhile
+        self._flushing = None
+        # segment and byte offset up to which the oldest segment is published
+        self._offset = (None, 0)
+        # the batch being published as (segment, end offset, records)
+        self._attempt = None
+        # failures of the batch ending at _failed_at
+        self._failed_at = None
+        self._failures = 0
+        # (segment, end offset) up to which messages are published one at a time
+        self._isolate = None
+        # (segment, end offset) of a message which failed max_attempts times on its own
+        self._suspect = None
+        os.makedirs(directory, exist_ok=True)
+        # segments left by a previous run are flushed first
+        self._sizes = {}
+        for name in os.listdir(directory):
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                number = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+                self._sizes[number] = os.path.getsize(self._path(number))
+        self._segments = sorted(self._sizes)
+        if self._segments:
+            logger.info("Found %d spooled segments", len(self._segments))
+            self._pending.set()
+
+    def publish(self, publish, topic, payload):
+        """
+            Publishes a message with publish(topic, payload), or spools it if that fails or the spool is offline.
+        """
+        if not self.offline:
+            try:
+                publish(topic, payload)
+                return
+            except Exception:  # pylint: disable=broad-except
+                logger.warning("Could not publish to %s, spooling messages until publishing works again",
+                               topic, exc_info=True)
+                self.offline = True
+        self.append(topic, payload)
+
+    def append(self, topic, payload):
+        """
+            Spools a message for publishing later.
+        """
+        if isinstance(payload, bytes):
+            record = {"topic": topic, "data": base64.b64encode(payload).decode()}
+        else:
+            record = {"topic": topic, "payload": payload}
+        record = (json.dumps(record) + "\n").encode()
+        with self._lock:
+            if self._file is None or self._sizes[self._segments[-1]] + len(record) > self.segment_bytes:
+                self._start_segment()
+            self._file.write(record)
+            # hand the record to the operating system, so it survives a crash of the function
+            self._file.flush()
+            self._sizes[self._segments[-1]] += len(record)
+            self.spooled += 1
+            self._limit_size()
+        self._pending.set()
+
+    def start(self, publish):
+        """
+            Starts the flusher thread, which sends spooled messages with publish(topic, payload).
+        """
+        threading.Thread(target=self._flush, args=(publish,), name="spool-flusher", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "segments": len(self._segments),
+                "bytes": sum(self._sizes.values()),
+                "spooled": self.spooled,
+                "flushed": self.flushed,
+                "dropped_bytes": self.dropped_bytes,
+                "dead_lettered": self.dead_lettered,
+                "offline": self.offline,
+            }
+
+    def _path(self, number):
+        return os.path.join(self.directory, "{}{:012d}{}".format(SEGMENT_PREFIX, number, SEGMENT_SUFFIX))
+
+    def _start_segment(self):
+        self._close_segment()
+        number = self._segments[-1] + 1 if self._segments else 0
+        self._file = open(self._path(number), "ab")
+        self._segments.append(number)
+        self._sizes[number] = 0
+
+    def _close_segment(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _limit_size(self):
+        while sum(self._sizes.values()) > self.max_bytes:
+            # neither the segment being written nor the one being read by the flusher
+            droppable = [number for number in self._segments[:-1] if number != self._flushing]
+            if not droppable:
+                return
+            number = droppable[0]
+            self._segments.remove(number)
+            self.dropped_bytes += self._sizes.pop(number)
+            os.unlink(self._path(number))
+            logger.warning("Spool exceeds %d bytes, dropped its oldest segment", self.max_bytes)
+
+    def _flush(self, publish):
+        while True:
+            self._pending.wait()
+            with self._lock:
+                if not self._segments:
+                    self._pending.clear()
+                    continue
+                number = self._flushing = self._segments[0]
+                if len(self._segments) == 1:
+                    # new messages go to a new segment while this one is flushed
+                    self._close_segment()
+            try:
+                self._flush_segment(number, publish)
+            except Exception as error:  # pylint: disable=broad-except
+                with self._lock:
+                    self._flushing = None
+                logger.warning("Could not flush spool, retrying in %.0f seconds: %s", self.retry_interval, error)
+                self._count_failure()
+                time.sleep(self.retry_interval)
+                continue
+            with self._lock:
+                self._flushing = None
+                if self._segments and self._segments[0] == number:
+                    self._segments.pop(0)
+                    self._sizes.pop(number)
+                    os.unlink(self._path(number))
+
+    def _flush_segment(self, number, publish):
+        """
+            Publishes all messages of a segment, which may already be partly published.
+        """
+        start = self._offset[1] if self._offset[0] == number else 0
+        batches = list(self._batches(number, start))
+        index = 0
+        while index < len(batches):
+            batch = batches[index]
+            index += 1
+            if self._suspect == (number, batch[3]):
+                probe = batches[index] if index < len(batches) else self._next_batch(number)
+                if probe is not None:
+                    # the suspect is rejected for itself if the message behind it can be published
+                    self._publish_batch(publish, probe)
+                    self._dead_letter(batch[2][0])
+                    index += probe[4] == number
+                    continue
+            self._publish_batch(publish, batch)
+
+    def _next_batch(self, number):
+        """
+            Returns the first batch of the segment after number, None if there is none.
+        """
+        with self._lock:
+            later = [segment for segment in self._segments if segment > number]
+            # read under lock, so _limit_size does not delete the segment meanwhile
+            return next(iter(self._batches(later[0], 0)), None) if later else None
+
+    def _publish_batch(self, publish, batch):
+        topic, payload, records, end, number = batch
+        self._attempt = (number, end, records)
+        publish(topic, payload)
+        if self.offline:
+            logger.info("Publishing works again, publishing new messages right away")
+            self.offline = False
+        # remember the progress, a failed flush continues after the last published message
+        self._offset = (number, end)
+        self._failures = 0
+        self.flushed += len(records)
+        time.sleep(self.flush_interval)
+
+    def _batches(self, number, start):
+        """
+            Yields the messages to publish from the byte offset start of a segment on,
+            as (topic, payload, spooled records, end offset, segment).
+        """
+        topic, records, payloads, size, end = None, [], [], COALESCE_OVERHEAD, start
+        with open(self._path(number), "rb") as file:
+            file.seek(start)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    # the last record is incomplete after a crash, or while it is being written
+                    break
+                try:
+                    record = json.loads(line.decode())
+                except ValueError:
+                    # the last record of a segment can be incomplete after a crash
+                    logger.warning("Skipping corrupt record in spool segment %d", number)
+                    end += len(line)
+                    continue
+                isolated = self._isolate is not None and self._isolate[0] == number and end < self._isolate[1]
+                payload = record.get("payload", "")
+                if payloads and ("data" in record or record["topic"] != topic or isolated
+                                 or len(payloads) >= self.flush_batch
+                                 or size + len(payload.encode()) + 1 > self.max_message_bytes):
+                    yield topic, self._coalesce(payloads), records, end, number
+                    records, payloads, size = [], [], COALESCE_OVERHEAD
+                end += len(line)
+                if "data" in record:
+                    yield record["topic"], base64.b64decode(record["data"]), [line], end, number
+                    continue
+                topic = record["topic"]
+                records.append(line)
+                payloads.append(payload)
+                size += len(payload.encode()) + 1
+        if payloads:
+            yield topic, self._coalesce(payloads), records, end, number
+
+    def _coalesce(self, payloads):
+        """
+            Returns the message of a list of JSON payloads. A single payload which would exceed
+            max_message_bytes when coalesced is returned as it is.
+        """
+        message = coalesce(payloads)
+        if len(payloads) == 1 and len(message.encode()) > self.max_message_bytes:
+            return payloads[0]
+        return message
+
+    def _count_failure(self):
+        """
+            Counts a failed publish of the current batch. Retries its messages one at a time, or
+            marks it as suspect if it is a single message, once it failed max_attempts times.
+        """
+        if self._attempt is None:
+            return
+        number, end, records = self._attempt
+        if self._suspect is not None:
+            if self._suspect != (number, end):
+                logger.warning("Publishing fails for other spooled messages as well, retrying all of them")
+                self._suspect = None
+            return
+        if self._failed_at != (number, end):
+            self._failed_at, self._failures = (number, end), 0
+        self._failures += 1
+        if self._failures < self.max_attempts:
+            return
+        self._failures = 0
+        if len(records) > 1:
+            logger.warning("Spooled batch of %d messages failed %d times, retrying them one at a time",
+                           len(records), self.max_attempts)
+            self._isolate = (number, end)
+        else:
+            self._suspect = (number, end)
+
+    def _dead_letter(self, record):
+        logger.error("Spooled message failed %d times, moving it to %s", self.max_attempts, DEAD_LETTER_FILE)
+        path = os.path.join(self.directory, DEAD_LETTER_FILE)
+        if os.path.exists(path) and os.path.getsize(path) + len(record) > self.segment_bytes:
+            # keeps the recent dead letters, at most two files of segment_bytes
+            os.replace(path, path + ".1")
+        with open(path, "ab") as file:
+            file.write(record)
+        self._suspect = None
+        self.dead_lettered += 1
+
+
+def create_spool(directory=SPOOL_DIR):
+    """
+        Returns the Spool in directory, or None if spooling is disabled.
+    """
+    return Spool(directory) if directory else None
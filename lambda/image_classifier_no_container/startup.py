@@ -0,0 +1,142 @@
+"""
+Cold start profiling and warm-up of the image classifier functions.
+
+The functions are pinned, so they are started once when the core starts and then
+handle all requests. Importing the machine learning library, loading the model and
+the first inferences (graph tracing, memory allocation, kernel selection) are slow.
+This module measures each of these steps and runs synthetic inferences at every
+batch size the micro-batcher can produce while the function is initialized, so the
+first real request runs at steady state speed.
+
+The startup report is logged and published once on the metrics topic. The latency of
+the first request is logged as well, to compare it with the warmed up inferences.
+
+This module is imported before all other modules of a function, so the time spent
+importing them is measured as well. Keep its own imports light.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from batching import BATCH_MAX_SIZE
+from metrics import METRICS_TOPIC
+
+logger = logging.getLogger()
+
+# batch sizes to warm up: "all" for every batch size up to BATCH_MAX_SIZE and the largest
+# batch of a multi-image request, a comma separated list like "1,8", or "none" to skip the warm-up
+WARMUP_BATCH_SIZES = os.getenv("WARMUP_BATCH_SIZES", "all")
+# synthetic inferences per batch size, the first one is usually much slower than the others
+WARMUP_ITERATIONS = int(os.getenv("WARMUP_ITERATIONS", "2"))
+
+# when this module was imported, which is before the other modules of the function
+STARTED = time.perf_counter()
+
+
+def warmup_batch_sizes(setting=WARMUP_BATCH_SIZES, max_batch_size=BATCH_MAX_SIZE, fixed_batch_size=None,
+                       larger_batch_sizes=()):
+    """
+        Returns the batch sizes to warm up. A model with a fixed batch size only runs batches of that size.
+        larger_batch_sizes are batches above max_batch_size the model runs as well, like the images of
+        a multi-image request which always run in one batch.
+    """
+    setting = setting.strip().lower()
+    if setting in ("", "none", "0"):
+        return []
+    if fixed_batch_size:
+        return [fixed_batch_size]
+    if setting == "all":
+        larger = {size for size in larger_batch_sizes if size and size > max_batch_size}
+        return list(range(1, max_batch_size + 1)) + sorted(larger)
+    return sorted({int(size) for size in setting.split(",")})
+
+
+class StartupProfiler:
+    """
+        Measures the steps of the function initialization in milliseconds.
+    """
+
+    def __init__(self, started=STARTED):
+        self.started = started
+        self.steps = {}
+        self.warm_up = {}
+        self.first_request = None
+        self._last = started
+        self._lock = threading.Lock()
+
+    def mark(self, step):
+        """
+            Records the time since the previous step as duration of step.
+        """
+        now = time.perf_counter()
+        self.steps[step] = round((now - self._last) * 1000, 1)
+        self._last = now
+
+    @contextmanager
+    def step(self, step):
+        """
+            Records the duration of the enclosed block as duration of step.
+        """
+        self._last = time.perf_counter()
+        yield
+        self.mark(step)
+
+    def request_completed(self, seconds):
+        """
+            Logs the latency of the first request after the start, later requests are ignored.
+        """
+        with self._lock:
+            if self.first_request is not None:
+                return
+            self.first_request = round(seconds * 1000, 1)
+        logger.info("First request completed in %.1f ms after warm-up inferences of %s ms",
+                    self.first_request, self.warm_up)
+
+    def report(self):
+        return {
+            "total_ms": round((self._last - self.started) * 1000, 1),
+            "steps_ms": dict(self.steps),
+            # duration of the last warm-up inference per batch size
+            "warm_up_ms": dict(self.warm_up),
+            "first_request_ms": self.first_request,
+        }
+
+
+def warm_up(profiler, run_batch, img_size, batch_sizes, iterations=WARMUP_ITERATIONS):
+    """
+        Runs batches of blank images through run_batch, which takes a list of prepared images.
+        The very first inference is recorded as its own step.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    if not batch_sizes:
+        return
+    image = np.zeros((img_size, img_size, 3), dtype=np.uint8)
+    with profiler.step("first_inference"):
+        run_batch([image] * batch_sizes[0])
+    with profiler.step("warm_up"):
+        for batch_size in batch_sizes:
+            for _ in range(iterations):
+                start = time.perf_counter()
+                run_batch([image] * batch_size)
+                profiler.warm_up[batch_size] = round((time.perf_counter() - start) * 1000, 1)
+
+
+def report_startup(profiler, publish, topic=METRICS_TOPIC, fields=None):
+    """
+        Logs the startup report and publishes it with publish(topic, payload).
+    """
+    report = dict(fields or {})
+    report["startup"] = profiler.report()
+    payload = json.dumps(report, separators=(",", ":"))
+    logger.info("Startup: %s", payload)
+    if not topic:
+        return
+    try:
+        publish(topic, payload)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Could not publish startup report")
@@ -0,0 +1,313 @@
+"""
+Continuous classification of a camera stream.
+
+Instead of one MQTT request per image, a function can read frames from a long-running
+source set with STREAM_SOURCE:
+
+- an MJPEG stream over HTTP(S) (multipart/x-mixed-replace), as served by most IP cameras
+- a local directory, new image files are picked up in the order of their names
+
+A reader thread thins out the frames (STREAM_FRAME_SKIP, STREAM_FPS) and puts them into
+a small queue. When inference falls behind, the oldest queued frame is dropped, so
+results stay close to real time instead of lagging further and further behind. A
+worker thread takes the next frame from the queue whenever the function has capacity
+for another frame.
+
+NOTE: This module is shared by all image classifier functions. Keep the copies in
+lambda/image_classifier_* identical.
+"""
+import http.client
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+from collections import deque, namedtuple
+from batching import BATCH_MAX_SIZE
+from download import DOWNLOAD_TIMEOUT
+from ingestion import MAX_IMAGE_BYTES, read_limited
+
+logger = logging.getLogger()
+
+# MJPEG URL or directory frames are read from, empty disables the stream
+STREAM_SOURCE = os.getenv("STREAM_SOURCE", "")
+# maximum number of frames per second classified, 0 classifies every frame
+STREAM_FPS = float(os.getenv("STREAM_FPS", "0"))
+# number of frames skipped after every frame classified
+STREAM_FRAME_SKIP = int(os.getenv("STREAM_FRAME_SKIP", "0"))
+# number of frames waiting for inference, the oldest frame is dropped when it is full
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "4"))
+# seconds to wait before reconnecting to a stream which failed or ended
+STREAM_RECONNECT_DELAY = float(os.getenv("STREAM_RECONNECT_DELAY", "5"))
+# what happens to a frame file once it is read: "keep", "delete" or the directory it is moved to
+STREAM_PROCESSED = os.getenv("STREAM_PROCESSED", "keep")
+# seconds between two checks of a frame directory for changes
+STREAM_POLL_INTERVAL = 0.05
+# seconds after which a frame directory is listed even if its modification time did not change
+STREAM_RESCAN_INTERVAL = 1.0
+# maximum length of a multipart header line
+MAX_HEADER_LINE = 1024
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# name identifies the frame in the result, received is the time.perf_counter() it was read
+Frame = namedtuple("Frame", ["name", "data", "received"])
+
+
+class FrameQueue:
+    """
+        Bounded queue of frames which drops the oldest frame instead of blocking the reader.
+    """
+
+    def __init__(self, maxsize=STREAM_QUEUE_SIZE):
+        self.maxsize = max(1, maxsize)
+        self.dropped = 0
+        self._frames = deque()
+        self._condition = threading.Condition()
+
+    def put(self, frame):
+        with self._condition:
+            if len(self._frames) >= self.maxsize:
+                self._frames.popleft()
+                self.dropped += 1
+            self._frames.append(frame)
+            self._condition.notify()
+
+    def get(self):
+        """
+            Returns the oldest frame, waits for one if the queue is empty.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._frames)
+            return self._frames.popleft()
+
+    def qsize(self):
+        return len(self._frames)
+
+
+def multipart_boundary(content_type):
+    """
+        Returns the boundary of a multipart content type as bytes.
+    """
+    for parameter in content_type.split(";")[1:]:
+        name, _, value = parameter.strip().partition("=")
+        if name.lower() == "boundary":
+            return value.strip('"').encode()
+    raise ValueError("No multipart boundary in content type {}".format(content_type))
+
+
+def read_multipart(stream, boundary, max_bytes=MAX_IMAGE_BYTES):
+    """
+        Yields the body of every part of a multipart stream. Parts with a Content-Length
+        header are read in one go, other parts are read up to the next boundary.
+    """
+    # some cameras already put the leading dashes into the boundary parameter
+    delimiters = (b"--" + boundary, boundary)
+    at_boundary = False
+    while True:
+        if not at_boundary:
+            line = stream.readline(MAX_HEADER_LINE)
+            if not line:
+                return
+            if line.strip() not in delimiters:
+                continue
+        headers = {}
+        while True:
+            line = stream.readline(MAX_HEADER_LINE)
+            if not line:
+                return
+            line = line.strip()
+            if not line:
+                break
+            name, _, value = line.partition(b":")
+            headers[name.strip().lower()] = value.strip()
+        length = headers.get(b"content-length")
+        if length:
+            yield bytes(read_limited(stream, max_bytes, int(length)))
+            at_boundary = False
+            continue
+        body = bytearray()
+        at_boundary = False
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            if line.strip() in delimiters:
+                at_boundary = True
+                break
+            body += line
+            if len(body) > max_bytes:
+                raise ValueError("Frame exceeds the maximum size of {} bytes".format(max_bytes))
+        # the line break before the boundary belongs to the boundary
+        if body.endswith(b"\r\n"):
+            del body[-2:]
+        yield bytes(body)
+
+
+def read_mjpeg(url, timeout=DOWNLOAD_TIMEOUT):
+    """
+        Yields the frames of an MJPEG stream as (name, data) until the stream ends.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "https":
+        connection = http.client.HTTPSConnection(parts.hostname, parts.port, timeout=timeout)
+    else:
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=timeout)
+    try:
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        connection.request("GET", path)
+        response = connection.getresponse()
+        if response.status != 200:
+            raise ValueError("Stream {} answered with status {}".format(url, response.status))
+        boundary = multipart_boundary(response.getheader("Content-Type", ""))
+        for index, data in enumerate(read_multipart(response, boundary)):
+            yield "{}#{}".format(url, index), data
+    finally:
+        connection.close()
+
+
+def dispose_frame(filename, processed=STREAM_PROCESSED):
+    """
+        Keeps, deletes or moves a frame file which was read, see STREAM_PROCESSED.
+    """
+    if processed == "keep":
+        return
+    try:
+        if processed == "delete":
+            os.remove(filename)
+        else:
+            shutil.move(filename, os.path.join(processed, os.path.basename(filename)))
+    except OSError:
+        logger.exception("Could not %s frame %s", "delete" if processed == "delete" else "move", filename)
+
+
+def read_directory(path, poll_interval=STREAM_POLL_INTERVAL, processed=STREAM_PROCESSED,
+                   rescan_interval=STREAM_RESCAN_INTERVAL):
+    """
+        Yields new image files in a directory as (name, data), in the order of their names.
+        Writers should create frames under a name starting with "." and rename them when complete.
+        The directory is only listed when its modification time changed, or after rescan_interval
+        in case a change fell into the same timestamp. Frames read are disposed of as set by processed.
+    """
+    if processed not in ("keep", "delete"):
+        os.makedirs(processed, exist_ok=True)
+    last = ""
+    modified = None
+    scanned = 0
+    while True:
+        stat = os.stat(path)
+        now = time.monotonic()
+        if stat.st_mtime_ns == modified and now - scanned < rescan_interval:
+            time.sleep(poll_interval)
+            continue
+        # take the modification time before listing, changes while listing are seen next time
+        modified, scanned = stat.st_mtime_ns, now
+        names = sorted(name for name in os.listdir(path)
+                       if name > last and not name.startswith(".")
+                       and name.lower().endswith(IMAGE_EXTENSIONS))
+        for name in names:
+            last = name
+            filename = os.path.join(path, name)
+            try:
+                with open(filename, "rb") as file:
+                    data = read_limited(file)
+            except (OSError, ValueError):
+                logger.exception("Could not read frame %s", filename)
+                continue
+            dispose_frame(filename, processed)
+            yield filename, bytes(data)
+
+
+def read_source(source):
+    """
+        Yields the frames of an MJPEG URL or a directory as (name, data).
+    """
+    if source.startswith(("http://", "https://")):
+        return read_mjpeg(source)
+    if source.startswith("file://"):
+        source = urllib.parse.urlsplit(source).path
+    return read_directory(source)
+
+
+class FrameStream:
+    """
+        Reads frames from a source and calls handle_frame(frame, done) for each frame classified.
+        handle_frame must call done() once the frame is finished, at most max_in_flight frames
+        are handled at a time.
+    """
+
+    def __init__(self, source, handle_frame, fps=STREAM_FPS, frame_skip=STREAM_FRAME_SKIP,
+                 queue_size=STREAM_QUEUE_SIZE, max_in_flight=BATCH_MAX_SIZE):
+        self.source = source
+        self.handle_frame = handle_frame
+        self.min_interval = 1.0 / fps if fps > 0 else 0
+        self.frame_skip = frame_skip
+        self.read = 0
+        self.skipped = 0
+        self._queue = FrameQueue(queue_size)
+        self._in_flight = threading.BoundedSemaphore(max(1, max_in_flight))
+        self._next_frame = 0
+        self._last_frame = None
+
+    def start(self):
+        for target, name in ((self._read_frames, "stream-reader"), (self._handle_frames, "stream-worker")):
+            threading.Thread(target=target, name=name, daemon=True).start()
+        logger.info("Classifying frames of %s", self.source)
+
+    def stats(self):
+        return {
+            "read": self.read,
+            "skipped": self.skipped,
+            "dropped": self._queue.dropped,
+            "queued": self._queue.qsize(),
+        }
+
+    def _read_frames(self):
+        while True:
+            try:
+                for name, data in read_source(self.source):
+                    self._offer(name, data)
+                logger.warning("Stream %s ended", self.source)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not read stream %s", self.source)
+            time.sleep(STREAM_RECONNECT_DELAY)
+
+    def _offer(self, name, data):
+        """
+            Queues a frame unless it is skipped to keep the configured frame rate.
+        """
+        now = time.perf_counter()
+        index = self.read
+        self.read += 1
+        if index < self._next_frame or \
+                (self._last_frame is not None and now - self._last_frame < self.min_interval):
+            self.skipped += 1
+            return
+        self._next_frame = index + 1 + self.frame_skip
+        self._last_frame = now
+        self._queue.put(Frame(name, data, now))
+
+    def _handle_frames(self):
+        while True:
+            # wait for capacity before taking a frame, meanwhile newer frames can push out queued ones
+            self._in_flight.acquire()
+            frame = self._queue.get()
+            try:
+                self.handle_frame(frame, self._in_flight.release)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Could not handle frame %s", frame.name)
+                self._in_flight.release()
+
+
+def start_stream(handle_frame, source=STREAM_SOURCE):
+    """
+        Starts classifying the frames of source, returns the FrameStream or None if no source is set.
+    """
+    if not source:
+        return None
+    stream = FrameStream(source, handle_frame)
+    stream.start()
+    return stream
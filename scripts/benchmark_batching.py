@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Measures the throughput vs. latency tradeoff of the micro-batching layer used by the
+image classifier lambdas for different maximum batch sizes.
+
+By default the model is simulated by a fixed per-call overhead plus a per-image cost,
+which is the shape of the CPU cost of MobileNet inference. Pass --saved-model to run a
+real Keras SavedModel instead (requires tensorflow).
+
+Example:
+    scripts/benchmark_batching.py --requests 512 --batch-sizes 1 4 8 16
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "image_classifier_container"))
+from batching import MicroBatcher  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def simulated_model(call_overhead_ms, per_image_ms):
+    """
+        Returns a run_batch function which sleeps like a model with the given cost.
+    """
+    def run_batch(images):
+        time.sleep((call_overhead_ms + per_image_ms * len(images)) / 1000.0)
+        return [0] * len(images)
+    return run_batch
+
+
+def saved_model(path, img_size):
+    """
+        Returns a run_batch function and an example input for a Keras SavedModel.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import tensorflow as tf  # pylint: disable=import-outside-toplevel
+    classifier = tf.keras.models.load_model(path)
+
+    def run_batch(images):
+        return list(np.argmax(classifier.predict(np.stack(images)), axis=-1))
+    # trace the model once so that graph building is not part of the measurement
+    example = np.random.rand(img_size, img_size, 3)
+    run_batch([example])
+    return run_batch, example
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(run_batch, example, batch_size, max_wait_ms, requests, producers, rate):
+    """
+        Submits requests from producer threads and returns throughput and latencies.
+        A rate of 0 submits as fast as possible (burst), otherwise requests/second in total.
+    """
+    # every request is measured, none is shed however long the queue gets
+    batcher = MicroBatcher(run_batch, max_batch_size=batch_size, max_wait_ms=max_wait_ms, max_pending=0)
+    latencies = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def callback_for(submitted):
+        def callback(_):
+            with lock:
+                latencies.append(time.monotonic() - submitted)
+                if len(latencies) == requests:
+                    done.set()
+        return callback
+
+    def produce(count):
+        interval = producers / rate if rate else 0
+        next_submit = time.monotonic()
+        for _ in range(count):
+            if interval:
+                next_submit += interval
+                time.sleep(max(0, next_submit - time.monotonic()))
+            batcher.submit(example, callback_for(time.monotonic()))
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=produce,
+                                args=(requests // producers + (1 if i < requests % producers else 0),))
+               for i in range(producers)]
+    for thread in threads:
+        thread.start()
+    done.wait()
+    elapsed = time.monotonic() - start
+    batcher.close()
+    return {
+        "batch_size": batch_size,
+        "throughput": requests / elapsed,
+        "p50": percentile(latencies, 50) * 1000,
+        "p95": percentile(latencies, 95) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--requests", type=int, default=256)
+    parser.add_argument("--producers", type=int, default=4,
+                        help="number of threads submitting requests")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="total requests per second, 0 submits all requests as a burst")
+    parser.add_argument("--call-overhead-ms", type=float, default=20,
+                        help="simulated fixed cost of a model call")
+    parser.add_argument("--per-image-ms", type=float, default=5,
+                        help="simulated cost per image in a batch")
+    parser.add_argument("--saved-model", help="path of a Keras SavedModel to benchmark instead")
+    parser.add_argument("--img-size", type=int, default=224)
+    args = parser.parse_args()
+
+    if args.saved_model:
+        run_batch, example = saved_model(args.saved_model, args.img_size)
+    else:
+        run_batch, example = simulated_model(args.call_overhead_ms, args.per_image_ms), None
+
+    print("{:>10} {:>14} {:>10} {:>10} {:>10}".format(
+        "batch size", "throughput/s", "p50 ms", "p95 ms", "p99 ms"))
+    for batch_size in args.batch_sizes:
+        stats = run(run_batch, example, batch_size, args.max_wait_ms,
+                    args.requests, args.producers, args.rate)
+        print("{batch_size:>10} {throughput:>14.1f} {p50:>10.1f} {p95:>10.1f} {p99:>10.1f}".format(**stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Measures how long gg_deployment_reset takes to find the Greengrass group of a core in
+an account with many groups, against a local stub of the Greengrass API.
+
+The stub serves --groups groups in pages of --page-size, answers every call after
+--latency-ms and throttles calls beyond --rate per second like the Greengrass API. The
+group of the core is placed at --position of the list. The lookup is measured with
+one worker (serial), with the given numbers of workers, and by group name. The lookup
+of the original function, which read only the first page serially, is measured for
+comparison.
+
+Requires boto3 and requests, the dependencies of the function.
+
+Example:
+    scripts/benchmark_group_lookup.py --groups 5000 --workers 4 16 32 --position last
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+os.environ.setdefault("STACK_NAME", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "cfn-util", "gg_deployment_reset"))
+from botocore.exceptions import ClientError  # noqa: E402 pylint: disable=wrong-import-position
+import index  # noqa: E402 pylint: disable=wrong-import-position
+
+ARN_PREFIX = "arn:aws:greengrass:us-east-1:123456789012:/greengrass/"
+THING_NAME = "benchmark_Core"
+
+
+class StubGreengrass:
+    """
+        Greengrass API with groups in memory, a fixed latency per call and a rate limit.
+    """
+
+    def __init__(self, groups, page_size, latency_ms, rate, position):
+        self.page_size = page_size
+        self.latency = latency_ms / 1000.0
+        self.rate = rate
+        self.calls = 0
+        self.throttled = 0
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        target = {"first": 0, "middle": groups // 2, "last": groups - 1}.get(position)
+        self.groups = []
+        self.cores = {}
+        for number in range(groups):
+            group_id = "group-{}".format(number)
+            self.groups.append({
+                "Id": group_id,
+                "Arn": ARN_PREFIX + "groups/" + group_id,
+                "Name": "benchmark" if number == target else "group_{}".format(number),
+                "LatestVersion": "v1",
+            })
+            self.cores[group_id] = THING_NAME if number == target else "core_{}".format(number)
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls += 1
+            if self.rate:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                throttled = self._tokens < 1
+                if throttled:
+                    self.throttled += 1
+                else:
+                    self._tokens -= 1
+        time.sleep(self.latency)
+        if self.rate and throttled:
+            raise ClientError({"Error": {"Code": "TooManyRequestsException", "Message": "Rate exceeded"}},
+                              operation)
+
+    def list_groups(self, NextToken=None):  # pylint: disable=invalid-name
+        self._call("ListGroups")
+        start = int(NextToken or 0)
+        response = {"Groups": self.groups[start:start + self.page_size]}
+        if start + self.page_size < len(self.groups):
+            response["NextToken"] = str(start + self.page_size)
+        return response
+
+    def get_group_version(self, GroupId, GroupVersionId):  # pylint: disable=invalid-name
+        self._call("GetGroupVersion")
+        return {"Definition": {"CoreDefinitionVersionArn": "{}definition/cores/{}/versions/{}".format(
+            ARN_PREFIX, GroupId, GroupVersionId)}}
+
+    def get_core_definition_version(self, CoreDefinitionId, CoreDefinitionVersionId):  # pylint: disable=invalid-name
+        self._call("GetCoreDefinitionVersion")
+        return {"Definition": {"Cores": [
+            {"ThingArn": "arn:aws:iot:us-east-1:123456789012:thing/" + self.cores[CoreDefinitionId]}]}}
+
+    def list_tags_for_resource(self, ResourceArn):  # pylint: disable=invalid-name
+        self._call("ListTagsForResource")
+        return {"tags": {}}
+
+
+def first_page_serial(thing_name):
+    """
+        The lookup of the original function: first page only, one group after the other.
+    """
+    for grp in index.greengrass.list_groups()["Groups"]:
+        if index.has_core(grp, thing_name):
+            return grp["Id"]
+    return None
+
+
+def measure(stub, lookup):
+    index.greengrass = stub
+    start = time.monotonic()
+    gid = lookup()
+    return {
+        "seconds": time.monotonic() - start,
+        "calls": stub.calls,
+        "throttled": stub.throttled,
+        "found": gid is not None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--page-size", type=int, default=50,
+                        help="groups per page of list_groups")
+    parser.add_argument("--latency-ms", type=float, default=30, help="latency of every API call")
+    parser.add_argument("--rate", type=float, default=100,
+                        help="API calls per second before calls are throttled, 0 never throttles")
+    parser.add_argument("--position", choices=["first", "middle", "last", "missing"], default="last",
+                        help="position of the group of the core in the list of groups")
+    parser.add_argument("--workers", type=int, nargs="+", default=[4, 16, 32])
+    parser.add_argument("--skip-serial", action="store_true",
+                        help="skip the serial lookup, which takes minutes for thousands of groups")
+    args = parser.parse_args()
+
+    def stub():
+        return StubGreengrass(args.groups, args.page_size, args.latency_ms, args.rate, args.position)
+
+    runs = [("first page, serial", lambda: first_page_serial(THING_NAME))]
+    if not args.skip_serial:
+        runs.append(("all pages, serial", lambda: index.find_first(index.list_groups(), THING_NAME, workers=1)))
+    for workers in args.workers:
+        runs.append(("{} workers".format(workers),
+                     lambda workers=workers: index.find_first(index.list_groups(), THING_NAME, workers=workers)))
+    runs.append(("by name", lambda: index.find_group(THING_NAME, group_name="benchmark")))
+
+    print("{} groups, group of the core at position {}".format(args.groups, args.position))
+    print("{:>20} {:>10} {:>8} {:>10} {:>6}".format("lookup", "seconds", "calls", "throttled", "found"))
+    for name, lookup in runs:
+        stats = measure(stub(), lookup)
+        print("{:>20} {seconds:>10.2f} {calls:>8} {throttled:>10} {found!s:>6}".format(name, **stats))
+
+
+if __name__ == "__main__":
+    main()
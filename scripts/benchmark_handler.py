@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Offline load test of an image classifier function.
+
+Imports the app.py of a function with a stubbed greengrasssdk IoT client, serves
+images from a local HTTP server and drives lambda_handler at a configurable
+concurrency and request rate. Latency is measured from calling the handler until the
+result for the image is published. Throughput, p50/p95/p99 latency, peak RSS, the
+time spent importing app.py and loading the model and the startup report of the
+function (see startup.py) are written to a JSON file, so builds and function
+variants can be compared before a fleet rollout.
+
+The model is loaded by the backend configured for the function (see backends.py), so
+the machine learning library and a model directory (--model-dir) must be available.
+With --fake-model the model is replaced by a backend which only sleeps, to measure
+download, preprocessing, batching and publishing on their own.
+
+Every function variant is benchmarked in its own process, e.g.:
+    scripts/benchmark_handler.py --function container --model-dir model_package \\
+        --requests 500 --concurrency 4 --rate 50 --output results/container.json
+"""
+import argparse
+import http.server
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FUNCTIONS = {
+    "container": "image_classifier_container",
+    "no_container": "image_classifier_no_container",
+    "neo": "image_classifier_neo",
+}
+
+
+class StubIoTClient:
+    """
+        Records published messages instead of sending them to AWS IoT.
+    """
+
+    def __init__(self):
+        self.on_publish = None
+        self.messages = 0
+        self.bytes = 0
+
+    def publish(self, topic, payload):
+        self.messages += 1
+        self.bytes += len(payload)
+        if self.on_publish:
+            self.on_publish(topic, payload)
+
+
+def install_greengrasssdk_stub(client):
+    module = types.ModuleType("greengrasssdk")
+    module.client = lambda name: client
+    sys.modules["greengrasssdk"] = module
+
+
+def synthetic_images(count, width, height):
+    """
+        Returns JPEG images of the given size as bytes.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import PIL.Image as Image  # pylint: disable=import-outside-toplevel
+    images = []
+    random = np.random.RandomState(0)
+    for _ in range(count):
+        output = io.BytesIO()
+        pixels = random.randint(0, 255, (height // 8, width // 8, 3)).astype(np.uint8)
+        Image.fromarray(pixels).resize((width, height)).save(output, "JPEG", quality=90)
+        images.append(output.getvalue())
+    return images
+
+
+def serve_images(images):
+    """
+        Serves images as /<index>.jpg from a local HTTP server. Returns its base URL.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            name = self.path.split("?")[0].strip("/").split(".")[0]
+            if not name.isdigit() or int(name) >= len(images):
+                self.send_error(404)
+                return
+            body = images[int(name)]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_port)
+
+
+def install_fake_backend(call_overhead_ms, per_image_ms):
+    """
+        Replaces all inference backends with one which sleeps like a model.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+    import backends  # pylint: disable=import-outside-toplevel
+
+    class FakeBackend(backends.Backend):
+        def import_library(self):
+            return None
+
+        def load(self):
+            pass
+
+        def run(self, batch):
+            time.sleep((call_overhead_ms + per_image_ms * len(batch)) / 1000.0)
+            return np.zeros((len(batch), 1000), dtype=np.float32)
+
+    for name in list(backends.BACKENDS):
+        backends.BACKENDS[name] = FakeBackend
+
+
+def fake_model_dir():
+    directory = tempfile.mkdtemp(prefix="benchmark-model-")
+    with open(os.path.join(directory, "ImageNetLabels.txt"), "w") as file:
+        file.write("\n".join(["background"] + ["class {}".format(i) for i in range(1000)]))
+    return directory + os.sep
+
+
+def percentile_ms(values, pct):
+    """
+        Returns the percentile of durations in seconds as milliseconds.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))] * 1000
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def decode(payload):
+    """
+        Returns a published message, JSON or binary msgpack.
+    """
+    if isinstance(payload, bytes):
+        import msgpack  # pylint: disable=import-outside-toplevel
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+def drive(app, base_url, image_count, requests, concurrency, rate, timeout):
+    """
+        Calls lambda_handler from concurrency threads and waits for all results.
+    """
+    started = {}
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def on_publish(topic, payload):
+        message = decode(payload)
+        now = time.monotonic()
+        # coalesced messages carry several responses, see OUTPUT_MODE in coalescing.py
+        for response in message.get("responses", [message]):
+            with lock:
+                start = started.pop(response.get("image"), None)
+                if start is None:
+                    continue
+                if "Error" in response:
+                    errors.append(response["Error"])
+                else:
+                    latencies.append(now - start)
+                if len(latencies) + len(errors) == requests:
+                    done.set()
+
+    app.iot_client.on_publish = on_publish
+    counter = iter(range(requests))
+    counter_lock = threading.Lock()
+    begin = time.monotonic()
+
+    def worker():
+        while True:
+            with counter_lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            if rate:
+                time.sleep(max(0, begin + index / rate - time.monotonic()))
+            # a unique query string tells the results apart
+            url = "{}/{}.jpg?request={}".format(base_url, index % image_count, index)
+            with lock:
+                started[url] = time.monotonic()
+            app.lambda_handler({"image": url}, None)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    completed = done.wait(timeout)
+    elapsed = time.monotonic() - begin
+    return {
+        "completed": completed,
+        "results": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "duration_s": elapsed,
+        "throughput_per_s": len(latencies) / elapsed,
+        "latency_p50_ms": percentile_ms(latencies, 50),
+        "latency_p95_ms": percentile_ms(latencies, 95),
+        "latency_p99_ms": percentile_ms(latencies, 99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--function", choices=sorted(FUNCTIONS), default="container")
+    parser.add_argument("--model-dir", help="model package directory, sets MODEL_DIR of the function")
+    parser.add_argument("--fake-model", action="store_true",
+                        help="replace the model by a backend which only sleeps")
+    parser.add_argument("--fake-call-overhead-ms", type=float, default=20)
+    parser.add_argument("--fake-per-image-ms", type=float, default=5)
+    parser.add_argument("--images", type=int, default=16, help="number of distinct images served")
+    parser.add_argument("--image-size", default="1280x720", help="WIDTHxHEIGHT of the served images")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of threads calling lambda_handler")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="total requests per second, 0 sends requests as fast as possible")
+    parser.add_argument("--cache", action="store_true",
+                        help="keep the result cache enabled, by default every request runs inference")
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="seconds to wait for all results")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    function_dir = os.path.join(ROOT, "lambda", FUNCTIONS[args.function])
+    output = os.path.abspath(args.output) if args.output else None
+    if args.model_dir:
+        os.environ["MODEL_DIR"] = os.path.join(os.path.abspath(args.model_dir), "")
+    elif args.fake_model:
+        os.environ["MODEL_DIR"] = fake_model_dir()
+    os.environ.setdefault("AWS_GG_RESOURCE_PREFIX", tempfile.gettempdir())
+    if not args.cache:
+        os.environ["CACHE_MAX_ENTRIES"] = "0"
+    width, height = (int(v) for v in args.image_size.split("x"))
+
+    client = StubIoTClient()
+    install_greengrasssdk_stub(client)
+    sys.path.insert(0, function_dir)
+    # the Neo function loads its labels from the working directory
+    os.chdir(function_dir)
+    if args.fake_model:
+        install_fake_backend(args.fake_call_overhead_ms, args.fake_per_image_ms)
+
+    import backends  # pylint: disable=import-outside-toplevel
+    model_load = {}
+    create_backend = backends.create_backend
+
+    def timed_create_backend(*create_args, **create_kwargs):
+        start = time.monotonic()
+        backend = create_backend(*create_args, **create_kwargs)
+        model_load["seconds"] = time.monotonic() - start
+        return backend
+    backends.create_backend = timed_create_backend
+
+    start = time.monotonic()
+    import app  # pylint: disable=import-outside-toplevel
+    import_time = time.monotonic() - start
+
+    base_url = serve_images(synthetic_images(args.images, width, height))
+    stats = drive(app, base_url, args.images, args.requests, args.concurrency,
+                  args.rate, args.timeout)
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+
+    results = {
+        "function": args.function,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "import_s": import_time,
+        "model_load_s": model_load.get("seconds"),
+        "peak_rss_bytes": peak_rss,
+        "startup": app.profiler.report(),
+        "published_messages": client.messages,
+        "published_bytes": client.bytes,
+    }
+    results.update(stats)
+    print(json.dumps(results, indent=2))
+    if output:
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    # the function keeps its worker threads running, do not wait for them
+    os._exit(0 if stats["completed"] else 1)  # pylint: disable=protected-access
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Measures the messages and bytes published per 1,000 inferences by the image classifier
+lambdas for the output modes in coalescing.py: one JSON message per response, and
+coalesced messages encoded as compact JSON or msgpack (requires msgpack).
+
+Responses are built like the responses of the lambdas, from random model scores over
+the ImageNet labels, for a stream of camera frames. AWS IoT meters messages in 5 KB
+steps, so the billed messages are reported as well.
+
+Example:
+    scripts/benchmark_output.py --inferences 1000 --window-counts 10 100 --top-k 5
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container")
+LABELS = os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_neo", "ImageNetLabels.txt")
+sys.path.insert(0, LAMBDA_DIR)
+from coalescing import Coalescer  # noqa: E402 pylint: disable=wrong-import-position
+from postprocessing import Postprocessor, load_labels  # noqa: E402 pylint: disable=wrong-import-position
+
+FUNCTION_ARN = "arn:aws:lambda:eu-west-1:123456789012:function:image_classifier_container:1"
+TOPIC = "gg_ml_sample/out"
+# size of a metered AWS IoT message
+BILLING_BYTES = 5 * 1024
+
+
+def responses(count, top_k, stream):
+    """
+        Returns count responses as published by the lambdas.
+    """
+    postprocessor = Postprocessor(load_labels(LABELS), k=top_k, apply_softmax=True)
+    scores = np.random.default_rng(0).normal(size=(count, len(postprocessor.labels))) * 3
+    return [dict({"image": "{}#{}".format(stream, index), "function": FUNCTION_ARN}, **result)
+            for index, result in enumerate(postprocessor(scores))]
+
+
+def measure(payloads, inferences):
+    """
+        Returns messages, bytes and billed messages per 1,000 inferences.
+    """
+    scale = 1000.0 / inferences
+    return {
+        "messages": len(payloads) * scale,
+        "bytes": sum(len(payload) for payload in payloads) * scale,
+        "billed": sum(math.ceil(len(payload) / BILLING_BYTES) for payload in payloads) * scale,
+    }
+
+
+def coalesced(data, encoding, window_count, max_bytes):
+    """
+        Returns the messages published for data by a Coalescer.
+    """
+    payloads = []
+    coalescer = Coalescer(lambda topic, payload: payloads.append(payload), {"function": FUNCTION_ARN},
+                          encoding=encoding, window_count=window_count, max_bytes=max_bytes)
+    for response in data:
+        coalescer.add(TOPIC, response)
+    coalescer.flush()
+    return payloads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--inferences", type=int, default=1000)
+    parser.add_argument("--window-counts", type=int, nargs="+", default=[10, 100],
+                        help="responses per coalesced message")
+    parser.add_argument("--max-bytes", type=int, default=128 * 1024,
+                        help="maximum size of a coalesced message")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--stream", default="http://camera.local/video.mjpg",
+                        help="image name of the responses, the frame number is appended")
+    args = parser.parse_args()
+
+    data = responses(args.inferences, args.top_k, args.stream)
+    rows = [("json", "-", measure([json.dumps(response) for response in data], args.inferences))]
+    for encoding in ("json", "msgpack"):
+        for window_count in args.window_counts:
+            try:
+                payloads = coalesced(data, encoding, window_count, args.max_bytes)
+            except ImportError:
+                print("msgpack is not installed, skipping the msgpack encoding", file=sys.stderr)
+                break
+            rows.append(("coalesced " + encoding, window_count, measure(payloads, args.inferences)))
+
+    print("per 1,000 inferences")
+    print("{:>18} {:>7} {:>10} {:>12} {:>8} {:>10}".format(
+        "mode", "window", "messages", "bytes", "billed", "bytes/inf"))
+    for mode, window_count, stats in rows:
+        print("{:>18} {:>7} {messages:>10.1f} {bytes:>12.0f} {billed:>8.1f} {per_inference:>10.1f}".format(
+            mode, window_count, per_inference=stats["bytes"] / 1000.0, **stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Compares the image preprocessing of the classifier lambdas against the original
+implementation (full resolution decode, generic resize, float64 normalization).
+
+Reports the mean time and the bytes allocated by Python/NumPy per stage. Allocations
+made inside the native Pillow decoder are not visible to tracemalloc.
+
+Example:
+    scripts/benchmark_preprocessing.py --image camera-frame.jpg --layout NCHW
+"""
+import argparse
+import io
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import PIL.Image as Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "image_classifier_container"))
+from preprocessing import LAYOUT_NCHW, LAYOUT_NHWC, Preprocessor  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def synthetic_jpeg(width, height):
+    """
+        Returns the bytes of a JPEG image with some structure, so it compresses like a photo.
+    """
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+    noise = np.random.RandomState(0).randint(0, 32, (height, width, 3))
+    pixels = np.stack([x + 0 * y, y + 0 * x, (x + y) / 2], axis=-1) + noise
+    output = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(output, "JPEG", quality=90)
+    return output.getvalue()
+
+
+def original_stages(data, size, layout):
+    """
+        The preprocessing as originally implemented in the lambda functions.
+    """
+    state = {}
+
+    def decode():
+        state["image"] = Image.open(io.BytesIO(data))
+        state["image"].load()
+
+    def resize():
+        state["image"] = state["image"].resize((size, size))
+
+    def normalize():
+        state["array"] = np.array(state["image"])/255.0
+
+    def to_layout():
+        image = state["array"]
+        if layout == LAYOUT_NCHW:
+            image = np.moveaxis(image, 2, 0)
+        # the models copy non contiguous float64 input into a contiguous float32 tensor
+        state["batch"] = np.ascontiguousarray(image[np.newaxis, ...], dtype=np.float32)
+
+    return [("decode", decode), ("resize", resize), ("normalize", normalize), ("layout", to_layout)]
+
+
+def optimized_stages(data, size, layout, resample):
+    preprocessor = Preprocessor(size, layout, resample)
+    # allocate the batch buffer once, as in a running function
+    preprocessor.to_batch([np.zeros((size, size, 3), dtype=np.uint8)])
+    state = {}
+
+    def decode():
+        state["image"] = preprocessor.decode(data)
+
+    def resize():
+        state["array"] = preprocessor.resize(state["image"])
+
+    def normalize():
+        state["batch"] = preprocessor.to_batch([state["array"]])
+
+    return [("decode", decode), ("resize", resize), ("normalize+layout", normalize)]
+
+
+def measure(stages, iterations):
+    """
+        Returns mean milliseconds and allocated bytes per stage.
+    """
+    timings = {name: 0.0 for name, _ in stages}
+    allocations = {name: 0 for name, _ in stages}
+    for _ in range(iterations):
+        for name, stage in stages:
+            start = time.perf_counter()
+            stage()
+            timings[name] += time.perf_counter() - start
+    # allocations are measured in a separate pass, tracing slows down the stages
+    for name, stage in stages:
+        tracemalloc.start()
+        stage()
+        allocations[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return [(name, timings[name] / iterations * 1000, allocations[name]) for name, _ in stages]
+
+
+def report(title, results):
+    print(title)
+    for name, millis, allocated in results:
+        print("  {:<18} {:>9.2f} ms {:>12,d} bytes".format(name, millis, allocated))
+    print("  {:<18} {:>9.2f} ms {:>12,d} bytes".format(
+        "total", sum(r[1] for r in results), sum(r[2] for r in results)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="JPEG image to use, defaults to a synthetic 1920x1080 frame")
+    parser.add_argument("--size", type=int, default=224)
+    parser.add_argument("--layout", choices=[LAYOUT_NHWC, LAYOUT_NCHW], default=LAYOUT_NHWC)
+    parser.add_argument("--resample", default="BILINEAR")
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.image:
+        with open(args.image, "rb") as file:
+            data = file.read()
+    else:
+        data = synthetic_jpeg(1920, 1080)
+
+    report("original", measure(original_stages(data, args.size, args.layout), args.iterations))
+    report("optimized ({}, {})".format(args.layout, args.resample),
+           measure(optimized_stages(data, args.size, args.layout, args.resample), args.iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Deploys the latest version (or --group-version) of many Greengrass groups in waves.
+
+scripts/create_deployment.sh deploys a single group and polls its status every 5
+seconds. This tool rolls out to any number of groups: the groups are split into waves
+of --wave-size groups, and up to --concurrency groups of a wave are deployed at the
+same time through one shared Greengrass client. The deployment status is polled
+with a backoff from --poll-min to --poll-max seconds, so short deployments are
+noticed quickly and long ones do not flood the API. Once more than --max-failures
+of the groups of a wave failed, the groups of the wave which did not start yet and
+all later waves are skipped, while the deployments already started are waited for.
+A summary with the status and the deployment time of every group is printed at the end.
+
+Groups are given by name, or by --prefix for all groups whose name starts with it.
+--stub deploys to a local stand-in of the Greengrass API with --stub-groups groups
+named group_<n>, to try out the rollout without an AWS account.
+
+Requires boto3.
+
+Examples:
+    scripts/deploy_groups.py gg_ml_sample
+    scripts/deploy_groups.py --prefix plant1_ --wave-size 20 --concurrency 10 --max-failures 0.1
+    scripts/deploy_groups.py --prefix group_ --stub --stub-groups 200 --wave-size 50
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+RUNNING = ("Building", "InProgress")
+
+
+class StubGreengrass:
+    """
+        Greengrass API with groups in memory whose deployments take a random time and fail at fail_rate.
+    """
+
+    def __init__(self, groups, deploy_seconds, fail_rate, latency_ms=30):
+        self.deploy_seconds = deploy_seconds
+        self.fail_rate = fail_rate
+        self.latency = latency_ms / 1000.0
+        self.calls = 0
+        self.groups = [{"Id": uuid.uuid4().hex, "Name": "group_{}".format(number), "LatestVersion": "1"}
+                       for number in range(groups)]
+        self.deployments = {}
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def list_groups(self, NextToken=None):  # pylint: disable=invalid-name
+        self._call()
+        start = int(NextToken or 0)
+        response = {"Groups": self.groups[start:start + 50]}
+        if start + 50 < len(self.groups):
+            response["NextToken"] = str(start + 50)
+        return response
+
+    def create_deployment(self, GroupId, GroupVersionId, DeploymentType):  # pylint: disable=invalid-name
+        self._call()
+        deployment_id = uuid.uuid4().hex
+        duration = random.uniform(0.5, 1.5) * self.deploy_seconds
+        self.deployments[deployment_id] = (time.monotonic() + duration, random.random() < self.fail_rate)
+        return {"DeploymentId": deployment_id}
+
+    def get_deployment_status(self, GroupId, DeploymentId):  # pylint: disable=invalid-name
+        self._call()
+        done_at, fails = self.deployments[DeploymentId]
+        if time.monotonic() < done_at:
+            return {"DeploymentStatus": "InProgress"}
+        if fails:
+            return {"DeploymentStatus": "Failure", "ErrorMessage": "stub deployment failed"}
+        return {"DeploymentStatus": "Success"}
+
+
+def list_groups(client):
+    """
+        Returns all groups, following the pagination of list_groups.
+    """
+    groups = []
+    kwargs = {}
+    while True:
+        response = client.list_groups(**kwargs)
+        groups.extend(response.get("Groups", []))
+        if not response.get("NextToken"):
+            return groups
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def deploy(client, group, version, poll_min, poll_max, timeout):
+    """
+        Deploys a group and waits for the deployment to finish. Returns the result of the group.
+    """
+    result = {"name": group["Name"], "polls": 0}
+    start = time.monotonic()
+    try:
+        deployment_id = client.create_deployment(
+            GroupId=group["Id"], GroupVersionId=version or group["LatestVersion"],
+            DeploymentType="NewDeployment")["DeploymentId"]
+        delay = poll_min
+        while True:
+            # full jitter keeps the polls of groups started together apart
+            time.sleep(random.uniform(0.5, 1.0) * delay)
+            response = client.get_deployment_status(GroupId=group["Id"], DeploymentId=deployment_id)
+            result["polls"] += 1
+            status = response["DeploymentStatus"]
+            if status not in RUNNING:
+                result["status"] = status
+                if status != "Success":
+                    result["error"] = response.get("ErrorMessage", "")
+                break
+            if time.monotonic() - start > timeout:
+                result["status"] = "Timeout"
+                break
+            delay = min(poll_max, delay * 1.5)
+    except Exception as error:  # pylint: disable=broad-except
+        result["status"] = "Error"
+        result["error"] = str(error)
+    result["seconds"] = time.monotonic() - start
+    return result
+
+
+def skipped(group):
+    return {"name": group["Name"], "status": "Skipped", "polls": 0, "seconds": 0.0}
+
+
+def roll_out(client, groups, args):
+    """
+        Deploys the groups wave by wave. Returns the results of all groups in their order,
+        groups which were not deployed after too many failures have the status Skipped.
+    """
+    results = {}
+    waves = [groups[start:start + args.wave_size] for start in range(0, len(groups), args.wave_size)]
+    stopped = False
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for number, wave in enumerate(waves, 1):
+            if stopped:
+                results.update((group["Id"], skipped(group)) for group in wave)
+                continue
+            started = time.monotonic()
+            allowed = args.max_failures * len(wave) if args.max_failures < 1 else args.max_failures
+            # groups beyond --concurrency wait in the executor until a deployment finished
+            futures = {executor.submit(deploy, client, group, args.group_version, args.poll_min,
+                                       args.poll_max, args.timeout): group for group in wave}
+            failures = 0
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                results[futures[future]["Id"]] = future.result()
+                if future.result()["status"] == "Success":
+                    continue
+                failures += 1
+                if failures > allowed and not stopped:
+                    stopped = True
+                    print("Stopping the rollout, {} of {} groups of wave {} failed".format(
+                        failures, len(wave), number), flush=True)
+                    for pending, group in futures.items():
+                        if pending.cancel():
+                            results[group["Id"]] = skipped(group)
+            print("wave {}/{}: {} groups, {} failed, {} skipped in {:.1f} s".format(
+                number, len(waves), len(wave), failures,
+                sum(future.cancelled() for future in futures), time.monotonic() - started), flush=True)
+    return [results[group["Id"]] for group in groups]
+
+
+def create_client(args):
+    import boto3  # pylint: disable=import-outside-toplevel
+    from botocore.config import Config  # pylint: disable=import-outside-toplevel
+    # one client for all threads, with a connection per thread and client side rate adaption when throttled
+    config = Config(max_pool_connections=args.concurrency, retries={"max_attempts": 10, "mode": "adaptive"})
+    return boto3.client("greengrass", region_name=args.region, config=config)
+
+
+def at_least_one(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return number
+
+
+def not_negative(value):
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("must not be negative")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("groups", nargs="*", help="names of the groups")
+    parser.add_argument("--prefix", help="deploy all groups whose name starts with the prefix")
+    parser.add_argument("--group-version", help="group version to deploy, defaults to the latest of each group")
+    parser.add_argument("--wave-size", type=at_least_one, default=10, help="number of groups per wave")
+    parser.add_argument("--concurrency", type=at_least_one, default=10,
+                        help="number of groups deployed at the same time")
+    parser.add_argument("--max-failures", type=not_negative, default=0,
+                        help="failed groups tolerated per wave, as number or as fraction of the wave if below 1")
+    parser.add_argument("--poll-min", type=float, default=1, help="seconds before the first status poll")
+    parser.add_argument("--poll-max", type=float, default=15, help="maximum seconds between two status polls")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds after which a deployment is given up")
+    parser.add_argument("--region", default=os.getenv("AWS_DEFAULT_REGION"))
+    parser.add_argument("--stub", action="store_true", help="deploy to a local stand-in of the Greengrass API")
+    parser.add_argument("--stub-groups", type=int, default=100)
+    parser.add_argument("--stub-deploy-seconds", type=float, default=5)
+    parser.add_argument("--stub-fail-rate", type=float, default=0)
+    args = parser.parse_args()
+    if not args.groups and not args.prefix:
+        parser.error("either group names or --prefix are required")
+
+    if args.stub:
+        client = StubGreengrass(args.stub_groups, args.stub_deploy_seconds, args.stub_fail_rate)
+    else:
+        client = create_client(args)
+    start = time.monotonic()
+    available = list_groups(client)
+    if args.prefix:
+        groups = [group for group in available if group["Name"].startswith(args.prefix)]
+    else:
+        by_name = {group["Name"]: group for group in available}
+        missing = [name for name in args.groups if name not in by_name]
+        if missing:
+            sys.exit("No group named {}".format(", ".join(missing)))
+        groups = [by_name[name] for name in args.groups]
+    if not groups:
+        sys.exit("No groups to deploy")
+    print("Deploying {} groups in waves of {}, {} at a time".format(len(groups), args.wave_size, args.concurrency))
+
+    results = roll_out(client, groups, args)
+    print()
+    print("{:<40} {:<10} {:>9} {:>6}  {}".format("group", "status", "seconds", "polls", "error"))
+    for result in results:
+        print("{name:<40} {status:<10} {seconds:>9.1f} {polls:>6}  {error}".format(
+            **dict({"error": ""}, **result)))
+    succeeded = sum(result["status"] == "Success" for result in results)
+    seconds = sorted(result["seconds"] for result in results if result["status"] != "Skipped") or [0.0]
+    print("{} of {} groups deployed, {} skipped, median {:.1f} s, slowest {:.1f} s, total {:.1f} s".format(
+        succeeded, len(groups), sum(result["status"] == "Skipped" for result in results),
+        seconds[len(seconds) // 2], seconds[-1], time.monotonic() - start))
+    if args.stub:
+        print("stub: {} API calls".format(client.calls))
+    if succeeded < len(groups):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
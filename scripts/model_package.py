@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Content-addressed model packages for delta updates of the cores.
+
+pack splits a model package (a directory with the layout of /models/image_classifier/
+or a model-package.tar.gz) into chunks of up to --chunk-size bytes per file and
+writes them to a local store directory, each compressed and named by the SHA-256 of its
+content, with a manifest of the version. Chunks which are already in the store are not
+written again, so a new version of the weights adds only the chunks which changed,
+while the labels and the dependencies tree are shared with the previous version.
+Upload the store e.g. with "aws s3 sync <store> s3://<bucket>/<prefix>".
+
+update installs a version from a store into a model directory like the function does
+with MODEL_UPDATE_URL (see lambda/image_classifier_container/model_update.py), to
+try it out or to update a core from a shell.
+
+report compares two versions of a store: the bytes a core with the first version
+fetches to update to the second, against the download of the full package.
+
+Examples:
+    scripts/model_package.py pack model-package.tar.gz --store store --version v1
+    scripts/model_package.py pack model_package_v2 --store store --version v2
+    scripts/model_package.py report store --from v1 --to v2
+    scripts/model_package.py update s3://bucket/models/image_classifier --model-dir /models/image_classifier
+"""
+import argparse
+import hashlib
+import json
+import os
+import stat
+import sys
+import tarfile
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from model_update import (MANIFEST_FILE, MANIFEST_FORMAT, ChunkStore, ModelUpdater, UpdateError,  # noqa: E402
+                          checked_path, chunk_hash, is_within, read_chunks)
+
+# chunk size in bytes, smaller chunks share more unchanged data but need more requests
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+def write_object(store, key, data):
+    """
+        Writes data to the object key of a local store. Returns False if the object already exists.
+    """
+    path = os.path.join(store, key)
+    if os.path.exists(path):
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as file:
+        file.write(data)
+    os.replace(path + ".tmp", path)
+    return True
+
+
+def pack(source_dir, store, version, chunk_size, package_bytes):
+    """
+        Writes the chunks and the manifest of the files in source_dir to store. Returns the manifest
+        and the number of chunks and bytes added to the store.
+    """
+    files = []
+    stored = {}
+    added_chunks = added_bytes = 0
+    for root, directories, names in os.walk(source_dir):
+        directories.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, source_dir)
+            if relative == MANIFEST_FILE:
+                continue
+            if os.path.islink(path):
+                target = os.readlink(path)
+                if os.path.isabs(target) or not is_within(source_dir, os.path.join(root, target)):
+                    raise SystemExit("Link {} -> {} points outside of {}".format(relative, target, source_dir))
+                files.append({"path": relative, "link": target})
+                continue
+            entry = {"path": relative, "size": os.path.getsize(path),
+                     "mode": stat.S_IMODE(os.stat(path).st_mode), "chunks": [], "sizes": []}
+            for data in read_chunks(path, chunk_size):
+                digest = chunk_hash(data)
+                entry["chunks"].append(digest)
+                entry["sizes"].append(len(data))
+                if digest not in stored:
+                    compressed = zlib.compress(data, 6)
+                    stored[digest] = len(compressed)
+                    if write_object(store, "chunks/" + digest, compressed):
+                        added_chunks += 1
+                        added_bytes += len(compressed)
+            files.append(entry)
+    if not files:
+        raise SystemExit("No files found in {}".format(source_dir))
+    if not version:
+        listing = json.dumps([[entry["path"], entry.get("chunks"), entry.get("link")] for entry in files])
+        version = hashlib.sha256(listing.encode()).hexdigest()[:12]
+    manifest = {"format": MANIFEST_FORMAT, "version": version, "chunk_size": chunk_size,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "package_bytes": package_bytes or sum(stored.values()), "files": files, "chunks": stored}
+    return manifest, added_chunks, added_bytes
+
+
+def compare(old, new):
+    """
+        Returns the number of chunks and bytes a core with the old manifest fetches for the new one.
+    """
+    present = set()
+    if old and old["chunk_size"] == new["chunk_size"]:
+        present = {digest for entry in old["files"] for digest in entry.get("chunks", [])}
+    missing = set(new["chunks"]) - present
+    return len(missing), sum(new["chunks"][digest] for digest in missing)
+
+
+def print_transfer(label, fetched_bytes, package_bytes):
+    print("{:<28} {:>14,} bytes".format(label, fetched_bytes))
+    print("{:<28} {:>14,} bytes".format("full package download", package_bytes))
+    if package_bytes:
+        print("{:<28} {:>13.1f} %".format("transferred", 100.0 * fetched_bytes / package_bytes))
+
+
+def extract(package, directory):
+    """
+        Extracts the tar archive package into directory. Raises SystemExit for links, device files
+        and other special members, and for members which would be written outside of directory.
+    """
+    with tarfile.open(package) as archive:
+        members = archive.getmembers()
+        for member in members:
+            if not (member.isfile() or member.isdir()):
+                raise SystemExit("{} of {} is not a regular file or directory".format(member.name, package))
+            # the ./ entry of an archive of a whole directory is the directory itself
+            if member.isdir() and os.path.normpath(os.path.join(directory, member.name)) == directory:
+                continue
+            try:
+                checked_path(directory, member.name)
+            except UpdateError:
+                raise SystemExit("{} of {} points outside of the package".format(member.name, package))
+            # no setuid, setgid or sticky bits in the model
+            member.mode &= 0o777
+        archive.extractall(directory, members)
+
+
+def run_pack(args):
+    package_bytes = 0
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source = args.source
+        if os.path.isfile(source):
+            package_bytes = os.path.getsize(source)
+            extract(source, temp_dir)
+            source = temp_dir
+        manifest, added_chunks, added_bytes = pack(source, args.store, args.version, args.chunk_size,
+                                                   package_bytes)
+    previous = None
+    if os.path.exists(os.path.join(args.store, "latest.json")):
+        previous = ChunkStore(args.store).manifest()
+    data = json.dumps(manifest, indent=1).encode()
+    if not write_object(args.store, "manifests/{}.json".format(manifest["version"]), data):
+        raise SystemExit("Version {} already exists in {}".format(manifest["version"], args.store))
+    if not args.no_latest:
+        with open(os.path.join(args.store, "latest.json"), "wb") as file:
+            file.write(data)
+
+    print("version {}: {} files, {} chunks, {} chunks ({:,} bytes) added to {}".format(
+        manifest["version"], len(manifest["files"]), len(manifest["chunks"]), added_chunks, added_bytes,
+        args.store))
+    if previous:
+        chunks, fetched_bytes = compare(previous, manifest)
+        print_transfer("update from {} ({} chunks)".format(previous["version"], chunks), fetched_bytes,
+                       manifest["package_bytes"])
+
+
+def run_report(args):
+    store = ChunkStore(args.store)
+    new = store.manifest(args.to_version)
+    old = store.manifest(args.from_version) if args.from_version else None
+    chunks, fetched_bytes = compare(old, new)
+    print("{} -> {}: {} of {} chunks missing".format(
+        old["version"] if old else "nothing", new["version"], chunks, len(new["chunks"])))
+    print_transfer("delta update", fetched_bytes, new["package_bytes"])
+
+
+def run_update(args):
+    updater = ModelUpdater(ChunkStore(args.store), args.model_dir, workers=args.workers, keep=args.keep)
+    report = updater.update(args.version)
+    if report is None:
+        print("Version {} is already installed in {}".format(updater.installed_version(), args.model_dir))
+        return
+    print("version {}: {} files, fetched {} of {} chunks in {:.1f} s".format(
+        report["version"], report["files"], report["fetched_chunks"], report["chunks"], report["seconds"]))
+    print_transfer("delta update", report["fetched_bytes"], report["package_bytes"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    pack_parser = commands.add_parser("pack", help="add a model package to a local store")
+    pack_parser.add_argument("source", help="model directory or tar.gz model package")
+    pack_parser.add_argument("--store", required=True, help="local store directory")
+    pack_parser.add_argument("--version", help="version of the package, defaults to a hash of its content")
+    pack_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    pack_parser.add_argument("--no-latest", action="store_true", help="do not make it the latest version")
+    pack_parser.set_defaults(run=run_pack)
+    report_parser = commands.add_parser("report", help="compare the transfer of two versions")
+    report_parser.add_argument("store", help="store URL or directory")
+    report_parser.add_argument("--from", dest="from_version", help="installed version, none if omitted")
+    report_parser.add_argument("--to", dest="to_version", help="new version, defaults to the latest")
+    report_parser.set_defaults(run=run_report)
+    update_parser = commands.add_parser("update", help="install a version into a model directory")
+    update_parser.add_argument("store", help="store URL or directory")
+    update_parser.add_argument("--model-dir", required=True)
+    update_parser.add_argument("--version", help="version to install, defaults to the latest")
+    update_parser.add_argument("--workers", type=int, default=4)
+    update_parser.add_argument("--keep", type=int, default=1, help="previous versions to keep")
+    update_parser.set_defaults(run=run_update)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Creates or deletes many AWS IoT things at once, each with a key, a certificate and a
+policy like the thing of the core created by the stack (see
+lambda/cfn-util/gg_create_thing/index.py).
+
+Things are provisioned by --workers threads, and the IoT API calls of all threads are
+limited to --rate calls per second. Throttled calls are retried with backoff. The
+progress of all things is written to the --state file every second and at the end.
+The file holds the certificates and private keys, so it is only readable by its
+owner. If a run fails for some things, run the same command again. Things which are done are
+skipped, and partly provisioned things are resumed without creating a second
+certificate. Delete removes the things from the state file.
+
+--stub runs against an in-memory stand-in of the IoT API kept in the given file. It
+has --stub-latency-ms per call, throttles calls beyond --stub-rate and fails
+--stub-fail-rate of the calls, to try out the tool without an AWS account.
+
+Requires boto3 and requests, the dependencies of the function.
+
+Examples:
+    scripts/provision_fleet.py create --prefix plant1_core --count 200 --state plant1.json
+    scripts/provision_fleet.py delete --prefix plant1_core --count 200 --state plant1.json
+    scripts/provision_fleet.py create --prefix test --count 100 --state /tmp/fleet.json \\
+        --stub /tmp/iot.json --stub-fail-rate 0.05
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "cfn-util", "gg_create_thing"))
+import boto3  # noqa: E402 pylint: disable=wrong-import-position
+from botocore.exceptions import ClientError  # noqa: E402 pylint: disable=wrong-import-position
+import index  # noqa: E402 pylint: disable=wrong-import-position
+
+CERTIFICATE_ARN = "arn:aws:iot:us-east-1:123456789012:cert/"
+# minimum seconds between two saves of the state file during a run
+SAVE_INTERVAL = 1.0
+
+
+class StubIoT:
+    """
+        In-memory stand-in of the IoT API calls used by gg_create_thing, persisted to a JSON file.
+    """
+
+    def __init__(self, path, latency_ms, rate, fail_rate):
+        self.path = path
+        self.latency = latency_ms / 1000.0
+        self.rate = rate
+        self.fail_rate = fail_rate
+        self.calls = 0
+        self.throttled = 0
+        self.failed = 0
+        self._tokens = rate
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        self.data = {"things": {}, "certificates": {}, "policies": {}}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.data = json.load(file)
+
+    def save(self):
+        with self._lock:
+            with open(self.path, "w") as file:
+                json.dump(self.data, file)
+
+    def _call(self, operation):
+        with self._lock:
+            self.calls += 1
+            if self.rate:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._refilled) * self.rate)
+                self._refilled = now
+                if self._tokens < 1:
+                    self.throttled += 1
+                    raise self._error("ThrottlingException", operation)
+                self._tokens -= 1
+            if random.random() < self.fail_rate:
+                self.failed += 1
+                raise self._error("ServiceUnavailableException", operation)
+        time.sleep(self.latency)
+
+    @staticmethod
+    def _error(code, operation):
+        return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+    def _thing(self, name, operation):
+        thing = self.data["things"].get(name)
+        if thing is None:
+            raise self._error("ResourceNotFoundException", operation)
+        return thing
+
+    def _certificate(self, arn, operation):
+        certificate = self.data["certificates"].get(arn.split("/")[-1])
+        if certificate is None:
+            raise self._error("ResourceNotFoundException", operation)
+        return certificate
+
+    def create_thing(self, thingName):  # pylint: disable=invalid-name
+        self._call("CreateThing")
+        with self._lock:
+            self.data["things"].setdefault(thingName, {"principals": []})
+        return {"thingName": thingName}
+
+    def create_keys_and_certificate(self, setAsActive):  # pylint: disable=invalid-name
+        self._call("CreateKeysAndCertificate")
+        certificate_id = uuid.uuid4().hex
+        with self._lock:
+            self.data["certificates"][certificate_id] = {
+                "status": "ACTIVE" if setAsActive else "INACTIVE", "policies": []}
+        return {"certificateId": certificate_id, "certificateArn": CERTIFICATE_ARN + certificate_id,
+                "certificatePem": "-----BEGIN CERTIFICATE-----", "keyPair": {"PrivateKey": "-----BEGIN RSA"}}
+
+    def create_policy(self, policyName, policyDocument):  # pylint: disable=invalid-name
+        self._call("CreatePolicy")
+        with self._lock:
+            if policyName in self.data["policies"]:
+                raise self._error("ResourceAlreadyExistsException", "CreatePolicy")
+            self.data["policies"][policyName] = policyDocument
+
+    def attach_policy(self, policyName, target):  # pylint: disable=invalid-name
+        self._call("AttachPolicy")
+        with self._lock:
+            policies = self._certificate(target, "AttachPolicy")["policies"]
+            if policyName not in policies:
+                policies.append(policyName)
+
+    def attach_thing_principal(self, thingName, principal):  # pylint: disable=invalid-name
+        self._call("AttachThingPrincipal")
+        with self._lock:
+            principals = self._thing(thingName, "AttachThingPrincipal")["principals"]
+            if principal not in principals:
+                principals.append(principal)
+
+    def list_thing_principals(self, thingName):  # pylint: disable=invalid-name
+        self._call("ListThingPrincipals")
+        with self._lock:
+            return {"principals": list(self._thing(thingName, "ListThingPrincipals")["principals"])}
+
+    def detach_thing_principal(self, thingName, principal):  # pylint: disable=invalid-name
+        self._call("DetachThingPrincipal")
+        with self._lock:
+            principals = self._thing(thingName, "DetachThingPrincipal")["principals"]
+            if principal in principals:
+                principals.remove(principal)
+
+    def detach_policy(self, policyName, target):  # pylint: disable=invalid-name
+        self._call("DetachPolicy")
+        with self._lock:
+            policies = self._certificate(target, "DetachPolicy")["policies"]
+            if policyName in policies:
+                policies.remove(policyName)
+
+    def update_certificate(self, certificateId, newStatus):  # pylint: disable=invalid-name
+        self._call("UpdateCertificate")
+        with self._lock:
+            self._certificate(certificateId, "UpdateCertificate")["status"] = newStatus
+
+    def delete_certificate(self, certificateId, forceDelete):  # pylint: disable=invalid-name
+        self._call("DeleteCertificate")
+        with self._lock:
+            self._certificate(certificateId, "DeleteCertificate")
+            del self.data["certificates"][certificateId]
+
+    def delete_policy(self, policyName):  # pylint: disable=invalid-name
+        self._call("DeletePolicy")
+        with self._lock:
+            if self.data["policies"].pop(policyName, None) is None:
+                raise self._error("ResourceNotFoundException", "DeletePolicy")
+
+    def delete_thing(self, thingName):  # pylint: disable=invalid-name
+        self._call("DeleteThing")
+        with self._lock:
+            if self.data["things"].pop(thingName, None) is None:
+                raise self._error("ResourceNotFoundException", "DeleteThing")
+
+    def describe_endpoint(self, endpointType):  # pylint: disable=invalid-name
+        self._call("DescribeEndpoint")
+        return {"endpointAddress": "stub-ats.iot.us-east-1.amazonaws.com"}
+
+
+class StateFile:
+    """
+        Per-thing progress in a JSON file only readable by its owner, saved during and after a run.
+        The workers change the state under lock, so it is serialized under lock as well.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved = 0
+        self.data = {"things": {}}
+        if os.path.exists(path):
+            with open(path) as file:
+                self.data = json.load(file)
+
+    def save(self, force=False):
+        """
+            Writes the state, unless it was written less than SAVE_INTERVAL seconds ago and not force.
+        """
+        if not force and time.monotonic() - self.saved < SAVE_INTERVAL:
+            return
+        # written under lock as well, so an older snapshot never replaces a newer one
+        with self.lock:
+            self.saved = time.monotonic()
+            data = json.dumps(self.data, indent=1)
+            # a new file, created with mode 0o600, a leftover temporary file could be readable by others
+            fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                             suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                with open(fd, "w") as file:
+                    file.write(data)
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+
+
+def thing_names(args):
+    if args.names:
+        return args.names
+    return ["{}_{}".format(args.prefix, number) for number in range(args.start, args.start + args.count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=["create", "delete"])
+    parser.add_argument("--names", nargs="+", help="names of the things")
+    parser.add_argument("--prefix", help="prefix of the thing names, followed by a number")
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--start", type=int, default=0, help="number of the first thing")
+    parser.add_argument("--state", required=True, help="JSON file with the progress, certificates and keys")
+    parser.add_argument("--workers", type=int, default=index.PROVISION_WORKERS)
+    parser.add_argument("--rate", type=float, default=index.API_RATE,
+                        help="maximum IoT API calls per second, 0 is unlimited")
+    parser.add_argument("--stub", help="use an in-memory IoT API kept in this file instead of AWS")
+    parser.add_argument("--stub-latency-ms", type=float, default=50)
+    parser.add_argument("--stub-rate", type=float, default=20)
+    parser.add_argument("--stub-fail-rate", type=float, default=0)
+    args = parser.parse_args()
+    if not args.names and not args.prefix:
+        parser.error("either --names or --prefix is required")
+
+    stub = None
+    if args.stub:
+        stub = StubIoT(args.stub, args.stub_latency_ms, args.stub_rate, args.stub_fail_rate)
+    client = index.RateLimitedClient(stub or boto3.client("iot"), args.rate)
+    state = StateFile(args.state)
+    things = state.data["things"]
+    names = thing_names(args)
+
+    def on_result(name, _, error):
+        with state.lock:
+            if error is None:
+                if args.action == "create":
+                    things[name]["status"] = "created"
+                else:
+                    things.pop(name, None)
+            else:
+                things.setdefault(name, {})["error"] = str(error)
+        state.save()
+
+    def on_progress(_, step):
+        # the private key is only returned once, it is saved soon after
+        if step == "certificate" and args.action == "create":
+            state.save()
+
+    start = time.monotonic()
+    try:
+        if args.action == "create":
+            if "iotEndpoint" not in state.data:
+                state.data["iotEndpoint"] = client.describe_endpoint(endpointType="iot:Data-ATS")["endpointAddress"]
+            pending = [name for name in names if things.get(name, {}).get("status") != "created"]
+            for name in pending:
+                things.get(name, {}).pop("error", None)
+            results = index.provision_things(client, pending, things, args.workers, on_result,
+                                             on_progress, state.lock)
+        else:
+            pending = names
+            results = index.deprovision_things(client, pending, things, args.workers, on_result,
+                                               lock=state.lock)
+    finally:
+        # also saves the progress of an interrupted run
+        state.save(force=True)
+        if stub:
+            stub.save()
+    elapsed = time.monotonic() - start
+
+    failed = {name: result for name, result in results.items() if isinstance(result, Exception)}
+    for name in names:
+        if name in failed:
+            status = "failed: {}".format(failed[name])
+        elif name in results:
+            status = "created" if args.action == "create" else "deleted"
+        else:
+            status = "skipped, already created"
+        print("{:<30} {}".format(name, status))
+    print("{} things, {} done, {} failed, {} skipped in {:.1f} s".format(
+        len(names), len(results) - len(failed), len(failed), len(names) - len(results), elapsed))
+    if stub:
+        print("stub: {} calls, {} throttled, {} failed, {} things, {} certificates, {} policies".format(
+            stub.calls, stub.throttled, stub.failed, len(stub.data["things"]),
+            len(stub.data["certificates"]), len(stub.data["policies"])))
+    if failed:
+        print("Run the same command again to retry the failed things")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Post-training INT8 quantization of the image classifier model.
+
+Converts the Keras SavedModel of a model package (as created by
+notebooks/01-Create-deployment-package.ipynb) into a fully INT8 quantized Tensorflow
+Lite model. A small set of local images is used to calibrate the quantization ranges.
+The output directory has the layout of /models/image_classifier/ on the core and can
+be used with INFERENCE_BACKEND=tflite:
+
+    <output>/model.tflite
+    <output>/ImageNetLabels.txt
+
+With --package the output is also written as tar.gz archive which can be uploaded
+and referenced by the ML resource in template.yaml.
+
+Afterwards the quantized model is compared against the float model on the evaluation
+images: top-1/top-5 agreement, model size and p50/p99 latency. The report is printed
+and written to <output>/quantization_report.json.
+
+Example:
+    scripts/quantize_model.py --model-dir model_package --calibration-dir calibration_images \\
+        --output-dir model_package_int8 --package model-package-int8.tar.gz
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from backends import TFLITE_MODEL_FILE, KerasBackend, TFLiteBackend  # noqa: E402
+from preprocessing import Preprocessor  # noqa: E402
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+def load_images(directory, preprocessor, limit):
+    """
+        Returns the preprocessed images found in directory as list of float32 HWC arrays.
+    """
+    names = sorted(name for name in os.listdir(directory)
+                   if name.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    if not names:
+        raise SystemExit("No images found in {}".format(directory))
+    images = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as file:
+            loaded = preprocessor.load(file.read())
+        images.append(preprocessor.to_batch([loaded])[0].copy())
+    return images
+
+
+def quantize(saved_model_dir, calibration_images, integer_io):
+    """
+        Returns the INT8 quantized Tensorflow Lite model as bytes.
+    """
+    import tensorflow as tf  # pylint: disable=import-outside-toplevel
+
+    def representative_dataset():
+        for image in calibration_images:
+            yield [image[np.newaxis, ...]]
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    # fail instead of silently falling back to float kernels
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    if integer_io:
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+    return converter.convert()
+
+
+def directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def top_k(scores, k):
+    return np.argsort(scores, axis=-1)[:, ::-1][:, :k]
+
+
+def latency(backend, image, iterations):
+    """
+        Returns p50 and p99 latency in milliseconds of single image inference.
+    """
+    batch = image[np.newaxis, ...]
+    backend.run(batch)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        backend.run(batch)
+        timings.append((time.perf_counter() - start) * 1000)
+    return float(np.percentile(timings, 50)), float(np.percentile(timings, 99))
+
+
+def compare(model_dir, output_dir, images, iterations, num_threads):
+    """
+        Returns the report comparing the float SavedModel with the quantized model.
+    """
+    float_backend = KerasBackend(model_dir)
+    float_backend.load()
+    int8_backend = TFLiteBackend(output_dir, num_threads=num_threads)
+    int8_backend.load()
+
+    float_scores = np.concatenate([float_backend.run(image[np.newaxis, ...]) for image in images])
+    int8_scores = np.concatenate([int8_backend.run(image[np.newaxis, ...]) for image in images])
+    float_top5 = top_k(float_scores, 5)
+    int8_top5 = top_k(int8_scores, 5)
+    float_p50, float_p99 = latency(float_backend, images[0], iterations)
+    int8_p50, int8_p99 = latency(int8_backend, images[0], iterations)
+    return {
+        "images": len(images),
+        # share of images where the quantized model predicts the same top-1 class
+        "top1_agreement": float(np.mean(float_top5[:, 0] == int8_top5[:, 0])),
+        # share of images where the float top-1 class is within the quantized top-5
+        "top5_agreement": float(np.mean([f[0] in q for f, q in zip(float_top5, int8_top5)])),
+        "float": {
+            "size_bytes": directory_size(os.path.join(model_dir, "saved_model")),
+            "latency_p50_ms": float_p50,
+            "latency_p99_ms": float_p99,
+        },
+        "int8": {
+            "size_bytes": directory_size(os.path.join(output_dir, TFLITE_MODEL_FILE)),
+            "latency_p50_ms": int8_p50,
+            "latency_p99_ms": int8_p99,
+        },
+    }
+
+
+def print_report(report):
+    print("Compared on {} images".format(report["images"]))
+    print("  top-1 agreement: {:.1%}".format(report["top1_agreement"]))
+    print("  top-5 agreement: {:.1%}".format(report["top5_agreement"]))
+    print("  {:<6} {:>14} {:>10} {:>10}".format("model", "size bytes", "p50 ms", "p99 ms"))
+    for name in ("float", "int8"):
+        model = report[name]
+        print("  {:<6} {:>14,d} {:>10.2f} {:>10.2f}".format(
+            name, model["size_bytes"], model["latency_p50_ms"], model["latency_p99_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model-dir", required=True,
+                        help="model package directory containing saved_model/ and ImageNetLabels.txt")
+    parser.add_argument("--calibration-dir", required=True,
+                        help="directory with images representative for the deployment")
+    parser.add_argument("--eval-dir", help="images to compare the models on, defaults to the calibration images")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--calibration-images", type=int, default=200,
+                        help="maximum number of calibration images used")
+    parser.add_argument("--integer-io", action="store_true",
+                        help="also quantize model input and output instead of keeping them float32")
+    parser.add_argument("--img-size", type=int, default=224)
+    parser.add_argument("--iterations", type=int, default=100, help="inferences per latency measurement")
+    parser.add_argument("--num-threads", type=int, default=1,
+                        help="threads used by Tensorflow Lite during the latency measurement")
+    parser.add_argument("--package", help="also write the output directory as .tar.gz to this file")
+    parser.add_argument("--with-dependencies", action="store_true",
+                        help="add the dependencies/ directory of the model package to --package")
+    args = parser.parse_args()
+
+    preprocessor = Preprocessor(args.img_size)
+    calibration_images = load_images(args.calibration_dir, preprocessor, args.calibration_images)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    print("Quantizing with {} calibration images".format(len(calibration_images)))
+    model = quantize(os.path.join(args.model_dir, "saved_model"), calibration_images, args.integer_io)
+    with open(os.path.join(args.output_dir, TFLITE_MODEL_FILE), "wb") as file:
+        file.write(model)
+    shutil.copy(os.path.join(args.model_dir, "ImageNetLabels.txt"), args.output_dir)
+
+    eval_images = calibration_images
+    if args.eval_dir:
+        eval_images = load_images(args.eval_dir, preprocessor, None)
+    report = compare(args.model_dir, args.output_dir, eval_images, args.iterations, args.num_threads)
+    print_report(report)
+    with open(os.path.join(args.output_dir, "quantization_report.json"), "w") as file:
+        json.dump(report, file, indent=2)
+
+    if args.package:
+        with tarfile.open(args.package, "w:gz") as archive:
+            for name in (TFLITE_MODEL_FILE, "ImageNetLabels.txt"):
+                archive.add(os.path.join(args.output_dir, name), arcname=name)
+            if args.with_dependencies:
+                archive.add(os.path.join(args.model_dir, "dependencies"), arcname="dependencies")
+        print("Wrote model package {}".format(args.package))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Tests of the rollout of group deployments in waves (scripts/deploy_groups.py) against the stand-in
+of the Greengrass API of the script.
+"""
+import argparse
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+# pylint: disable=wrong-import-position
+import deploy_groups  # noqa: E402
+from deploy_groups import StubGreengrass, list_groups, roll_out  # noqa: E402
+
+
+def rollout_args(**kwargs):
+    values = {"group_version": None, "poll_min": 0.01, "poll_max": 0.05, "timeout": 10,
+              "wave_size": 10, "concurrency": 2, "max_failures": 0}
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def test_deploys_all_waves():
+    client = StubGreengrass(25, deploy_seconds=0.02, fail_rate=0, latency_ms=0)
+    results = roll_out(client, list_groups(client), rollout_args())
+    assert [result["name"] for result in results] == ["group_{}".format(number) for number in range(25)]
+    assert all(result["status"] == "Success" for result in results)
+
+
+def test_stops_within_the_wave_on_failures():
+    client = StubGreengrass(30, deploy_seconds=0.02, fail_rate=1, latency_ms=0)
+    results = roll_out(client, list_groups(client), rollout_args(max_failures=1))
+    statuses = [result["status"] for result in results]
+    # two failures exceed the threshold, the deployments which started by then finish,
+    # at most one per worker
+    assert 2 <= statuses.count("Failure") <= 2 + 2
+    assert statuses.count("Skipped") == 30 - statuses.count("Failure")
+    assert all(status == "Skipped" for status in statuses[10:])
+    assert len(client.deployments) == statuses.count("Failure")
+
+
+def test_rejects_invalid_arguments(monkeypatch, capsys):
+    for argument in (["--wave-size", "0"], ["--concurrency", "0"], ["--max-failures", "-1"]):
+        monkeypatch.setattr(sys, "argv", ["deploy_groups.py", "--stub", "--prefix", "group_"] + argument)
+        with pytest.raises(SystemExit):
+            deploy_groups.main()
+        assert argument[0] in capsys.readouterr().err
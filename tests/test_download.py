@@ -0,0 +1,183 @@
+"""
+Tests of the image downloads (lambda/image_classifier_container/download.py) against a local HTTP server.
+"""
+import http.server
+import os
+import sys
+import threading
+import time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from download import ConnectionPool, DownloadError, Downloader, Prefetcher  # noqa: E402
+from ingestion import ImageTooLargeError  # noqa: E402
+from scheduling import Overloaded  # noqa: E402
+
+IMAGE = b"\x89PNG" + bytes(range(256)) * 16
+
+
+class ImageServer(http.server.ThreadingHTTPServer):
+    """
+        Keep-alive HTTP server which records connections and requests.
+
+        /image answers with IMAGE, /slow does so after a delay, /flaky/<n>/<key> fails with 503
+        for the first n requests of key, /missing answers with 404.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.connections = 0
+        self.requests = {}
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            count = server.requests[self.path] = server.requests.get(self.path, 0) + 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            if self.path.startswith("/slow"):
+                time.sleep(0.1)
+            if self.path.startswith("/flaky/") and count <= int(self.path.split("/")[2]):
+                self.respond(503, b"busy")
+            elif self.path.startswith("/missing"):
+                self.respond(404, b"not found")
+            else:
+                self.respond(200, IMAGE)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    image_server = ImageServer()
+    thread = threading.Thread(target=image_server.serve_forever, daemon=True)
+    thread.start()
+    yield image_server
+    image_server.shutdown()
+    image_server.server_close()
+
+
+def test_connection_is_reused(server):
+    downloader = Downloader()
+    for _ in range(5):
+        assert downloader.fetch(server.url + "/image").data == IMAGE
+    assert server.requests["/image"] == 5
+    assert server.connections == 1
+    downloader.pool.close()
+
+
+def test_connections_are_reused_per_worker(server):
+    downloader = Downloader(pool=ConnectionPool(max_idle=2))
+    results = []
+    prefetcher = Prefetcher(lambda url: downloader.fetch(url).data, workers=2)
+    for number in range(20):
+        prefetcher.submit("{}/slow/{}".format(server.url, number), results.append)
+    prefetcher.close()
+    assert results == [IMAGE] * 20
+    assert server.connections <= 2
+
+
+def test_prefetcher_limits_concurrent_downloads(server):
+    downloader = Downloader()
+    results = []
+    prefetcher = Prefetcher(lambda url: downloader.fetch(url).data, workers=3)
+    for number in range(12):
+        prefetcher.submit("{}/slow/{}".format(server.url, number), results.append)
+    prefetcher.close()
+    assert len(results) == 12
+    assert server.max_active == 3
+
+
+def test_prefetcher_sheds_beyond_max_pending(server):
+    downloader = Downloader()
+    results = []
+    lock = threading.Lock()
+
+    def callback(result):
+        with lock:
+            results.append(result)
+
+    prefetcher = Prefetcher(lambda url: downloader.fetch(url).data, workers=1, max_pending=2)
+    for number in range(6):
+        prefetcher.submit("{}/slow/{}".format(server.url, number), callback)
+    prefetcher.close()
+    shed = [result for result in results if isinstance(result, Overloaded)]
+    assert len(results) == 6
+    assert shed and prefetcher.dropped()["shed"] == len(shed)
+
+
+def test_retries_server_errors(server):
+    downloader = Downloader(retries=2, backoff=0.01)
+    assert downloader.fetch(server.url + "/flaky/2/a").data == IMAGE
+    assert server.requests["/flaky/2/a"] == 3
+
+
+def test_gives_up_after_retries(server):
+    downloader = Downloader(retries=1, backoff=0.01)
+    with pytest.raises(DownloadError) as error:
+        downloader.fetch(server.url + "/flaky/5/b")
+    assert error.value.status == 503
+    assert server.requests["/flaky/5/b"] == 2
+
+
+def test_does_not_retry_client_errors(server):
+    downloader = Downloader(retries=2, backoff=0.01)
+    with pytest.raises(DownloadError) as error:
+        downloader.fetch(server.url + "/missing")
+    assert error.value.status == 404
+    assert server.requests["/missing"] == 1
+
+
+def test_rejects_large_images(server):
+    downloader = Downloader(max_bytes=100)
+    with pytest.raises(ImageTooLargeError):
+        downloader.fetch(server.url + "/image")
+
+
+def test_retries_unreachable_server():
+    downloader = Downloader(retries=1, backoff=0.01, timeout=1)
+    with pytest.raises(DownloadError):
+        # nothing listens on port 9 of the loopback interface
+        downloader.fetch("http://127.0.0.1:9/image")
+
+
+def test_prefetcher_passes_errors_to_callback(server):
+    downloader = Downloader(retries=0)
+    results = []
+    prefetcher = Prefetcher(lambda url: downloader.fetch(url).data, workers=2)
+    prefetcher.submit(server.url + "/missing", results.append)
+    prefetcher.submit(server.url + "/image", results.append)
+    prefetcher.close()
+    errors = [result for result in results if isinstance(result, DownloadError)]
+    assert len(errors) == 1 and errors[0].status == 404
+    assert IMAGE in results
@@ -0,0 +1,70 @@
+"""
+Tests of the extraction of model packages by scripts/model_package.py.
+"""
+import io
+import os
+import stat
+import sys
+import tarfile
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+# pylint: disable=wrong-import-position
+from model_package import extract  # noqa: E402
+
+
+def create_package(path, members):
+    """
+        Writes a tar archive with members, a list of (TarInfo, content) pairs.
+    """
+    with tarfile.open(path, "w:gz") as archive:
+        for member, content in members:
+            if content is not None:
+                member.size = len(content)
+                archive.addfile(member, io.BytesIO(content))
+            else:
+                archive.addfile(member)
+
+
+def info(name, kind=tarfile.REGTYPE, mode=0o644, link=""):
+    member = tarfile.TarInfo(name)
+    member.type = kind
+    member.mode = mode
+    member.linkname = link
+    return member
+
+
+def test_extracts_files_and_directories(tmp_path):
+    package = str(tmp_path / "model.tar.gz")
+    create_package(package, [
+        (info(".", tarfile.DIRTYPE, 0o755), None),
+        (info("./saved_model", tarfile.DIRTYPE, 0o755), None),
+        (info("./saved_model/saved_model.pb"), b"graph"),
+        (info("./run.sh", mode=0o4755), b"#!/bin/sh"),
+    ])
+    directory = str(tmp_path / "extracted")
+    os.mkdir(directory)
+    extract(package, directory)
+    with open(os.path.join(directory, "saved_model", "saved_model.pb"), "rb") as file:
+        assert file.read() == b"graph"
+    assert stat.S_IMODE(os.stat(os.path.join(directory, "run.sh")).st_mode) == 0o755
+
+
+@pytest.mark.parametrize("member", [
+    info("../outside.txt"),
+    info("/tmp/outside.txt"),
+    info("link", tarfile.SYMTYPE, link="/etc/passwd"),
+    info("hardlink", tarfile.LNKTYPE, link="../outside.txt"),
+    info("device", tarfile.CHRTYPE),
+    info("fifo", tarfile.FIFOTYPE),
+])
+def test_rejects_unsafe_members(tmp_path, member):
+    package = str(tmp_path / "model.tar.gz")
+    create_package(package, [(info("model.tflite"), b"model"),
+                             (member, b"x" if member.isfile() else None)])
+    directory = str(tmp_path / "extracted")
+    os.mkdir(directory)
+    with pytest.raises(SystemExit):
+        extract(package, directory)
+    assert os.listdir(directory) == []
+    assert not os.path.exists(str(tmp_path / "outside.txt"))
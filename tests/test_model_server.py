@@ -0,0 +1,134 @@
+"""
+Tests of the model server (lambda/image_classifier_container/model_server.py) with a model which
+records the batches it runs.
+"""
+import os
+import stat
+import sys
+import threading
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+import model_server  # noqa: E402
+from backends import Backend  # noqa: E402
+from model_server import ModelServer, ModelServerClient, ModelServerError, join_rows  # noqa: E402
+
+SHAPE = (4, 4, 3)
+
+
+class SumBackend(Backend):
+    """
+        Returns the sum of each image and its index within the batch as class scores.
+    """
+
+    def __init__(self, batch_size=None):
+        super().__init__("model")
+        self.batch_size = batch_size
+        self.batches = []
+
+    def import_library(self):
+        return None
+
+    def load(self):
+        pass
+
+    def run(self, batch):
+        self.batches.append(batch)
+        sums = batch.reshape(len(batch), -1).sum(axis=1)
+        return np.stack([sums, np.arange(len(batch), dtype=np.float32)], axis=1)
+
+
+def create_server(tmp_path, backend, **kwargs):
+    server = ModelServer({"model": backend}, str(tmp_path / "socket" / "model_server.sock"),
+                         max_batch_size=8, max_wait_ms=1, **kwargs)
+    server.start()
+    return server
+
+
+def create_client(server):
+    return ModelServerClient(server.path, "model", connect_timeout=1)
+
+
+def images(count, start=0):
+    return np.stack([np.full(SHAPE, start + number, dtype=np.float32) for number in range(count)])
+
+
+def test_shared_batch_is_run_in_place(tmp_path):
+    backend = SumBackend()
+    server = create_server(tmp_path, backend)
+    client = create_client(server)
+    batch = client.allocate((3,) + SHAPE)
+    batch[...] = images(3, start=1)
+    output = client.run(batch)
+    assert output[:, 0].tolist() == [48, 96, 144]
+    # the server ran the model on the memory mapped from the client, not on a copy of it
+    backend.batches[0][2, 0, 0, 0] = -1
+    assert batch[2, 0, 0, 0] == -1
+
+
+def test_join_rows_views_consecutive_rows():
+    batch = images(4)
+    assert np.shares_memory(join_rows(list(batch)), batch)
+    assert np.shares_memory(join_rows(list(batch[1:3])), batch)
+    joined = join_rows([batch[0], batch[2]])
+    assert not np.shares_memory(joined, batch)
+    assert joined[:, 0, 0, 0].tolist() == [0, 2]
+
+
+def test_fixed_batch_size_is_padded(tmp_path):
+    backend = SumBackend(batch_size=4)
+    server = create_server(tmp_path, backend)
+    output = create_client(server).run(images(6, start=1))
+    assert output[:, 0].tolist() == [48 * number for number in range(1, 7)]
+    assert [len(batch) for batch in backend.batches] == [4, 4]
+
+
+def test_client_is_thread_safe(tmp_path):
+    server = create_server(tmp_path, SumBackend())
+    client = create_client(server)
+    client.allocate((2,) + SHAPE)
+    errors = []
+
+    def classify(start):
+        try:
+            for _ in range(20):
+                # batches of other threads are copied into the same shared memory
+                output = client.run(images(2, start=start))
+                assert output[:, 0].tolist() == [48 * start, 48 * (start + 1)]
+        except Exception as error:  # pylint: disable=broad-except
+            errors.append(error)
+
+    threads = [threading.Thread(target=classify, args=(start,)) for start in range(0, 16, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_socket_is_only_accessible_to_the_group(tmp_path):
+    server = create_server(tmp_path, SumBackend())
+    assert stat.S_IMODE(os.stat(os.path.dirname(server.path)).st_mode) == 0o750
+    assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o660
+
+
+def test_rejects_world_writable_socket_directory(tmp_path):
+    directory = tmp_path / "socket"
+    directory.mkdir()
+    os.chmod(str(directory), 0o777)
+    with pytest.raises(ModelServerError):
+        create_server(tmp_path, SumBackend())
+
+
+def test_rejects_other_users(tmp_path, monkeypatch):
+    server = create_server(tmp_path, SumBackend())
+    monkeypatch.setattr(model_server, "peer_groups", lambda connection: (12345, {12345}))
+    with pytest.raises((ConnectionError, OSError)):
+        create_client(server).describe()
+    assert server.rejected == 2
+
+    monkeypatch.setattr(model_server, "peer_groups", lambda connection: (12345, {12345, 4242}))
+    server = create_server(tmp_path, SumBackend(), allowed_gids="4242")
+    assert create_client(server).describe()["layout"] == server.backends["model"].layout
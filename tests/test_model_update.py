@@ -0,0 +1,85 @@
+"""
+Tests of the delta updates of the model (lambda/image_classifier_container/model_update.py) from a
+chunk store in a local directory.
+"""
+import json
+import os
+import sys
+import zlib
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from model_update import MANIFEST_FORMAT, ChunkStore, ModelUpdater, UpdateError, chunk_hash  # noqa: E402
+
+CHUNK_SIZE = 16
+
+
+def write_store(store, version, files):
+    """
+        Writes a manifest of version to store. files maps each path to its content, or to ("link", target).
+    """
+    entries = []
+    os.makedirs(os.path.join(store, "chunks"), exist_ok=True)
+    os.makedirs(os.path.join(store, "manifests"), exist_ok=True)
+    for path, content in files.items():
+        if isinstance(content, tuple):
+            entries.append({"path": path, "link": content[1]})
+            continue
+        entry = {"path": path, "size": len(content), "chunks": [], "sizes": []}
+        for offset in range(0, len(content), CHUNK_SIZE):
+            data = content[offset:offset + CHUNK_SIZE]
+            entry["chunks"].append(chunk_hash(data))
+            entry["sizes"].append(len(data))
+            with open(os.path.join(store, "chunks", chunk_hash(data)), "wb") as file:
+                file.write(zlib.compress(data))
+        entries.append(entry)
+    manifest = {"format": MANIFEST_FORMAT, "version": version, "chunk_size": CHUNK_SIZE, "files": entries}
+    for name in ("latest.json", "manifests/{}.json".format(version)):
+        with open(os.path.join(store, name), "w") as file:
+            json.dump(manifest, file)
+
+
+def create_updater(tmp_path):
+    store = str(tmp_path / "store")
+    updater = ModelUpdater(ChunkStore(store), str(tmp_path / "models" / "model"), workers=2)
+    return store, updater
+
+
+def test_update(tmp_path):
+    store, updater = create_updater(tmp_path)
+    write_store(store, "v1", {"model.tflite": b"weights" * 10, "labels/names.txt": b"cat\ndog\n",
+                              "labels.txt": ("link", "labels/names.txt")})
+    report = updater.update()
+    assert report["version"] == "v1" and report["fetched_chunks"] == report["chunks"]
+    with open(os.path.join(updater.model_dir, "labels.txt"), "rb") as file:
+        assert file.read() == b"cat\ndog\n"
+
+    write_store(store, "v2", {"model.tflite": b"weights" * 10 + b"more", "labels/names.txt": b"cat\ndog\n"})
+    report = updater.update()
+    assert report["version"] == "v2" and report["fetched_chunks"] == 1
+    assert updater.installed_version() == "v2"
+    with open(os.path.join(updater.model_dir, "VERSION")) as file:
+        assert file.read() == "v2\n"
+
+
+@pytest.mark.parametrize("files", [
+    {"model.tflite": b"weights", "../../outside.txt": b"written"},
+    {"escape": ("link", "/"), "escape/outside.txt": b"written"},
+    {"escape": ("link", "../.."), "escape/outside.txt": b"written"},
+    # b/.. is within the model as a path, but the parent of the link b is outside of it
+    {"b": ("link", "."), "a": ("link", "b/.."), "a/outside.txt": b"written"},
+    {"VERSION": ("link", "../../outside.txt")},
+])
+def test_rejects_paths_outside_of_the_model(tmp_path, files):
+    store, updater = create_updater(tmp_path)
+    write_store(store, "v1", files)
+    with pytest.raises(UpdateError):
+        updater.update()
+    assert updater.installed_version() is None
+    assert not os.path.lexists(updater.model_dir)
+    outside = [os.path.join(root, name) for root, _, names in os.walk(str(tmp_path))
+               for name in names if name == "outside.txt"]
+    assert not outside
+    # staging is removed after the failed update
+    assert os.listdir(updater.versions_dir) == [".lock"]
@@ -0,0 +1,135 @@
+"""
+Tests of the bulk provisioning of things (lambda/cfn-util/gg_create_thing/index.py and
+scripts/provision_fleet.py) against the in-memory stand-in of the IoT API of the script.
+"""
+import json
+import os
+import random
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+# pylint: disable=wrong-import-position
+from provision_fleet import StateFile, StubIoT  # noqa: E402
+import index  # noqa: E402
+
+NAMES = ["core_{}".format(number) for number in range(40)]
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(index, "RETRY_BASE_DELAY", 0.001)
+    monkeypatch.setattr(index, "RETRY_MAX_DELAY", 0.1)
+    monkeypatch.setattr(index, "MAX_ATTEMPTS", 50)
+    random.seed(1)
+
+
+def create_stub(tmp_path, rate=0, fail_rate=0):
+    return StubIoT(str(tmp_path / "iot.json"), latency_ms=0, rate=rate, fail_rate=fail_rate)
+
+
+def assert_provisioned(stub, states, names):
+    assert sorted(stub.data["things"]) == sorted(names)
+    # one certificate per thing, none left over from failed attempts
+    assert len(stub.data["certificates"]) == len(names)
+    for name in names:
+        state = states[name]
+        certificate = stub.data["certificates"][state["certificateId"]]
+        assert certificate["status"] == "ACTIVE"
+        assert certificate["policies"] == [index.policy_name(name)]
+        assert stub.data["things"][name]["principals"] == [state["certificateArn"]]
+        assert state["privateKey"]
+
+
+def test_create(tmp_path):
+    stub = create_stub(tmp_path)
+    states = {}
+    results = index.provision_things(index.RateLimitedClient(stub, 0), NAMES, states, workers=8)
+    assert not [result for result in results.values() if isinstance(result, Exception)]
+    assert_provisioned(stub, states, NAMES)
+
+
+def test_resume_after_partial_run(tmp_path):
+    stub = create_stub(tmp_path, fail_rate=0.1)
+    states = {}
+    client = index.RateLimitedClient(stub, 0)
+    results = index.provision_things(client, NAMES, states, workers=8)
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    assert failed and stub.failed
+
+    stub.fail_rate = 0
+    results = index.provision_things(client, failed, states, workers=8)
+    assert not [result for result in results.values() if isinstance(result, Exception)]
+    assert_provisioned(stub, states, NAMES)
+
+
+def test_throttled_calls_are_retried(tmp_path):
+    stub = create_stub(tmp_path, rate=50)
+    states = {}
+    results = index.provision_things(index.RateLimitedClient(stub, 0), NAMES[:20], states, workers=8)
+    assert stub.throttled
+    assert not [result for result in results.values() if isinstance(result, Exception)]
+    assert_provisioned(stub, states, NAMES[:20])
+
+
+def test_rate_limit_avoids_throttling(tmp_path):
+    stub = create_stub(tmp_path, rate=50)
+    states = {}
+    index.provision_things(index.RateLimitedClient(stub, 25), NAMES[:6], states, workers=8)
+    assert stub.throttled == 0
+    assert_provisioned(stub, states, NAMES[:6])
+
+
+def test_deprovision(tmp_path):
+    stub = create_stub(tmp_path)
+    states = {}
+    client = index.RateLimitedClient(stub, 0)
+    index.provision_things(client, NAMES, states, workers=8)
+    # a certificate which is not recorded in the state is deleted as well
+    stub.attach_thing_principal(thingName=NAMES[0],
+                                principal=client.create_keys_and_certificate(setAsActive=True)["certificateArn"])
+
+    stub.fail_rate = 0.1
+    results = index.deprovision_things(client, NAMES, states, workers=8)
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    assert failed
+    stub.fail_rate = 0
+    results = index.deprovision_things(client, failed, states, workers=8)
+    assert not [result for result in results.values() if isinstance(result, Exception)]
+    assert stub.data == {"things": {}, "certificates": {}, "policies": {}}
+
+
+def test_state_is_saved_while_workers_run(tmp_path):
+    stub = create_stub(tmp_path)
+    state = StateFile(str(tmp_path / "state.json"))
+    things = state.data["things"]
+
+    def on_result(name, _, error):
+        assert error is None
+        with state.lock:
+            things[name]["status"] = "created"
+        state.save()
+
+    names = ["core_{}".format(number) for number in range(200)]
+    index.provision_things(index.RateLimitedClient(stub, 0), names, things, workers=32, on_result=on_result,
+                           on_progress=lambda name, step: state.save(), lock=state.lock)
+    state.save(force=True)
+    with open(str(tmp_path / "state.json")) as file:
+        saved = json.load(file)["things"]
+    assert all(saved[name]["status"] == "created" for name in names)
+    assert os.stat(str(tmp_path / "state.json")).st_mode & 0o777 == 0o600
+    assert_provisioned(stub, things, names)
+
+
+def test_state_is_private_despite_leftover_files(tmp_path):
+    path = str(tmp_path / "state.json")
+    # a state file and a temporary file left behind with modes readable by others
+    for leftover in (path, path + ".tmp"):
+        with open(leftover, "w") as file:
+            file.write("{\"things\": {}}")
+        os.chmod(leftover, 0o644)
+    state = StateFile(path)
+    state.data["things"]["core_0"] = {"status": "created", "keyPair": {"PrivateKey": "secret"}}
+    state.save(force=True)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert sorted(os.listdir(str(tmp_path))) == ["state.json", "state.json.tmp"]
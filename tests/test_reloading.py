@@ -0,0 +1,81 @@
+"""
+Tests of the model version and the swap of models with their labels
+(lambda/image_classifier_container/reloading.py).
+"""
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+import reloading  # noqa: E402
+from backends import Backend  # noqa: E402
+from reloading import MODEL_LABELS_FILE, ReloadingBackend, model_version  # noqa: E402
+
+
+class ConstantBackend(Backend):
+    """
+        Returns the same scores for every image.
+    """
+
+    def __init__(self, model_dir, scores=(0.1, 0.9)):
+        super().__init__(model_dir)
+        self.scores = np.array(scores, dtype=np.float32)
+
+    def import_library(self):
+        return None
+
+    def load(self):
+        pass
+
+    def run(self, batch):
+        return np.tile(self.scores, (len(batch), 1))
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def test_version_covers_model_files_only(tmp_path):
+    model_dir = str(tmp_path)
+    write(os.path.join(model_dir, "saved_model", "variables", "variables.index"), "index")
+    write(os.path.join(model_dir, "dependencies", "tensorflow", "__init__.py"), "")
+    version = model_version(model_dir)
+    assert version
+
+    write(os.path.join(model_dir, "dependencies", "numpy", "__init__.py"), "changed")
+    assert model_version(model_dir) == version
+    write(os.path.join(model_dir, "saved_model", "variables", "variables.index"), "new index")
+    assert model_version(model_dir) != version
+    version = model_version(model_dir)
+    write(os.path.join(model_dir, MODEL_LABELS_FILE), "background\ncat\ndog")
+    assert model_version(model_dir) != version
+
+
+def test_version_file(tmp_path):
+    write(str(tmp_path / "VERSION"), "7\n")
+    assert model_version(str(tmp_path)) == "7"
+    assert model_version(str(tmp_path / "missing")) is None
+
+
+def test_labels_are_swapped_with_the_model(tmp_path, monkeypatch):
+    model_dir = str(tmp_path)
+    write(os.path.join(model_dir, "model.tflite"), "1")
+    reloader = ReloadingBackend(ConstantBackend(model_dir), interval=0)
+    assert reloader.labels is None
+
+    write(os.path.join(model_dir, MODEL_LABELS_FILE), "background\ncat\ndog")
+    monkeypatch.setattr(reloading, "load_backend", lambda name, path: ConstantBackend(path))
+    validated = []
+    reloader._swap("2", lambda backend: validated.append(backend.labels.tolist()))  # pylint: disable=protected-access
+    assert validated == [["cat", "dog"]]
+    reloader.run(np.zeros((1, 2, 2, 3), dtype=np.float32))
+    assert reloader.labels.tolist() == ["cat", "dog"]
+    assert reloader.version == "2"
+
+    # a model without labels keeps the labels of the model before it
+    os.remove(os.path.join(model_dir, MODEL_LABELS_FILE))
+    reloader._swap("3", lambda backend: None)  # pylint: disable=protected-access
+    assert reloader.labels.tolist() == ["cat", "dog"]
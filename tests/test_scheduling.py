@@ -0,0 +1,107 @@
+"""
+Tests of the work queue (lambda/image_classifier_container/scheduling.py) and of the stop markers
+which MicroBatcher and Prefetcher queue in it when they close.
+"""
+import math
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from batching import MicroBatcher  # noqa: E402
+from download import Prefetcher  # noqa: E402
+from scheduling import Overloaded, WorkQueue  # noqa: E402
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
+
+
+def forced(work_queue):
+    return work_queue._forced  # pylint: disable=protected-access
+
+
+def create_queue(maxsize):
+    dropped = []
+    work_queue = WorkQueue(maxsize, on_drop=lambda entry, error: dropped.append((entry, error)))
+    return work_queue, dropped
+
+
+def test_sheds_least_urgent_entry():
+    work_queue, dropped = create_queue(2)
+    work_queue.put("low", priority=0)
+    work_queue.put("high", priority=1)
+    work_queue.put("higher", priority=2)
+    assert [entry for entry, _ in dropped] == ["low"]
+    assert isinstance(dropped[0][1], Overloaded)
+    assert [work_queue.get_nowait(), work_queue.get_nowait()] == ["higher", "high"]
+
+
+def test_forced_entry_is_not_shed_by_later_puts():
+    work_queue, dropped = create_queue(2)
+    work_queue.put("a")
+    work_queue.put(None, priority=-math.inf, force=True)
+    work_queue.put("b")
+    work_queue.put("c")
+    work_queue.put("d")
+    assert [entry for entry, _ in dropped] == ["c", "d"]
+    assert work_queue.qsize() == 2
+    assert [work_queue.get_nowait() for _ in range(3)] == ["a", "b", None]
+
+
+def test_batcher_closes_when_queue_fills_after_close():
+    release = threading.Event()
+    results = []
+    lock = threading.Lock()
+
+    def callback(result):
+        with lock:
+            results.append(result)
+
+    def run_batch(items):
+        release.wait()
+        return items
+
+    batcher = MicroBatcher(run_batch, max_batch_size=1, max_wait_ms=0, max_pending=2)
+    batcher.submit(0, callback)
+    wait_for(lambda: batcher.qsize() == 0)
+    for number in range(1, 3):
+        batcher.submit(number, callback)
+    closing = threading.Thread(target=batcher.close)
+    closing.start()
+    # the stop marker is queued behind a full queue
+    wait_for(lambda: forced(batcher._queue) == 1)  # pylint: disable=protected-access
+    for number in range(3, 6):
+        batcher.submit(number, callback)
+    release.set()
+    closing.join(5)
+    assert not closing.is_alive()
+    assert len(results) == 6
+
+
+def test_prefetcher_closes_when_queue_fills_after_close():
+    release = threading.Event()
+    results = []
+    lock = threading.Lock()
+
+    def callback(result):
+        with lock:
+            results.append(result)
+
+    prefetcher = Prefetcher(lambda source: release.wait() and source, workers=2, max_pending=2)
+    for number in range(4):
+        prefetcher.submit(number, callback)
+    closing = threading.Thread(target=prefetcher.close)
+    closing.start()
+    wait_for(lambda: forced(prefetcher._queue) == 2)  # pylint: disable=protected-access
+    for number in range(4, 8):
+        prefetcher.submit(number, callback)
+    release.set()
+    closing.join(5)
+    assert not closing.is_alive()
+    assert len(results) == 8
@@ -0,0 +1,46 @@
+"""
+Checks that the modules shared by the image classifier functions are identical in
+lambda/image_classifier_*. Each function is packaged from its own directory, so every
+change to a shared module has to be copied to all of them.
+"""
+import os
+import pytest
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), "..", "lambda")
+FUNCTIONS = ("image_classifier_container", "image_classifier_neo", "image_classifier_no_container")
+# app.py differs in how each function finds its model and labels, the rest of it is shared
+SHARED_APP_START = "\ndef prepare_image("
+
+
+def read(function, name):
+    with open(os.path.join(LAMBDA_DIR, function, name)) as file:
+        return file.read()
+
+
+def shared_modules():
+    return sorted(name for name in os.listdir(os.path.join(LAMBDA_DIR, FUNCTIONS[0]))
+                  if name.endswith(".py") and name not in ("app.py", "__init__.py"))
+
+
+def test_functions_have_the_same_modules():
+    for function in FUNCTIONS[1:]:
+        modules = sorted(name for name in os.listdir(os.path.join(LAMBDA_DIR, function))
+                         if name.endswith(".py") and name not in ("app.py", "__init__.py"))
+        assert modules == shared_modules(), function
+
+
+@pytest.mark.parametrize("name", shared_modules())
+def test_shared_modules_are_identical(name):
+    original = read(FUNCTIONS[0], name)
+    for function in FUNCTIONS[1:]:
+        assert read(function, name) == original, \
+            "lambda/{}/{} differs from lambda/{}/{}".format(function, name, FUNCTIONS[0], name)
+
+
+def test_shared_part_of_app_is_identical():
+    original = read(FUNCTIONS[0], "app.py")
+    for function in FUNCTIONS[1:]:
+        app = read(function, "app.py")
+        assert SHARED_APP_START in app, function
+        assert app[app.index(SHARED_APP_START):] == original[original.index(SHARED_APP_START):], \
+            "lambda/{}/app.py differs from lambda/{}/app.py after prepare_image".format(function, FUNCTIONS[0])
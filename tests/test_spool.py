@@ -0,0 +1,162 @@
+"""
+Tests of the spool of unpublished results (lambda/image_classifier_container/spool.py).
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from spool import DEAD_LETTER_FILE, Spool  # noqa: E402
+
+MAX_BYTES = 1000
+
+
+class Broker:
+    """
+        publish() of the spool which rejects messages above MAX_BYTES and while offline.
+    """
+
+    def __init__(self, online=True, rejects=()):
+        self.online = online
+        self.rejects = rejects
+        self.messages = []
+        self.lock = threading.Lock()
+
+    def publish(self, topic, payload):
+        if not self.online:
+            raise ConnectionError("offline")
+        if len(payload) > MAX_BYTES or any(reject in payload for reject in self.rejects):
+            raise ValueError("message rejected")
+        with self.lock:
+            self.messages.append((topic, json.loads(payload)))
+
+    def published(self):
+        with self.lock:
+            return [message.get("i") for _, payload in self.messages
+                    for message in payload.get("spooled", [payload])]
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "timed out"
+        time.sleep(0.01)
+
+
+def create_spool(directory):
+    return Spool(str(directory), flush_rate=0, flush_batch=100, retry_interval=0.01,
+                 max_message_bytes=MAX_BYTES, max_attempts=3)
+
+
+def test_coalesced_messages_stay_below_max_bytes(tmp_path):
+    broker = Broker()
+    spool = create_spool(tmp_path)
+    for number in range(50):
+        spool.append("t", json.dumps({"i": number, "pad": "x" * 100}))
+    spool.start(broker.publish)
+    wait_for(lambda: len(broker.published()) == 50)
+    assert broker.published() == list(range(50))
+    assert len(broker.messages) > 1
+    assert spool.stats()["dead_lettered"] == 0
+
+
+def test_large_message_is_published_as_it_is(tmp_path):
+    broker = Broker()
+    spool = create_spool(tmp_path)
+    payload = json.dumps({"i": 0, "pad": "x" * (MAX_BYTES - 20)})
+    spool.append("t", payload)
+    spool.start(broker.publish)
+    wait_for(lambda: broker.published() == [0])
+    assert "spooled" not in broker.messages[0][1]
+
+
+def test_rejected_message_is_dead_lettered(tmp_path):
+    broker = Broker(rejects=['"i": 3,'])
+    spool = create_spool(tmp_path)
+    for number in range(6):
+        spool.append("t", json.dumps({"i": number, "pad": ""}))
+    spool.start(broker.publish)
+    wait_for(lambda: spool.stats()["flushed"] == 5)
+    assert sorted(set(broker.published())) == [0, 1, 2, 4, 5]
+    assert spool.stats()["dead_lettered"] == 1
+    with open(os.path.join(str(tmp_path), DEAD_LETTER_FILE)) as file:
+        assert json.loads(json.loads(file.read())["payload"])["i"] == 3
+
+
+def test_nothing_is_dead_lettered_while_offline(tmp_path):
+    broker = Broker(online=False)
+    spool = create_spool(tmp_path)
+    spool.append("t", json.dumps({"i": 0}))
+    spool.start(broker.publish)
+    # the flush fails far more often than max_attempts while the core is offline
+    for number in range(1, 30):
+        spool.append("t", json.dumps({"i": number}))
+        time.sleep(0.02)
+    broker.online = True
+    wait_for(lambda: len(broker.published()) == 30)
+    assert spool.stats()["dead_lettered"] == 0
+
+
+def test_rejected_message_at_the_end_of_a_segment_is_dead_lettered(tmp_path):
+    broker = Broker(rejects=['"i": 1}'])
+    spool = Spool(str(tmp_path), segment_bytes=60, flush_rate=0, retry_interval=0.01,
+                  max_message_bytes=MAX_BYTES, max_attempts=3)
+    for number in range(3):
+        spool.append("t", json.dumps({"i": number}))
+    assert spool.stats()["segments"] == 3
+    spool.start(broker.publish)
+    wait_for(lambda: spool.stats()["flushed"] == 2 and spool.stats()["segments"] == 0)
+    assert broker.published() == [0, 2]
+    assert spool.stats()["dead_lettered"] == 1
+
+
+def test_messages_are_spooled_right_away_while_offline(tmp_path):
+    broker = Broker(online=False)
+    attempts = []
+
+    def publish(topic, payload):
+        attempts.append(payload)
+        broker.publish(topic, payload)
+
+    spool = create_spool(tmp_path)
+    spool.start(broker.publish)
+    for number in range(5):
+        spool.publish(publish, "t", json.dumps({"i": number}))
+    # only the first message waits for the failing publish
+    assert len(attempts) == 1
+    assert spool.stats()["offline"] and spool.stats()["spooled"] == 5
+
+    broker.online = True
+    wait_for(lambda: not spool.stats()["offline"])
+    spool.publish(publish, "t", json.dumps({"i": 5}))
+    assert len(attempts) == 2
+    wait_for(lambda: sorted(broker.published()) == list(range(6)))
+
+
+def test_segment_being_flushed_is_not_dropped(tmp_path):
+    flushing = threading.Event()
+    release = threading.Event()
+    published = []
+
+    def publish(topic, payload):
+        flushing.set()
+        release.wait()
+        published.extend(message["i"] for message in json.loads(payload)["spooled"])
+
+    spool = Spool(str(tmp_path), max_bytes=200, segment_bytes=60, flush_rate=0, flush_batch=1,
+                  retry_interval=0.01, max_message_bytes=MAX_BYTES)
+    spool.append("t", json.dumps({"i": 0}))
+    spool.start(publish)
+    assert flushing.wait(5)
+    # the flusher reads the first segment, the oldest of the others are dropped instead
+    for number in range(1, 20):
+        spool.append("t", json.dumps({"i": number}))
+    assert os.path.exists(spool._path(0))  # pylint: disable=protected-access
+    assert spool.stats()["dropped_bytes"] > 0
+    release.set()
+    wait_for(lambda: spool.stats()["segments"] == 0)
+    assert published[0] == 0 and published[-1] == 19
+    assert spool.stats()["flushed"] == len(published)
@@ -0,0 +1,20 @@
+"""
+Tests of the batch sizes warmed up at startup (lambda/image_classifier_container/startup.py).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+from startup import warmup_batch_sizes  # noqa: E402
+
+
+def test_warms_up_larger_batches():
+    assert warmup_batch_sizes("all", 4) == [1, 2, 3, 4]
+    assert warmup_batch_sizes("all", 4, larger_batch_sizes=(32, None, 16, 4, 32)) == [1, 2, 3, 4, 16, 32]
+
+
+def test_explicit_and_fixed_batch_sizes():
+    assert warmup_batch_sizes("8, 1", 4, larger_batch_sizes=(32,)) == [1, 8]
+    assert warmup_batch_sizes("all", 4, fixed_batch_size=1, larger_batch_sizes=(32,)) == [1]
+    assert warmup_batch_sizes("none", 4, larger_batch_sizes=(32,)) == []
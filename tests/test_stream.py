@@ -0,0 +1,63 @@
+"""
+Tests of reading frames from a directory (lambda/image_classifier_container/stream.py).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lambda", "image_classifier_container"))
+# pylint: disable=wrong-import-position
+import stream  # noqa: E402
+from stream import read_directory  # noqa: E402
+
+
+def write_frame(directory, name, data=b"frame"):
+    with open(os.path.join(directory, "." + name), "wb") as file:
+        file.write(data)
+    os.rename(os.path.join(directory, "." + name), os.path.join(directory, name))
+
+
+def test_deletes_frames_once_read(tmp_path):
+    directory = str(tmp_path)
+    write_frame(directory, "1.jpg", b"first")
+    write_frame(directory, "2.jpg", b"second")
+    frames = read_directory(directory, poll_interval=0.001, processed="delete")
+    assert next(frames) == (os.path.join(directory, "1.jpg"), b"first")
+    assert next(frames) == (os.path.join(directory, "2.jpg"), b"second")
+    assert os.listdir(directory) == []
+
+
+def test_moves_frames_once_read(tmp_path):
+    directory, done = str(tmp_path / "frames"), str(tmp_path / "done")
+    os.mkdir(directory)
+    write_frame(directory, "1.png")
+    frames = read_directory(directory, poll_interval=0.001, processed=done)
+    assert next(frames)[0] == os.path.join(directory, "1.png")
+    assert os.listdir(directory) == []
+    assert os.listdir(done) == ["1.png"]
+
+
+def test_lists_only_changed_directories(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    write_frame(directory, "1.jpg")
+    listed = []
+    listdir = os.listdir
+
+    def count_listdir(path):
+        listed.append(path)
+        return listdir(path)
+    monkeypatch.setattr(stream.os, "listdir", count_listdir)
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if len(sleeps) == 20:
+            write_frame(directory, "2.jpg")
+            # make sure the change is visible on file systems with coarse timestamps
+            stat = os.stat(directory)
+            os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    monkeypatch.setattr(stream.time, "sleep", sleep)
+    frames = read_directory(directory, poll_interval=0.001, rescan_interval=60)
+    assert next(frames)[0].endswith("1.jpg")
+    assert next(frames)[0].endswith("2.jpg")
+    assert len(sleeps) == 20
+    assert len(listed) == 2